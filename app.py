@@ -1,27 +1,197 @@
+import time
+RUN_STARTED = time.perf_counter()  # Start of this script run, for the startup report
 import streamlit as st
-from snowflake.snowpark import Session
-from snowflake.snowpark.context import get_active_session
-from snowflake.core import Root
-import pandas as pd
 import json
-from fpdf import FPDF
-from markdown2 import markdown
-from bs4 import BeautifulSoup  # To handle HTML parsing
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from functools import partial
 import base64
+import contextvars
+import sys
+import tempfile
+from backends import LocalBackend, SnowflakeBackend
+from concurrency import AdmissionController, AdmittedBackend, deadline_stream, fan_out
+from connection import PooledConnection, SessionPool
+from conversation import ConversationStore, SessionMemory, deep_size
+from exports import ExportJobs, render_meal_plan_csv, render_response_pdf, render_shopping_list_pdf
+from mealplan import MEAL_SLOTS, SLOT_QUERIES, PlanRequest, build_meal_plan, estimate_calories
+from nutrition import NutritionSnapshot, comparison_context, compared_rows, ranking_context
+from prefetch import Prefetcher, predict_follow_ups
+from telemetry import InstrumentedBackend, Tracer, current_span, serve
+from retrieval import constraint_filter, extract_constraints, rerank
+from routing import ModelRouter
+from prompting import estimate_tokens, format_chat_history, recipe_context, truncate_lines_to_tokens
+from caching import SQLiteCache, TTLCache, TieredCache, VectorIndex, make_key, normalize_query
+IMPORTS_DONE = time.perf_counter()
 st.set_page_config(page_title='NutriMate', layout = 'wide', page_icon = 'static/NutriMate2.png', initial_sidebar_state = 'auto')
 
-pd.set_option("max_colwidth", None)
-
 # Default Values
 NUM_CHUNKS = 4  # Number of chunks provided as context. Adjust this to optimize accuracy
 SLIDE_WINDOW = 7  # Number of past conversations to remember
+SUMMARY_MAX_WORDS = 120  # Length of the rolling summary of older conversation
+CONTEXT_TOKEN_BUDGET = 2000  # Approximate tokens of search results sent with each question
+HISTORY_TOKEN_BUDGET = 500  # Approximate tokens of chat history sent with each question
+INGREDIENT_DETAILS = False  # Ask the model about every by-name match before answering, one extra batch of completions per turn
+
+# Session memory parameters
+SESSION_MESSAGES_IN_MEMORY = 2 * SLIDE_WINDOW  # Newest messages a session keeps as text; older ones are spilled to disk
+SESSION_MEMORY_LIMIT = 256 * 1024  # Bytes of message text a session keeps in memory
+SESSION_SPILL_PATH = st.secrets.get("SESSION_SPILL_PATH") or os.path.join(tempfile.gettempdir(), "nutrimate_sessions.db")
+SESSION_SPILL_TTL = 7 * 24 * 3600  # Seconds spilled messages and search results are kept
+SESSION_IDLE = 3600  # Seconds after which a silent session drops out of the memory report
+
+# Backend parameters
+BACKEND = st.secrets.get("BACKEND", "snowflake")  # "local" runs offline on the fixtures in LOCAL_FIXTURES_DIR
+LOCAL_FIXTURES_DIR = st.secrets.get("LOCAL_FIXTURES_DIR", "fixtures")
+LOCAL_LATENCY = float(st.secrets.get("LOCAL_LATENCY", 0.0))  # Seconds the local backend sleeps per call
+LOCAL_TOKEN_LATENCY = float(st.secrets.get("LOCAL_TOKEN_LATENCY", 0.0))  # Seconds per word of a local completion
+
+
+def service_secret(name):
+    # The local backend needs no Snowflake configuration
+    return st.secrets.get(name, "") if BACKEND == "local" else st.secrets[name]
+
 
 # Service parameters
-CORTEX_SEARCH_DATABASE =st.secrets["CORTEX_SEARCH_DATABASE"]
-CORTEX_SEARCH_SCHEMA = st.secrets["CORTEX_SEARCH_SCHEMA"]
-RECIPE_SEARCH_SERVICE = st.secrets["RECIPE_SEARCH_SERVICE"]
-INGREDIENT_SEARCH_SERVICE =st.secrets["INGREDIENT_SEARCH_SERVICE"]
-INGREDIENT_BY_NAME_SEARCH_SERVICE =st.secrets["INGREDIENT_BY_NAME_SEARCH_SERVICE"]
+CORTEX_SEARCH_DATABASE = service_secret("CORTEX_SEARCH_DATABASE")
+CORTEX_SEARCH_SCHEMA = service_secret("CORTEX_SEARCH_SCHEMA")
+RECIPE_SEARCH_SERVICE = service_secret("RECIPE_SEARCH_SERVICE")
+INGREDIENT_SEARCH_SERVICE = service_secret("INGREDIENT_SEARCH_SERVICE")
+INGREDIENT_BY_NAME_SEARCH_SERVICE = service_secret("INGREDIENT_BY_NAME_SEARCH_SERVICE")
+
+# Connection parameters
+SESSION_POOL_SIZE = int(st.secrets.get("SESSION_POOL_SIZE", 4))  # Snowflake sessions shared by all users
+
+# Batching parameters
+BATCH_COMPLETE = True  # Send independent prompts to Cortex as one SQL statement
+CORTEX_BATCH_SIZE = 50  # Maximum prompts per batched statement
+
+# Concurrency parameters
+# Either one limit for all warehouses or a [CORTEX_CONCURRENCY] table mapping warehouse name to limit
+CORTEX_CONCURRENCY = st.secrets.get("CORTEX_CONCURRENCY", 4)
+CORTEX_CALL_TIMEOUT = 60  # Seconds a single fanned-out Cortex call may run
+ADMISSION_LIMIT = st.secrets.get("ADMISSION_LIMIT")  # Remote calls in flight across all users, defaults to the warehouse concurrency
+ADMISSION_MAX_WAIT = 60  # Seconds a call may queue for a slot before failing
+
+# Model routing parameters
+MODEL_ROUTING = True  # Default of the sidebar toggle; the selected model is the largest a turn may use
+STAGE_MODELS = {  # Fixed models of the sub-steps; the answer is routed by question complexity
+    "rewrite": "mistral-7b",
+    "summary": "mistral-7b",
+    "extract": "mistral-7b",
+    "details": "mistral-7b",
+    "shopping_list": "mixtral-8x7b",
+}
+MODEL_LATENCY_BUDGETS = {"answer": 20, "details": 10, "rewrite": 5}  # Seconds of p90 latency before routing steps down
+MODEL_TIMEOUTS = {"answer": 60, "details": 30, "rewrite": 15, "summary": 30, "extract": 15, "shopping_list": 60}  # Seconds before retrying on a smaller model
+MODEL_COST_BUDGET = float(st.secrets.get("MODEL_COST_BUDGET", 0))  # Credits per million tokens a model may cost, 0 for no limit
+
+# Streaming parameters
+STREAM_RESPONSES = True  # Stream COMPLETE tokens through the Cortex REST API, falling back to SQL on failure
+CORTEX_REST_URL = st.secrets.get("CORTEX_REST_URL") or f"https://{service_secret('account')}.snowflakecomputing.com"
+STREAM_TIMEOUT = 120  # Seconds
+STREAM_FIRST_TOKEN_TIMEOUT = 20  # Seconds to the first token before the answer falls back to a smaller model; MODEL_TIMEOUTS["answer"] bounds the whole stream
+
+# Telemetry parameters
+TELEMETRY_PORT = st.secrets.get("TELEMETRY_PORT")  # Serve /metrics (Prometheus) and /traces (OTLP JSON) on this port
+TRACE_WATERFALL = True  # Show the spans of the last turn in the debug sidebar
+
+# Cache parameters
+CACHE_DB_PATH = st.secrets.get("CACHE_DB_PATH")  # Optional SQLite file shared across sessions and restarts
+CLASSIFICATION_CACHE_SIZE = 2048
+CLASSIFICATION_CACHE_TTL = 7 * 24 * 3600  # Seconds
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = int(st.secrets.get("SEARCH_CACHE_TTL", 60))  # Seconds, keep in line with the search services' TARGET_LAG
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL = 6 * 3600  # Seconds
+SEMANTIC_ANSWER_CACHE = True  # Also reuse answers of near-duplicate questions with the same search results
+SEMANTIC_SIMILARITY = 0.95  # Minimum cosine similarity between question embeddings
+EMBED_MODEL = "snowflake-arctic-embed-m"
+HISTORY_REWRITE_OVERLAP = 0.8  # Below this word overlap the condensed query counts as changed by the chat history
+
+CLASSIFY_EXPR = """
+    SNOWFLAKE.CORTEX.CLASSIFY_TEXT(
+      ?,
+      [
+        {
+          'label': 'recipe',
+          'description': 'Queries related to cooking or preparing specific dishes or meals',
+          'examples': ['How do I bake a chocolate cake?', 'Give me a recipe for lasagna', 'What are the steps to make sushi?']
+        },
+        {
+          'label': 'ingredients',
+          'description': 'Queries related to categories of food based on their nutritional facts or general properties',
+          'examples': ['What are some high-protein foods?', 'Suggest some low-calorie food categories', 'What should diabetics avoid eating?']
+        },
+        {
+          'label': 'ingredients_by_name',
+          'description': 'Queries specifically mentioning a named ingredient to get its properties or nutritional facts',
+          'examples': ['What are the nutritional facts of mangoes?', 'Tell me about oranges', 'Explain the benefits of bananas.']
+        }
+      ],
+      {'task_description': 'Classify the query as recipe, ingredients, or ingredients_by_name based on whether the user asks about preparing a dish, general food properties, or specific ingredient details.'}
+    )
+    """
+
+# Patterns are matched against normalize_query() output (lowercase, no punctuation or hyphens)
+KEYWORD_RULES = [
+    ("recipe", re.compile(r"\b(recipes?|how (do|to|can|should) (i |we |you )?(make|cook|bake|prepare|fry|grill)|meal plan)\b")),
+    ("ingredients", re.compile(r"\b(foods?|ingredients?|items?) (that are |which are )?(high|low|rich|poor) in\b|\b(high|low) (protein|calorie|carb|carbohydrate|fat|fiber|sugar|sodium) (foods?|ingredients?|items?)\b")),
+    ("ingredients_by_name", re.compile(r"^(what (is|are) the )?(nutrition(al)? (facts|values?|information|info)|calories|benefits) (of|in) \w+|^tell me about \w+")),
+]
+# Labels come from both classifiers, so editing either one invalidates the cached labels
+CLASSIFIER_VERSION = make_key(CLASSIFY_EXPR, [(label, pattern.pattern) for label, pattern in KEYWORD_RULES])
+
+# Export parameters
+EXPORT_WORKERS = 2  # Background threads rendering PDFs and CSVs
+EXPORT_MEMORY_ITEMS = 16  # Rendered files kept in memory; all of them are also kept in SESSION_SPILL_PATH
+EXPORT_TTL = 3600  # Seconds
+SHOPPING_LIST_LLM = True  # Let the LLM polish the locally aggregated shopping list
+SHOPPING_LIST_LLM_MAX_ITEMS = 40  # Longer lists are exported as aggregated, without the LLM pass
+EXPORTS = {
+    # name: (label, icon, file name, mime type)
+    "shopping_list": ("Shopping List as PDF", ":material/shopping_bag:", "shopping_list.pdf", "application/pdf"),
+    "meal_plan": ("Meal Plan as CSV", ":material/ramen_dining:", "mealplan.csv", "text/csv"),
+    "response_pdf": ("Full Response as PDF", ":material/picture_as_pdf:", "recipes.pdf", "application/pdf"),
+}
+
+# Speculative prefetch parameters
+PREFETCH = True  # Start the recipe exports and warm the searches of likely follow-ups while the answer is generated
+PREFETCH_FOLLOW_UPS = 3  # Follow-up questions suggested and warmed per recipe turn
+PREFETCH_WORKERS = 2  # Background threads warming the search cache
+
+# Local nutrition snapshot parameters
+LOCAL_NUTRITION_SNAPSHOT = st.secrets.get("LOCAL_NUTRITION_SNAPSHOT", False)  # Answer structured ingredient queries locally
+NUTRITION_TABLE = st.secrets.get("NUTRITION_TABLE", "TABLE2")
+NUTRITION_SNAPSHOT_PATH = st.secrets.get("NUTRITION_SNAPSHOT_PATH", "nutrition_snapshot.parquet")
+NUTRITION_SNAPSHOT_MAX_AGE = 24 * 3600  # Seconds before the snapshot is pulled again
+
+# Meal plan parameters
+MEAL_PLAN_DIR = st.secrets.get("MEAL_PLAN_DIR", "meal_plans")  # Where generated plan files are written
+MEAL_PLAN_SEARCH_FILTERS = st.secrets.get("MEAL_PLAN_SEARCH_FILTERS", False)  # The recipe service has DIET and CUISINE as ATTRIBUTES
+MEAL_PLAN_PAGE_SIZE = 50  # Recipes per search request
+MEAL_PLAN_MAX_WEEKS = 8
+MEAL_PLAN_CHUNK_ROWS = 500  # Rows written to the plan file at a time
+
+# Recipe retrieval parameters
+RECIPE_SEARCH_FILTERS = st.secrets.get("RECIPE_SEARCH_FILTERS", MEAL_PLAN_SEARCH_FILTERS)  # Filter chat searches on DIET and CUISINE
+RECIPE_CANDIDATES = 5  # Recipes searched per recipe returned, reranked locally against the question's constraints
+
+DIETS = [
+    "Vegetarian", "Non Vegeterian", "Eggetarian", "Vegan", "High Protein Vegetarian",
+    "High Protein Non Vegetarian", "Diabetic Friendly", "Gluten Free", "Sugar Free Diet",
+    "No Onion No Garlic (Sattvic)",
+]
+
+# Words that make a question depend on the chat history, see is_self_contained()
+FOLLOW_UP_WORDS = {
+    "it", "its", "that", "this", "those", "these", "them", "they", "their", "one", "ones", "same",
+    "more", "another", "other", "else", "instead", "also", "too", "again", "above", "previous",
+    "earlier", "last", "first", "second", "third", "similar", "such", "there", "both",
+}
 
 # Updated Default Values
 TABLE2_COLUMNS = [
@@ -50,6 +220,9 @@ def init_session():
     """
     Initializes and returns a Snowflake session using the Snowpark library.
     """
+    # Imported on the first question rather than on every cold start
+    from snowflake.snowpark import Session
+
     #use the details of your own account for these params
     connection_params = {
         "account":st.secrets["account"],  # Replace with your Snowflake account identifier
@@ -68,38 +241,300 @@ def init_session():
         st.error(f"Failed to connect to Snowflake: {e}")
         return None
 
-session = init_session()
-root = Root(session)
+def create_connection():
+    """
+    Opens a Snowflake session and builds the Root and Cortex Search service handles on it.
+    """
+    from snowflake.core import Root
+
+    session = init_session()
+    if session is None:
+        raise RuntimeError("Failed to connect to Snowflake")
+    root = Root(session)
+
+    search_schema = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA]
+    svcR = search_schema.cortex_search_services[RECIPE_SEARCH_SERVICE]
+    svcI_N = search_schema.cortex_search_services[INGREDIENT_BY_NAME_SEARCH_SERVICE]
+    svcI = search_schema.cortex_search_services[INGREDIENT_SEARCH_SERVICE]
+    return PooledConnection(session, root, {"recipe": svcR, "ingredients": svcI, "ingredients_by_name": svcI_N})
+
+
+@st.cache_resource
+def get_session_pool():
+    """
+    Process-wide pool of Snowflake connections, created once and shared by every browser session.
+    Connections are opened lazily on the first remote call.
+    """
+    return SessionPool(create_connection, size=SESSION_POOL_SIZE)
+
+
+@st.cache_resource
+def get_tracer():
+    """
+    Process-wide tracer recording the spans of every turn, exported on TELEMETRY_PORT when set.
+    """
+    tracer = Tracer()
+    if TELEMETRY_PORT:
+        try:
+            serve(tracer, int(TELEMETRY_PORT))
+        except OSError as e:
+            print(f"Telemetry endpoint unavailable on port {TELEMETRY_PORT}: {e}")
+    return tracer
+
+
+@st.cache_resource
+def get_admission():
+    """
+    Process-wide admission controller shared by every session, with its queue exported as gauges.
+    """
+    controller = AdmissionController(int(ADMISSION_LIMIT or warehouse_concurrency()), ADMISSION_MAX_WAIT)
+    tracer = get_tracer()
+    tracer.gauge("nutrimate_admission_active", "Remote calls running.", lambda: controller.stats()["active"])
+    tracer.gauge("nutrimate_admission_queued", "Remote calls waiting for a slot.", lambda: controller.stats()["queued"])
+    tracer.gauge("nutrimate_admission_wait_p95_seconds", "95th percentile of recent queue waits.",
+                 lambda: controller.stats()["wait_p95"])
+    return controller
+
+
+def session_user():
+    """
+    Id of this browser session, which admission control queues fairly against the others.
+    """
+    if "user_id" not in st.session_state:
+        st.session_state.user_id = os.urandom(8).hex()
+    return st.session_state.user_id
+
+
+@st.cache_resource
+def get_backend():
+    """
+    Process-wide backend serving classification, search, completion and embeddings:
+    Snowflake Cortex, or the offline LocalBackend when BACKEND is "local". Every call is traced
+    and admitted through get_admission().
+    """
+    if BACKEND == "local":
+        backend = LocalBackend(LOCAL_FIXTURES_DIR, latency=LOCAL_LATENCY, token_latency=LOCAL_TOKEN_LATENCY)
+    else:
+        backend = SnowflakeBackend(get_session_pool(), CLASSIFY_EXPR, CORTEX_REST_URL, STREAM_TIMEOUT, CORTEX_BATCH_SIZE)
+    return InstrumentedBackend(AdmittedBackend(backend, get_admission()), get_tracer())
+
+
+@dataclass
+class TurnContext:
+    """
+    Classification, condensed query and search results of one chat turn.
+    """
+    question: str
+    classification: str
+    chat_history: str
+    search_query: str
+    search_results: dict
+    embedding: list = None
+    answer_model: str = None  # Routed model of the answer, then the model that actually generated it
 
-svcR = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[RECIPE_SEARCH_SERVICE]
-svcI_N = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[INGREDIENT_BY_NAME_SEARCH_SERVICE]
-svcI = root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[INGREDIENT_SEARCH_SERVICE]
 
 ### Functions
-def add_bg_from_local(image_file):
+@contextmanager
+def timed(stage):
     """
-    Adds a background image to the Streamlit app using a local image file.
+    Records the seconds spent in the with-block under `stage` in the current turn's timings
+    and traces it as a span.
+    """
+    start = time.perf_counter()
+    try:
+        with get_tracer().span(stage):
+            yield
+    finally:
+        timings = st.session_state.setdefault("turn_timings", {})
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def mark_cache(result):
+    """
+    Tags the current stage's span with the outcome of its cache lookup, e.g. "hit" or "miss".
+    """
+    span = current_span()
+    if span is not None:
+        span.set("cache", result)
+
+
+def backend_calls():
+    return sum(get_backend().stats().get("calls", {}).values())
+
+
+def warehouse_concurrency():
+    """
+    Returns the number of Cortex calls that may run in parallel on the configured warehouse.
+    """
+    if hasattr(CORTEX_CONCURRENCY, "get"):
+        return int(CORTEX_CONCURRENCY.get(st.secrets.get("warehouse"), 4))
+    return int(CORTEX_CONCURRENCY)
+
+
+@st.cache_resource
+def get_cortex_executor():
+    """
+    Process-wide thread pool for independent Cortex calls, bounded by the warehouse concurrency limit.
+    """
+    return ThreadPoolExecutor(max_workers=warehouse_concurrency(), thread_name_prefix="cortex")
+
+
+@st.cache_resource
+def get_router():
+    """
+    Process-wide model router; its latency stats are shared by every session.
+    """
+    return ModelRouter(STAGE_MODELS, MODEL_LATENCY_BUDGETS, MODEL_TIMEOUTS, cost_budget=MODEL_COST_BUDGET)
+
+
+def route(stage, question=""):
+    """
+    Returns the model for a stage of this session's turn: the selected model when routing is off.
+    """
+    if not st.session_state.get("model_routing", MODEL_ROUTING):
+        return st.session_state.model_name
+    return get_router().choose(stage, question, ceiling=st.session_state.model_name)
+
+
+def routed_complete(stage, prompt, model_name):
+    """
+    Completes prompt on model_name, retrying on smaller models when the call times out or fails.
+    Safe to call from worker threads.
+    """
+    response, _ = get_router().call(stage, model_name, partial(cortex_complete, prompt))
+    return response
+
+
+def stream_cortex_complete(prompt, model_name=None):
+    """
+    Streams a completion and yields the text chunks as they arrive.
+    """
+    return get_backend().stream(prompt, model_name or st.session_state.model_name)
+
+
+def complete_into(message_placeholder, prompt, model_name=None):
     """
-    with open(image_file, "rb") as img_file:
-        encoded_img = base64.b64encode(img_file.read()).decode()
-    st.markdown(
-        f"""
+    Writes the completion into the chat placeholder token by token and returns the full text.
+    Falls back to the blocking SQL path, and from there to smaller models, when streaming is
+    disabled or fails. A stream that misses its first-token or total deadline falls back to the
+    next smaller model right away.
+    """
+    model_name = model_name or st.session_state.model_name
+    metrics = {
+        "model": model_name,
+        "streamed": False,
+        "time_to_first_token": None,
+        "total_time": None,
+    }
+    start = time.perf_counter()
+    res_text = ""
+    fallback_model = model_name
+    if STREAM_RESPONSES:
+        chunks = deadline_stream(stream_cortex_complete(prompt, model_name), STREAM_FIRST_TOKEN_TIMEOUT,
+                                 MODEL_TIMEOUTS.get("answer"))
+        try:
+            for chunk in chunks:
+                if metrics["time_to_first_token"] is None:
+                    metrics["time_to_first_token"] = time.perf_counter() - start
+                res_text += chunk
+                message_placeholder.markdown(res_text + "▌")
+            metrics["streamed"] = bool(res_text)
+            if metrics["streamed"]:
+                get_router().record("answer", model_name, time.perf_counter() - start)
+        except TimeoutError as e:
+            get_router().record("answer", model_name, time.perf_counter() - start, "timeout")
+            # Retrying the same model would likely be as slow, so start one size down when there is one
+            fallback_model = (get_router().fallbacks(model_name)[1:] or [model_name])[0]
+            print(f"Streaming on {model_name} {e}, falling back to {fallback_model}")
+        except Exception as e:
+            get_router().record("answer", model_name, time.perf_counter() - start, "error")
+            print(f"Streaming failed, falling back to SQL: {e}")
+
+    if not metrics["streamed"]:
+        res_text, metrics["model"] = get_router().call("answer", fallback_model, partial(cortex_complete, prompt))
+        res_text = res_text or "No response received."
+        metrics["time_to_first_token"] = time.perf_counter() - start
+
+    metrics["total_time"] = time.perf_counter() - start
+    st.session_state.completion_metrics = metrics
+    message_placeholder.markdown(res_text)
+    return res_text
+
+
+def cortex_complete(prompt, model_name=None):
+    """
+    Runs snowflake.cortex.complete on a single prompt and returns the response text.
+    """
+    return get_backend().complete(prompt, model_name or st.session_state.model_name)
+
+def cortex_complete_batch(prompts, model_name=None):
+    """
+    Completes many independent prompts with one SQL statement per CORTEX_BATCH_SIZE prompts
+    and returns the responses in the order of the prompts.
+    """
+    return get_backend().complete_batch(prompts, model_name or st.session_state.model_name)
+
+
+@st.cache_resource
+def background_css(image_file):
+    """
+    Builds the background CSS once per process. With static file serving enabled the image is
+    referenced by URL, so browsers cache it instead of receiving it inline on every rerun.
+    """
+    if st.get_option("server.enableStaticServing") and image_file.startswith("static/"):
+        url = f"app/{image_file}"
+    else:
+        with open(image_file, "rb") as img_file:
+            url = f"data:image/png;base64,{base64.b64encode(img_file.read()).decode()}"
+    return f"""
         <style>
         .stApp {{
-            background-image: url("data:image/png;base64,{encoded_img}");
+            background-image: url("{url}");
             background-position: center;
             background-size: 78%; /* Keeps the original size of the image */
             background-repeat: no-repeat; /* Repeats the image both horizontally and vertically */
             background-attachment: scroll; /* Ensures it scrolls with the content */
         }}
         </style>
-        """,
-        unsafe_allow_html=True
-    )
+        """
+
+
+def add_bg_from_local(image_file):
+    """
+    Adds a background image to the Streamlit app using a local image file.
+    """
+    st.markdown(background_css(image_file), unsafe_allow_html=True)
 
 # Use the function
 add_bg_from_local("static/background.png")
 
+@st.cache_resource
+def get_startup_report():
+    """
+    Timings of the first script run in this process, i.e. the cold start.
+    """
+    return {"imports": IMPORTS_DONE - RUN_STARTED, "first_render": None}
+
+
+def show_startup_report():
+    """
+    Records the cold start once per process and shows it next to this rerun's timings.
+    """
+    rendered = time.perf_counter() - RUN_STARTED
+    report = get_startup_report()
+    if report["first_render"] is None:
+        report["first_render"] = rendered
+        print(f"Cold start: imports {report['imports']:.3f}s, first render {rendered:.3f}s")
+    if st.session_state.get("debug"):
+        with st.sidebar.expander("Startup"):
+            st.json({
+                "cold_start": {name: round(value, 3) for name, value in report.items()},
+                "this_run": {"imports": round(IMPORTS_DONE - RUN_STARTED, 3), "render": round(rendered, 3)},
+                # Deferred until first used
+                "loaded": {name: name in sys.modules for name in ("pandas", "snowflake.snowpark", "fpdf", "bs4", "markdown2")},
+            })
+
+
 def load_css():
     with open("static/styles.css", "r") as f:
         st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
@@ -111,173 +546,373 @@ def config_options():
         'mixtral-8x7b',
         'mistral-large',
         'mistral-7b'), key="model_name")
+    st.sidebar.checkbox('Use smaller models for sub-steps and simple questions', key="model_routing", value=MODEL_ROUTING)
     st.sidebar.checkbox('Do you want me to remember the chat history?', key="use_chat_history", value=True)
     st.sidebar.checkbox('Debug: Click to see summary of previous conversations', key="debug", value=True)
     st.sidebar.button("Start Over", key="clear_conversation", on_click=reset_state)
+    meal_plan_options()
+    if st.session_state.debug:
+        if st.session_state.get("conversation_summary"):
+            st.sidebar.text("Summary of previous conversations:")
+            st.sidebar.caption(st.session_state.conversation_summary)
+        with st.sidebar.expander("Classification cache"):
+            st.json(get_classification_cache().stats())
+            st.button("Clear classification cache", on_click=invalidate_classification_cache)
+        with st.sidebar.expander("Cortex admission"):
+            st.json(get_admission().stats())
+        with st.sidebar.expander("Prefetch"):
+            st.json(get_prefetcher().stats())
+        with st.sidebar.expander("Model routing"):
+            st.json(get_router().stats())
+        with st.sidebar.expander("Snowflake connection" if BACKEND != "local" else "Local backend"):
+            st.json(get_backend().stats())
+        if LOCAL_NUTRITION_SNAPSHOT:
+            with st.sidebar.expander("Nutrition snapshot"):
+                # Loading may query Snowflake, so it is left to the first question that needs it
+                if os.path.exists(NUTRITION_SNAPSHOT_PATH):
+                    saved_at = time.localtime(os.path.getmtime(NUTRITION_SNAPSHOT_PATH))
+                    st.caption(f"Saved {time.strftime('%Y-%m-%d %H:%M', saved_at)}")
+                else:
+                    st.caption("Not saved yet")
+                st.button("Refresh snapshot", on_click=refresh_nutrition_snapshot)
+        with st.sidebar.expander("Search cache"):
+            st.json(get_search_cache().stats())
+            st.button("Clear search cache", on_click=get_search_cache().clear)
+        with st.sidebar.expander("Answer cache"):
+            st.json({"exact": get_answer_cache().stats(), "semantic": get_answer_index().stats()})
+            st.button("Clear answer cache", on_click=clear_answer_cache)
     #st.sidebar.expander("Session State").write(st.session_state)
 
 
-def generate_shopping_list(json_data):
-    """
-    Generates a shopping list from JSON data, refines it using Snowflake Cortex, 
-    and ensures Markdown content is properly formatted for the PDF.
-    """
-    try:
-        # Combine ingredients from all recipes into a single text block
-        combined_ingredients = []
-        for item in json_data.get('results', []):
-            ingredients = item.get('TRANSLATEDINGREDIENTS', "").split(", ")
-            combined_ingredients.extend(ingredients)
-
-        # Create a single text input for the Cortex model
-        ingredients_text = "\n".join(combined_ingredients)
-        prompt = f"""
-            You are a smart assistant. Create a comprehensive shopping list in Markdown format 
-            (use headers, bullet points, and **bold** where appropriate) based on the following ingredients:
-            {ingredients_text}
-        """
-
-        # Use Snowflake Cortex to complete the prompt
-        cmd = """
-                SELECT snowflake.cortex.complete(?, ?) AS response
-              """
-        df_response = session.sql(cmd, params=[st.session_state.model_name, prompt]).collect()
-        shopping_list_markdown = df_response[0].RESPONSE.strip()
-
-        # Convert Markdown to HTML
-        html_text = markdown(shopping_list_markdown)
-
-        # Parse HTML into plain text using BeautifulSoup
-        soup = BeautifulSoup(html_text, 'html.parser')
-        plain_text = soup.get_text()
-
-        # Initialize the PDF object
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-
-        # Add the plain text to the PDF
-        pdf.multi_cell(0, 10, plain_text)
-
-        # Convert PDF to binary data
-        pdf_data = pdf.output(dest="S").encode("latin1")
-        st.session_state.shopping_list_pdf_data = pdf_data
-
-        #st.success("Shopping list generated successfully!")
-
-    except Exception as e:
-        st.error(f"An error occurred while generating the shopping list: {e}")
-
-def extract_ingredients(query):
+def extract_ingredients(query, model_name=None):
     """Extracts specific ingredients from the user query."""
     ingredient_prompt = f"List the specific ingredients mentioned in the following query: {query}"
-    cmd = """
-            SELECT snowflake.cortex.complete(?, ?) AS response
-          """
-    response = session.sql(
-        cmd, params=[st.session_state.model_name, ingredient_prompt]
-    ).collect()
+    response = routed_complete("extract", ingredient_prompt, model_name or route("extract", query))
     
     if response:
         ingredients = [
             ingredient.strip()
-            for ingredient in response[0]["RESPONSE"].split(",")
+            for ingredient in response.split(",")
         ]
         return ingredients
     return []
 
-def fetch_ingredient_details(ingredient):
+def fetch_ingredient_details(ingredient, model_name=None):
     """Fetches details for a specific ingredient."""
     detail_prompt = f"Can you tell me about {ingredient}?"
-    cmd = """
-            SELECT snowflake.cortex.complete(?, ?) AS response
-          """
-    response = session.sql(
-        cmd, params=[st.session_state.model_name, detail_prompt]
-    ).collect()
+    response = routed_complete("details", detail_prompt, model_name or route("details", ingredient))
     
     if response:
-        return response[0]["RESPONSE"]
+        return response
     return f"No details found for {ingredient}."
 
 
+@st.cache_resource
+def get_export_jobs():
+    """
+    Process-wide background queue rendering the downloadable files.
+    """
+    disk = SQLiteCache(SESSION_SPILL_PATH, cache_namespace("exports"), maxsize=1000, ttl=EXPORT_TTL)
+    return ExportJobs(max_workers=EXPORT_WORKERS, maxsize=EXPORT_MEMORY_ITEMS, ttl=EXPORT_TTL, disk=disk)
 
 
-def download_response_as_pdf(response_text):
+@st.cache_resource
+def get_meal_plan_files():
     """
-    Generates and serves the full response as a downloadable PDF file using a simplified approach.
+    Process-wide cache of the bytes of finished meal plan files by job key, read once per file.
     """
-    try:
-        # Initialize the PDF object
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
+    return TTLCache(maxsize=EXPORT_MEMORY_ITEMS, ttl=EXPORT_TTL)
 
-        # Add the response text to the PDF
-        pdf.multi_cell(0, 10, txt=response_text)  # Handles multi-line text
 
-        # Generate the PDF as a byte string
-        pdf_data = pdf.output(dest='S').encode('latin1')
+def start_exports(response):
+    """
+    Starts rendering every export of the latest turn in the background, so the files are usually
+    ready by the time the user wants them. Renders are keyed on their inputs and run only once.
+    """
+    jobs = get_export_jobs()
+    model_name = route("shopping_list")
+    keys = {}
+
+    json_data = None
+    if st.session_state.get("json_data_key"):
+        json_data = get_session_spill().get(st.session_state.json_data_key)
+    if json_data and st.session_state.classification == "recipe":
+        recipes_key = make_key([item.get("TRANSLATEDRECIPENAME") for item in json_data.get("results", [])])
+        keys["shopping_list"] = make_key("shopping_list", model_name if SHOPPING_LIST_LLM else None, recipes_key)
+        complete_fn = partial(routed_complete, "shopping_list", model_name=model_name) if SHOPPING_LIST_LLM else None
+        jobs.submit(keys["shopping_list"], render_shopping_list_pdf, json_data, complete_fn, SHOPPING_LIST_LLM_MAX_ITEMS)
+        keys["meal_plan"] = make_key("meal_plan", recipes_key)
+        jobs.submit(keys["meal_plan"], render_meal_plan_csv, json_data)
+
+    if response is not None:
+        keys["response_pdf"] = make_key("response_pdf", response)
+        jobs.submit(keys["response_pdf"], render_response_pdf, response)
+
+    # Renders of this session's earlier turns are cancelled by prefetch() once nobody wants them
+    for key in keys.values():
+        get_prefetcher().track(session_user(), key, partial(jobs.cancel, key))
+    st.session_state.export_keys = keys
+
+
+def search_recipe_page(query, limit, search_filter=None):
+    if not MEAL_PLAN_SEARCH_FILTERS:
+        # The filters are still applied to the results by the plan assembler
+        search_filter = None
+    return get_similar_chunks_search_service(query, "recipe", limit, search_filter)
+
+
+def start_meal_plan(request, file_format):
+    """
+    Starts building a meal plan file in the background. Only the job key is kept in session_state;
+    the plan itself is streamed to a file under MEAL_PLAN_DIR.
+    """
+    calories = None
+    if LOCAL_NUTRITION_SNAPSHOT and request.daily_calories:
+        try:
+            calories = partial(estimate_calories, snapshot=get_nutrition_snapshot())
+        except Exception as e:
+            print(f"Nutrition snapshot unavailable, planning without calories: {e}")
+
+    key = make_key("meal_plan_file", asdict(request), file_format, MEAL_PLAN_SEARCH_FILTERS, calories is not None)
+    os.makedirs(MEAL_PLAN_DIR, exist_ok=True)
+    remove_old_meal_plans()
+    path = os.path.join(MEAL_PLAN_DIR, f"meal_plan_{key[:12]}.{file_format}")
+    get_export_jobs().submit(
+        key, build_meal_plan, request, search_recipe_page, get_cortex_executor(), path, file_format,
+        MEAL_PLAN_PAGE_SIZE, calories, MEAL_PLAN_CHUNK_ROWS,
+    )
+    st.session_state.meal_plan_job = (key, file_format)
 
-        # Save the PDF data to session_state
-        st.session_state.pdf_data = pdf_data
 
-    except Exception as e:
-        st.error(f"An error occurred while generating the PDF: {e}")
+def remove_old_meal_plans():
+    """
+    Deletes the plan files last written more than EXPORT_TTL seconds ago, after their jobs have
+    expired from the export queue.
+    """
+    cutoff = time.time() - EXPORT_TTL
+    for entry in os.scandir(MEAL_PLAN_DIR):
+        try:
+            if entry.is_file() and entry.name.startswith("meal_plan_") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError as e:
+            # Another process may have removed it first
+            print(f"Could not remove old meal plan {entry.name}: {e}")
+
+
+def meal_plan_bytes(key, path):
+    files = get_meal_plan_files()
+    data = files.get(key)
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+        files.set(key, data)
+    return data
+
+
+def meal_plan_options():
+    with st.sidebar.expander("Meal plan"):
+        with st.form("meal_plan_form"):
+            weeks = st.number_input("Weeks", min_value=1, max_value=MEAL_PLAN_MAX_WEEKS, value=1)
+            slots = st.multiselect("Meals", list(SLOT_QUERIES), default=list(MEAL_SLOTS))
+            diet = st.selectbox("Diet", ["Any"] + DIETS)
+            cuisines = st.text_input("Cuisines (comma separated, empty for any)")
+            max_recipe_time = st.number_input("Max minutes per recipe (0 for any)", min_value=0, max_value=600, value=0, step=5)
+            daily_time_budget = st.number_input("Cooking minutes per day (0 for any)", min_value=0, max_value=1440, value=0, step=15)
+            daily_calories = 0
+            if LOCAL_NUTRITION_SNAPSHOT:
+                daily_calories = st.number_input("Calories per day (0 to ignore)", min_value=0, max_value=6000, value=0, step=100)
+            file_format = st.radio("Format", ["csv", "parquet"], horizontal=True)
+            if st.form_submit_button("Build meal plan") and slots:
+                request = PlanRequest(
+                    days=7 * int(weeks),
+                    slots=tuple(slots),
+                    diet="" if diet == "Any" else diet,
+                    cuisines=tuple(c.strip() for c in cuisines.split(",") if c.strip()),
+                    max_recipe_time=int(max_recipe_time),
+                    daily_time_budget=int(daily_time_budget),
+                    daily_calories=int(daily_calories),
+                )
+                start_meal_plan(request, file_format)
 
 
-def download_csv(json_data):
-    # Create a list of dictionaries for each recipe
-    recipe_data = [
-        {
-            'Recipe Name': item['TRANSLATEDRECIPENAME'],
-            'Ingredients':item['TRANSLATEDINGREDIENTS'],
-            'Instructions': item['TRANSLATEDINSTRUCTIONS'],
-            'URL': item.get('URL', 'N/A'),
-            'Prep Time (mins)': item['PREPTIMEINMINS'],
-            'Cook Time (mins)': item['COOKTIMEINMINS'],
-            'Total Time (mins)': item['TOTALTIMEINMINS'],
-            'Cuisine': item['CUISINE'],
-            'Servings': item['SERVINGS'],
-            'Diet': item['DIET']
-        }
-        for item in json_data['results']
-    ]
+def meal_plan_panel(jobs):
+    """
+    Shows the download button or progress of the requested meal plan. Returns True while it is being built.
+    """
+    job = st.session_state.get("meal_plan_job")
+    if not job:
+        return False
+    key, file_format = job
+    state, value = jobs.status(key)
+    if state == "done" and os.path.exists(value):
+        st.download_button(
+            icon=":material/calendar_month:",
+            label=f"Download Meal Plan as {file_format.upper()}",
+            data=meal_plan_bytes(key, value),
+            file_name=f"meal_plan.{file_format}",
+            mime="text/csv" if file_format == "csv" else "application/vnd.apache.parquet",
+            key="download_meal_plan_file",
+        )
+    elif state == "running":
+        st.progress(value, text=":material/calendar_month: Building meal plan...")
+        return True
+    elif state == "error":
+        st.error(f"An error occurred while building the meal plan: {value}")
+    return False
+
+
+def export_panel():
+    """
+    Shows a download button for every finished export and a progress bar for the others.
+    Runs as a fragment that polls while renders are pending.
+    """
+    jobs = get_export_jobs()
+    pending = False
+    for name, key in st.session_state.get("export_keys", {}).items():
+        label, icon, file_name, mime = EXPORTS[name]
+        state, value = jobs.status(key)
+        if state == "done":
+            st.download_button(
+                icon=":material/download:",
+                label=f"Download {label}",
+                data=value,
+                file_name=file_name,
+                mime=mime,
+                key=f"download_{name}",
+            )
+        elif state == "running":
+            pending = True
+            st.progress(value, text=f"{icon} Preparing {label}...")
+        elif state == "error":
+            st.error(f"An error occurred while generating the {label}: {value}")
+    pending = meal_plan_panel(jobs) or pending
+
+    # Once everything is rendered, rerun the app so the fragment stops polling
+    if st.session_state.get("exports_polling") and not pending:
+        st.session_state.exports_polling = False
+        st.rerun()
+
+
+def show_exports():
+    jobs = get_export_jobs()
+    keys = list(st.session_state.get("export_keys", {}).values())
+    if st.session_state.get("meal_plan_job"):
+        keys.append(st.session_state.meal_plan_job[0])
+    pending = any(jobs.status(key)[0] == "running" for key in keys)
+    st.session_state.exports_polling = pending
+    st.fragment(export_panel, run_every=1 if pending else None)()
+
+
+@st.cache_resource
+def get_prefetcher():
+    """
+    Process-wide speculative work of every session: follow-up searches and export renders.
+    """
+    prefetcher = Prefetcher(max_workers=PREFETCH_WORKERS, ttl=SEARCH_CACHE_TTL)
+    get_tracer().gauge("nutrimate_prefetch_pending", "Speculative searches waiting or running.", prefetcher.pending)
+    return prefetcher
 
-    # Convert the list of dictionaries to a DataFrame
-    df = pd.DataFrame(recipe_data)
 
-    # Generate the CSV output
-    csv_output = df.to_csv(index=False)
+def prefetch_key(query, classification, limit=NUM_CHUNKS):
+    return make_key("prefetch", classification, normalize_query(query), limit)
 
-    # Save the CSV data to session_state
-    st.session_state.csv_data = csv_output
 
+def prefetch(turn):
+    """
+    Speculative work started as soon as the turn's search results are known, while the answer is
+    still being generated: the recipe exports start rendering, and the searches of the predicted
+    follow-up questions warm the search cache. Work of earlier turns that this turn made
+    irrelevant is cancelled. The searches run as the "background" admission user, so they never
+    take a slot ahead of a waiting session.
+    """
+    follow_ups = []
+    if turn.classification == "recipe":
+        follow_ups = predict_follow_ups(turn.search_results.get("results", []), PREFETCH_FOLLOW_UPS)
+    st.session_state.follow_ups = follow_ups
+    start_exports(None)
 
-def fetch_and_store_json_data(question):
+    prefetcher = get_prefetcher()
+    keys = {prefetch_key(question, "ingredients_by_name"): question for question in follow_ups}
+    cancelled = prefetcher.release(session_user(), keep=set(keys) | set(st.session_state.export_keys.values()))
+    started = sum(prefetcher.submit(session_user(), key, get_similar_chunks_search_service, question, "ingredients_by_name")
+                  for key, question in keys.items())
+    span = current_span()
+    if span is not None:
+        span.set("follow_ups", started)
+        span.set("cancelled", cancelled)
+
+
+def ask_follow_up(question):
+    st.session_state.suggested_question = question
+
+
+def show_follow_ups():
     """
-    Fetches and stores the JSON data globally in session_state for reuse.
+    Offers the predicted follow-up questions of the last recipe turn, whose searches are warm.
     """
-    classification = classify_prompt(question)
-    if classification=='recipe':
-        if "json_data" not in st.session_state:
-            st.session_state.json_data = {}  # Initialize if not present
+    follow_ups = st.session_state.get("follow_ups")
+    if not follow_ups:
+        return
+    for column, question in zip(st.columns(len(follow_ups)), follow_ups):
+        column.button(question, key=f"follow_up_{question}", on_click=ask_follow_up, args=(question,))
 
-        if st.session_state.use_chat_history:
-            chat_history = get_chat_history()
-            if chat_history:
-                question_summary = summarize_question_with_history(chat_history, question)
-                prompt_context = get_similar_chunks_search_service(question_summary, classification)
-            else:
-                prompt_context = get_similar_chunks_search_service(question, classification)
-        else:
-            prompt_context = get_similar_chunks_search_service(question, classification)
 
-        # Parse and store JSON data in session state
-        json_data = json.loads(prompt_context)
-        st.session_state.json_data = json_data
-        # if "json_data" in st.session_state and st.session_state.json_data:
-        #     #st.success("Json data fetched and stored")
+def fetch_and_store_json_data(turn):
+    """
+    Stores the recipe search results of the current turn in the spill cache for the exports and
+    keeps only their key in session_state.
+    """
+    if turn.classification == 'recipe':
+        key = make_key("json_data", turn.search_results)
+        get_session_spill().set(key, turn.search_results)
+        st.session_state.json_data_key = key
+
+
+@st.cache_resource
+def get_session_spill():
+    """
+    Process-wide disk cache holding the older messages and search results of every session.
+    """
+    return SQLiteCache(SESSION_SPILL_PATH, cache_namespace("session_spill"), maxsize=100000, ttl=SESSION_SPILL_TTL)
+
+
+@st.cache_resource
+def get_session_memory():
+    """
+    Process-wide report of the memory held by every active session, exported as gauges.
+    """
+    memory = SessionMemory(idle=SESSION_IDLE)
+    get_tracer().gauge("nutrimate_session_memory_bytes", "Memory held by the state of active sessions.", memory.total)
+    get_tracer().gauge("nutrimate_active_sessions", "Sessions active within SESSION_IDLE.", lambda: len(memory.sessions()))
+    return memory
+
+
+def new_conversation():
+    return ConversationStore(get_session_spill(), session_user(), SESSION_MESSAGES_IN_MEMORY, SESSION_MEMORY_LIMIT)
+
+
+def report_session_memory():
+    """
+    Measures this session's state, records it in the process-wide report and shows both in the
+    debug sidebar.
+    """
+    by_key = {key: deep_size(value) for key, value in st.session_state.to_dict().items()}
+    messages = st.session_state.get("messages")
+    report = {
+        "bytes": sum(by_key.values()),
+        "messages": len(messages) if messages is not None else 0,
+        "spilled": messages.spilled() if messages is not None else 0,
+    }
+    memory = get_session_memory()
+    memory.update(session_user(), report)
+    if st.session_state.get("debug"):
+        with st.sidebar.expander("Session memory"):
+            st.json({
+                "this_session": {**report, "largest": dict(sorted(by_key.items(), key=lambda item: -item[1])[:5])},
+                "active_sessions": len(memory.sessions()),
+                "total_bytes": memory.total(),
+                "sessions": {user[:8]: value for user, value in memory.sessions().items()},
+            })
 
 
 def init_messages():
@@ -286,91 +921,274 @@ def init_messages():
     """
     if st.session_state.get("clear_conversation", False) or "messages" not in st.session_state:
         # Reset messages
-        st.session_state.messages = []
+        if st.session_state.get("messages") is not None:
+            st.session_state.messages.clear()
+        st.session_state.messages = new_conversation()
+        st.session_state.conversation_summary = ""
+        st.session_state.summarized_upto = 0
+        st.session_state.summary_job = None
 
         
 def reset_state():
     if st.session_state.get("clear_conversation", False) or "messages" not in st.session_state:
-        st.session_state.messages = []
-    st.session_state.json_data = None 
-    st.session_state.pdf_data = None  # Reset PDF data
-    st.session_state.csv_data = None  # Reset CSV data
-    st.session_state.latest_response = None
+        if st.session_state.get("messages") is not None:
+            st.session_state.messages.clear()
+        st.session_state.messages = new_conversation()
+    st.session_state.json_data_key = None
+    st.session_state.export_keys = {}  # Forget the exports of the previous conversation
+    st.session_state.follow_ups = []
+    get_prefetcher().release(session_user())
+
+def keyword_classify(query):
+    """
+    Cheap local pre-classification for obvious queries. Returns None unless exactly one label matches.
+    """
+    normalized = normalize_query(query)
+    labels = {label for label, pattern in KEYWORD_RULES if pattern.search(normalized)}
+    if len(labels) == 1:
+        return labels.pop()
+    return None
 
-def classify_prompt(query):
-    cmd = f"""
-    SELECT SNOWFLAKE.CORTEX.CLASSIFY_TEXT(
-      '{query}',
-      [
-        {{
-          'label': 'recipe',
-          'description': 'Queries related to cooking or preparing specific dishes or meals',
-          'examples': ['How do I bake a chocolate cake?', 'Give me a recipe for lasagna', 'What are the steps to make sushi?']
-        }},
-        {{
-          'label': 'ingredients',
-          'description': 'Queries related to categories of food based on their nutritional facts or general properties',
-          'examples': ['What are some high-protein foods?', 'Suggest some low-calorie food categories', 'What should diabetics avoid eating?']
-        }},
-        {{
-          'label': 'ingredients_by_name',
-          'description': 'Queries specifically mentioning a named ingredient to get its properties or nutritional facts',
-          'examples': ['What are the nutritional facts of mangoes?', 'Tell me about oranges', 'Explain the benefits of bananas.']
-        }}
-      ],
-      {{'task_description': 'Classify the query as recipe, ingredients, or ingredients_by_name based on whether the user asks about preparing a dish, general food properties, or specific ingredient details.'}}
-    );
+
+def cache_namespace(name):
+    # Keeps offline results out of the disk cache shared with the Snowflake backend
+    return name if BACKEND == "snowflake" else f"{BACKEND}:{name}"
+
+
+@st.cache_resource
+def get_classification_cache():
+    """
+    Process-wide classification cache shared by every session, backed by SQLite when CACHE_DB_PATH is set.
     """
+    disk = None
+    if CACHE_DB_PATH:
+        disk = SQLiteCache(CACHE_DB_PATH, cache_namespace("classification"), maxsize=CLASSIFICATION_CACHE_SIZE * 10, ttl=CLASSIFICATION_CACHE_TTL)
+    return TieredCache(TTLCache(maxsize=CLASSIFICATION_CACHE_SIZE, ttl=CLASSIFICATION_CACHE_TTL), disk)
+
 
+def invalidate_classification_cache():
+    get_classification_cache().clear()
+
+
+def classify_prompt(query):
+    # Cached labels are keyed on the classifier version so editing CLASSIFY_EXPR or KEYWORD_RULES invalidates them
+    cache = get_classification_cache()
+    key = make_key(CLASSIFIER_VERSION, normalize_query(query))
+    label = cache.get(key)
+    if label is not None:
+        mark_cache("hit")
+        return label
+
+    label = keyword_classify(query)
+    mark_cache("keyword" if label else "miss")
+    if label is None:
+        label = cortex_classify(query)
+    if label:
+        cache.set(key, label)
+    return label
+
+
+def cortex_classify(query):
     # Execute the SQL command
     try:
-        result = session.sql(cmd).collect()
-        
-        # Ensure the result is not empty
-        if result and result[0]:
-            # Parse the JSON string from the result
-            data = json.loads(result[0][0])  # Assuming the result is in the first row and column
-            label = data.get("label")
-            # if label=='ingredients' or label=='ingredients_by_name':
-            #     st.session_state.json_data = None
-            return label
-        else:
-            return None  # No classification result
+        return get_backend().classify(query)
     except Exception as e:
         print(f"Error during classification: {e}")
         return None
 
 
 
-def get_similar_chunks_search_service(query, classification):
+def fetch_nutrition_table():
+    return get_backend().fetch_table(NUTRITION_TABLE, TABLE2_COLUMNS)
+
+
+@st.cache_resource(ttl=NUTRITION_SNAPSHOT_MAX_AGE)
+def get_nutrition_snapshot():
+    """
+    Process-wide snapshot of the nutrition table, reloaded from Parquet (or Snowflake once the
+    file is stale) every NUTRITION_SNAPSHOT_MAX_AGE seconds.
+    """
+    return NutritionSnapshot.load(NUTRITION_SNAPSHOT_PATH, TABLE2_COLUMNS, fetch_nutrition_table, NUTRITION_SNAPSHOT_MAX_AGE)
+
+
+def refresh_nutrition_snapshot():
+    if os.path.exists(NUTRITION_SNAPSHOT_PATH):
+        os.remove(NUTRITION_SNAPSHOT_PATH)
+    get_nutrition_snapshot.clear()
+
+
+def local_nutrition_search(query, classification, limit):
+    """
+    Answers exact-name lookups and nutrient filters from the local snapshot.
+    Returns None when the snapshot is disabled, unavailable or the query needs semantic search.
+    """
+    if not LOCAL_NUTRITION_SNAPSHOT or classification not in ("ingredients", "ingredients_by_name"):
+        return None
+    try:
+        snapshot = get_nutrition_snapshot()
+    except Exception as e:
+        print(f"Nutrition snapshot unavailable: {e}")
+        return None
+    return snapshot.answer(query, classification, limit)
+
+
+@st.cache_resource
+def get_search_cache():
+    """
+    Process-wide cache of parsed Cortex Search responses shared by every session.
+    """
+    disk = None
+    if CACHE_DB_PATH:
+        disk = SQLiteCache(CACHE_DB_PATH, cache_namespace("search"), maxsize=SEARCH_CACHE_SIZE * 10, ttl=SEARCH_CACHE_TTL)
+    return TieredCache(TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL), disk)
+
+
+def get_similar_chunks_search_service(query, classification, limit=NUM_CHUNKS, search_filter=None):
+    """
+    Searches the service matching the classification and returns the parsed response,
+    served from the shared search cache when the same search ran within SEARCH_CACHE_TTL.
+    search_filter is passed to Cortex Search as its attribute filter.
+    """
     if classification == "recipe":
-        service = svcR
+        service_name = RECIPE_SEARCH_SERVICE
         query_columns = COLUMNS
     elif classification == "ingredients":
-        service = svcI
+        service_name = INGREDIENT_SEARCH_SERVICE
         query_columns = TABLE2_COLUMNS
     elif classification == "ingredients_by_name":
-        service = svcI_N
+        service_name = INGREDIENT_BY_NAME_SEARCH_SERVICE
         query_columns = TABLE2_COLUMNS
     else:
         return {}
 
-    response = service.search(query, query_columns, limit=NUM_CHUNKS)
+    if search_filter is None:
+        results = local_nutrition_search(query, classification, limit)
+        if results is not None:
+            mark_cache("snapshot")
+            return results
 
-    
-    #st.sidebar.json(response.model_dump_json())
-    return response.model_dump_json()
+    cache = get_search_cache()
+    # Service names are all "" on the local backend, so the classification tells the searches apart
+    key = make_key(CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, service_name, classification, normalize_query(query),
+                   query_columns, limit, search_filter)
+    results = cache.get(key)
+    if results is not None:
+        mark_cache("prefetch" if get_prefetcher().claim(prefetch_key(query, classification, limit)) else "hit")
+        return results
+    mark_cache("miss")
+
+    results = get_backend().search(classification, query, query_columns, limit, search_filter)
+    cache.set(key, results)
+
+    #st.sidebar.json(results)
+    return results
+
+
+def retrieve_recipes(query, limit=NUM_CHUNKS):
+    """
+    Hybrid recipe retrieval. The diet, cuisine and time limit read from the question filter the
+    search when the service supports it, and a wider candidate set is reranked locally so that
+    recipes meeting every constraint and matching the question's words come first.
+    """
+    constraints = extract_constraints(query)
+    candidates = limit * RECIPE_CANDIDATES
+    search_filter = constraint_filter(constraints) if RECIPE_SEARCH_FILTERS else None
+    response = get_similar_chunks_search_service(query, "recipe", candidates, search_filter)
+    results = response.get("results", [])
+    if search_filter and len(results) < limit:
+        # Too few recipes meet every filter; unfiltered ones fill the gap and rank after them
+        results = results + get_similar_chunks_search_service(query, "recipe", candidates).get("results", [])
+    span = current_span()
+    if span is not None:
+        span.set("constraints", ", ".join(f"{k}={v}" for k, v in asdict(constraints).items() if v))
+        span.set("candidates", len(results))
+    return {**response, "results": rerank(results, query, constraints, limit)}
 
 
 def get_chat_history():
+    """
+    Returns the conversation before the current question as text: the rolling summary of the
+    folded exchanges plus the messages of the window not folded into it yet, within HISTORY_TOKEN_BUDGET.
+    """
+    collect_summary_update()
+    summary = st.session_state.get("conversation_summary", "")
+
     chat_history = []
-    start_index = max(0, len(st.session_state.messages) - SLIDE_WINDOW)
+    start_index = max(st.session_state.get("summarized_upto", 0), len(st.session_state.messages) - SLIDE_WINDOW)
     for i in range(start_index, len(st.session_state.messages) - 1):
         chat_history.append(st.session_state.messages[i])
-    return chat_history
 
-def summarize_question_with_history(chat_history, question):
+    summary_text = f"Summary of the earlier conversation: {summary}" if summary else ""
+    recent_text = format_chat_history(chat_history, HISTORY_TOKEN_BUDGET - estimate_tokens(summary_text))
+    return "\n".join(filter(None, [summary_text, recent_text]))
+
+
+def fold_into_summary(summary, exchange, model_name):
+    """
+    Folds one question/answer exchange into the rolling conversation summary.
+    """
     prompt = f"""
+        Update the summary of a conversation between a user and a nutrition and recipe assistant
+        with the new exchange below. Keep the dishes, ingredients, diets and preferences the user
+        mentioned. Answer with only the updated summary, in at most {SUMMARY_MAX_WORDS} words.
+
+        <summary>
+        {summary}
+        </summary>
+        <new_exchange>
+        {format_chat_history(exchange, HISTORY_TOKEN_BUDGET)}
+        </new_exchange>
+    """
+    return (routed_complete("summary", prompt, model_name) or summary).strip()
+
+
+def schedule_summary_update():
+    """
+    Starts folding the messages added since the last update into the summary in the background,
+    so a later turn only has to pick up the result. The job runs in a copy of the caller's context,
+    keeping the turn's trace and admission user.
+    """
+    upto = len(st.session_state.messages)
+    exchange = st.session_state.messages[st.session_state.get("summarized_upto", 0):upto]
+    if not st.session_state.use_chat_history or not exchange:
+        return
+    future = get_cortex_executor().submit(
+        contextvars.copy_context().run,
+        fold_into_summary, st.session_state.get("conversation_summary", ""), exchange, route("summary"),
+    )
+    st.session_state.summary_job = (future, upto)
+
+
+def collect_summary_update():
+    """
+    Applies the background summary update if it has finished, without waiting for it. Otherwise the
+    unfolded messages are sent as they are and the update is picked up on a later turn.
+    """
+    job = st.session_state.get("summary_job")
+    if job is None:
+        return
+    future, upto = job
+    if not future.done():
+        return
+    try:
+        st.session_state.conversation_summary = future.result()
+        st.session_state.summarized_upto = upto
+        st.session_state.summary_job = None
+    except Exception as e:
+        print(f"Error updating conversation summary: {e}")
+        st.session_state.summary_job = None
+
+
+def is_self_contained(question):
+    """
+    Heuristic for questions that can be searched without the chat history: long enough and free
+    of words that refer back to earlier messages.
+    """
+    words = normalize_query(question).split()
+    return len(words) >= 4 and not FOLLOW_UP_WORDS.intersection(words)
+
+def history_summary_prompt(chat_history, question):
+    return f"""
         Based on the chat history below and the question, generate a query that extends the question
         with the chat history provided. The query should be in natural language.
         Answer with only the query. Do not add any explanation.
@@ -383,11 +1201,9 @@ def summarize_question_with_history(chat_history, question):
         </question>
     """
 
-    cmd = """
-            SELECT snowflake.cortex.complete(?, ?) AS response
-          """
-    df_response = session.sql(cmd, params=[st.session_state.model_name, prompt]).collect()
-    summary = df_response[0].RESPONSE
+
+def summarize_question_with_history(chat_history, question):
+    summary = routed_complete("rewrite", history_summary_prompt(chat_history, question), route("rewrite", question))
 
     # if st.session_state.debug:
     #     st.sidebar.text("Summary used to find similar chunks in the docs:")
@@ -396,37 +1212,121 @@ def summarize_question_with_history(chat_history, question):
     return summary.replace("'", "")
 
 
-def create_prompt(myquestion):
-    classification = classify_prompt(myquestion)
-    #st.success(f"Prompt classified as:{classification}")
-    if not classification:
-        return "Unable to classify the query.", {}
+def classify_and_summarize(chat_history, question):
+    """
+    Classifies the question and condenses it with the chat history. When the label isn't cached
+    both run in a single SQL statement, so the turn pays one round trip instead of two.
+    """
+    cache = get_classification_cache()
+    key = make_key(CLASSIFIER_VERSION, normalize_query(question))
+    label = cache.get(key) or keyword_classify(question)
+    if label is not None or not BATCH_COMPLETE:
+        # classify_prompt is served from the cache or keyword rules when the label is already known
+        label = classify_prompt(question)
+        return label, summarize_question_with_history(chat_history, question) if label else question
+
+    mark_cache("miss")
+    try:
+        label, summary = get_backend().classify_and_complete(
+            question, route("rewrite", question), history_summary_prompt(chat_history, question)
+        )
+        summary = summary.replace("'", "")
+    except Exception as e:
+        print(f"Error during batched classification: {e}")
+        label = classify_prompt(question)
+        return label, summarize_question_with_history(chat_history, question) if label else question
+
+    if label:
+        cache.set(key, label)
+    return label, summary
 
+
+def build_turn_context(question):
+    """
+    Classifies the question, condenses it with the chat history and runs the similarity search
+    exactly once per turn. The returned TurnContext is shared by every later step of the turn.
+    """
+    chat_history = ""
+    search_query = question
     if st.session_state.use_chat_history:
         chat_history = get_chat_history()
-        if chat_history:
-            question_summary = summarize_question_with_history(chat_history, myquestion)
-            prompt_context = get_similar_chunks_search_service(question_summary, classification)
+
+    with timed("classify"):
+        if chat_history and not is_self_contained(question):
+            classification, search_query = classify_and_summarize(chat_history, question)
         else:
-            prompt_context = get_similar_chunks_search_service(myquestion, classification)
-    else:
-        prompt_context = get_similar_chunks_search_service(myquestion, classification)
-        chat_history = ""
+            classification = classify_prompt(question)
+
+    search_results = {}
+    if classification:
+        with timed("search"):
+            if classification == "recipe":
+                search_results = retrieve_recipes(search_query)
+            else:
+                search_results = get_similar_chunks_search_service(search_query, classification)
+
+    return TurnContext(
+        question=question,
+        classification=classification,
+        chat_history=chat_history,
+        search_query=search_query,
+        search_results=search_results,
+    )
+
+
+def build_context(turn):
+    """
+    Renders the search results of the turn for the prompt within CONTEXT_TOKEN_BUDGET. Ingredient
+    results become a compact nutrient table (a side-by-side comparison when the question compares
+    items) and recipes keep only the fields worth answering from, instead of the raw JSON.
+    """
+    rows = turn.search_results.get("results", [])
+    if turn.classification in ("ingredients", "ingredients_by_name") and rows:
+        snapshot = None
+        if LOCAL_NUTRITION_SNAPSHOT:
+            try:
+                snapshot = get_nutrition_snapshot()
+            except Exception as e:
+                print(f"Nutrition snapshot unavailable: {e}")
+        compared = compared_rows(turn.question, rows)
+        if compared:
+            return truncate_lines_to_tokens(comparison_context(compared, TABLE2_COLUMNS, snapshot), CONTEXT_TOKEN_BUDGET)
+        return truncate_lines_to_tokens(ranking_context(rows, TABLE2_COLUMNS, turn.question), CONTEXT_TOKEN_BUDGET)
+    if turn.classification == "recipe" and rows:
+        return recipe_context(rows, CONTEXT_TOKEN_BUDGET)
+    return json.dumps(turn.search_results)
+
+
+def turn_results(turn):
+    """
+    The search results of the turn keyed by recipe or ingredient name, or None for an unknown classification.
+    """
+    json_data = turn.search_results
+    if not json_data:
+        return {}
+    if turn.classification == "recipe":
+        return {item["TRANSLATEDRECIPENAME"]: item["TRANSLATEDINSTRUCTIONS"] for item in json_data["results"]}
+    if turn.classification in ("ingredients", "ingredients_by_name"):
+        return {item["NAME"]: {k: item[k] for k in TABLE2_COLUMNS if k in item} for item in json_data["results"]}
+    return None
+
+
+def create_prompt(turn, extra_history=None):
+    if not turn.classification:
+        return "Unable to classify the query.", {}
 
-    if not prompt_context:
+    if not turn.search_results:
         return "No relevant context found.", {}
 
-    # Parse context based on classification
-    json_data = json.loads(prompt_context)
-    if classification == "recipe":
-        results = {item["TRANSLATEDRECIPENAME"]: item["TRANSLATEDINSTRUCTIONS"] for item in json_data["results"]}
-    elif classification == "ingredients":
-            results = {item["NAME"]: {k: item[k] for k in TABLE2_COLUMNS if k in item} for item in json_data["results"]}
-    elif classification == "ingredients_by_name":
-            results = {item["NAME"]: {k: item[k] for k in TABLE2_COLUMNS if k in item} for item in json_data["results"]}
-    else:
+    results = turn_results(turn)
+    if results is None:
         return "Unknown classification.", {}
 
+    chat_history = turn.chat_history
+    if extra_history:
+        chat_history = "\n".join(filter(None, [chat_history, format_chat_history(extra_history, HISTORY_TOKEN_BUDGET)]))
+    context = build_context(turn)
+
     prompt = f"""
            You are an expert assistant that extracts information from the CONTEXT provided
            between <context> and </context> tags.
@@ -442,113 +1342,247 @@ def create_prompt(myquestion):
            {chat_history}
            </chat_history>
            <context>
-           {prompt_context}
+           {context}
            </context>
            <question>
-           {myquestion}
+           {turn.question}
            </question>
            Answer:
     """
 
+    st.session_state.prompt_tokens = {
+        "history": estimate_tokens(chat_history),
+        "context": estimate_tokens(context),
+        "total": estimate_tokens(prompt),
+    }
     return prompt, results
 
-def fetch_and_complete(myquestion):
-    prompt, results = create_prompt(myquestion)
-
-    if "ingredients_by_name" in myquestion.lower():
-        ingredients = results.keys()
-        chat_history = []
-        for ingredient in ingredients:
-            # Fetch details for each ingredient
-            ingredient_prompt = f"Can you tell me about {ingredient}?"
-            cmd = """
-                SELECT snowflake.cortex.complete(?, ?) AS response
-            """
-            response = session.sql(
-                cmd, params=[st.session_state.model_name, ingredient_prompt]
-            ).collect()
-            ingredient_details = response[0]["RESPONSE"] if response else "No details found."
-            chat_history.append({"role": "user", "content": ingredient_prompt})
-            chat_history.append({"role": "assistant", "content": ingredient_details})
+def fetch_and_complete(turn, message_placeholder=None):
+    """
+    Answers an ingredients_by_name question. With INGREDIENT_DETAILS the details of every matched
+    ingredient are added to the chat history the final prompt is built with.
+    """
+    ingredient_history = []
+    if INGREDIENT_DETAILS:
+        ingredient_history = fetch_ingredient_history(list(turn_results(turn) or {}))
 
     # Use the original question with full chat context
-    cmd = """
-        SELECT snowflake.cortex.complete(?, ?) AS response
+    prompt, results = create_prompt(turn, extra_history=ingredient_history)
+    res_text, turn.answer_model = generate_answer(prompt, turn.answer_model or route("answer", turn.question), message_placeholder)
+    return res_text, results
+
+
+def fetch_ingredient_history(ingredients):
     """
-    df_response = session.sql(cmd, params=[st.session_state.model_name, prompt]).collect()
-    res_text = df_response[0]["RESPONSE"] if df_response else "No response received."
+    Asks the model about each ingredient, returning the questions and answers as chat messages.
+    """
+    model_name = route("details")
+    details = None
+    if BATCH_COMPLETE:
+        try:
+            details = cortex_complete_batch([f"Can you tell me about {ingredient}?" for ingredient in ingredients], model_name)
+            details = [detail or f"No details found for {ingredient}." for ingredient, detail in zip(ingredients, details)]
+        except Exception as e:
+            print(f"Batched completion failed, fanning out instead: {e}")
+
+    if details is None:
+        # Fetch details for all ingredients in parallel; worker threads can't read session_state
+        details = fan_out(
+            get_cortex_executor(),
+            lambda ingredient: fetch_ingredient_details(ingredient, model_name),
+            ingredients,
+            timeout=CORTEX_CALL_TIMEOUT,
+            default=lambda ingredient: f"No details found for {ingredient}.",
+        )
+
+    ingredient_history = []
+    for ingredient, ingredient_details in zip(ingredients, details):
+        ingredient_history.append({"role": "user", "content": f"Can you tell me about {ingredient}?"})
+        ingredient_history.append({"role": "assistant", "content": ingredient_details})
+    return ingredient_history
+
+
+def generate_answer(prompt, model_name, message_placeholder=None):
+    """
+    Answers prompt, streamed into the placeholder when one is given. Returns (answer, model used),
+    which is a smaller model than model_name when the router had to fall back.
+    """
+    if message_placeholder is not None:
+        res_text = complete_into(message_placeholder, prompt, model_name)
+        return res_text, st.session_state.completion_metrics["model"]
+    res_text, model_used = get_router().call("answer", model_name, partial(cortex_complete, prompt))
+    return res_text or "No response received.", model_used
 
-    return res_text, results
 
-def complete(myquestion):
-    if st.session_state.classification == "ingredients_by_name":
-        prompt,recipes = fetch_and_complete(myquestion)
-    else:
-        prompt, recipes = create_prompt(myquestion)
-    cmd = """
-            SELECT snowflake.cortex.complete(?, ?) AS response
-          """
-    df_response = session.sql(cmd, params=[st.session_state.model_name, prompt]).collect()
-    
-    # Extract the response text
-    res_text = df_response[0]['RESPONSE'] if df_response else "No response received."
-    return res_text, recipes
-
-def create_prompt(myquestion):
-    classification = classify_prompt(myquestion)
-    #st.success(f"Prompt classified as:{classification}")
-    if not classification:
-        return "Unable to classify the query.", {}
+@st.cache_resource
+def get_answer_cache():
+    """
+    Process-wide exact answer cache shared by every session, backed by SQLite when CACHE_DB_PATH is set.
+    """
+    disk = None
+    if CACHE_DB_PATH:
+        disk = SQLiteCache(CACHE_DB_PATH, cache_namespace("answers"), maxsize=ANSWER_CACHE_SIZE * 10, ttl=ANSWER_CACHE_TTL)
+    return TieredCache(TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL), disk)
 
-    if st.session_state.use_chat_history:
-        chat_history = get_chat_history()
-        if chat_history:
-            question_summary = summarize_question_with_history(chat_history, myquestion)
-            prompt_context = get_similar_chunks_search_service(question_summary, classification)
-        else:
-            prompt_context = get_similar_chunks_search_service(myquestion, classification)
-    else:
-        prompt_context = get_similar_chunks_search_service(myquestion, classification)
-        chat_history = ""
 
-    if not prompt_context:
-        return "No relevant context found.", {}
+@st.cache_resource
+def get_answer_index():
+    """
+    Process-wide vector index of answered questions, the semantic tier of the answer cache.
+    """
+    return VectorIndex(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
 
-    # Parse context based on classification
-    json_data = json.loads(prompt_context)
-    if classification == "recipe":
-        results = {item["TRANSLATEDRECIPENAME"]: item["TRANSLATEDINSTRUCTIONS"] for item in json_data["results"]}
-    elif classification == "ingredients":
-            results = {item["NAME"]: {k: item[k] for k in TABLE2_COLUMNS if k in item} for item in json_data["results"]}
-    elif classification == "ingredients_by_name":
-            results = {item["NAME"]: {k: item[k] for k in TABLE2_COLUMNS if k in item} for item in json_data["results"]}
-    else:
-        return "Unknown classification.", {}
 
-    prompt = f"""
-           You are an expert assistant that extracts information from the CONTEXT provided
-           between <context> and </context> tags.
-           You offer a chat experience considering the information included in the CHAT HISTORY
-           provided between <chat_history> and </chat_history> tags.
-           When answering the question contained between <question> and </question> tags,
-           be concise and do not hallucinate.
-           If you don’t have the information, just say so.
+def clear_answer_cache():
+    get_answer_cache().clear()
+    get_answer_index().clear()
 
-           Do not mention the CONTEXT or CHAT HISTORY used in your answer.
 
-           <chat_history>
-           {chat_history}
-           </chat_history>
-           <context>
-           {prompt_context}
-           </context>
-           <question>
-           {myquestion}
-           </question>
-           Answer:
+def embed_text(text):
+    return get_backend().embed(text, EMBED_MODEL)
+
+
+def history_changes_query(turn):
+    """
+    True when condensing with the chat history turned the question into a materially different query.
     """
+    question_words = set(normalize_query(turn.question).split())
+    query_words = set(normalize_query(turn.search_query).split())
+    union = question_words | query_words
+    return bool(union) and len(question_words & query_words) / len(union) < HISTORY_REWRITE_OVERLAP
+
+
+def answer_cache_entry(turn):
+    """
+    Returns (key, scope) of the turn's answer, or None when the answer mustn't be cached.
+    The scope (model, classification, search results) must match for a semantic hit. The model is
+    turn.answer_model: the routed one on lookup and the one that answered on store.
+    """
+    if not turn.classification or not turn.search_results.get("results") or history_changes_query(turn):
+        return None
+    scope = make_key(turn.answer_model, turn.classification, turn.search_results["results"])
+    return make_key(scope, normalize_query(turn.search_query)), scope
+
+
+def lookup_answer(turn):
+    """
+    Returns (answer, tier) from the answer cache, or (None, None) on a miss.
+    """
+    entry = answer_cache_entry(turn)
+    if entry is None:
+        return None, None
+    key, scope = entry
+    answer = get_answer_cache().get(key)
+    if answer is not None:
+        return answer, "exact"
+    if SEMANTIC_ANSWER_CACHE:
+        try:
+            turn.embedding = embed_text(turn.search_query)
+        except Exception as e:
+            print(f"Error embedding question: {e}")
+            return None, None
+        match = get_answer_index().search(turn.embedding, SEMANTIC_SIMILARITY, lambda payload: payload["scope"] == scope)
+        if match is not None:
+            return match[0]["answer"], "semantic"
+    return None, None
+
+
+def store_answer(turn, answer):
+    entry = answer_cache_entry(turn)
+    if entry is None:
+        return
+    key, scope = entry
+    get_answer_cache().set(key, answer)
+    if SEMANTIC_ANSWER_CACHE and turn.embedding is not None:
+        get_answer_index().add(key, turn.embedding, {"scope": scope, "answer": answer})
+
+
+def complete(turn, message_placeholder=None):
+    """
+    Answers the question of the turn. When a placeholder is given the answer is streamed into it.
+    Answers are served from, and added to, the answer cache.
+    """
+    turn.answer_model = route("answer", turn.question)
+    with get_tracer().span("answer_cache") as span:
+        res_text, tier = lookup_answer(turn)
+        span.set("cache", tier or "miss")
+    if res_text is not None:
+        results = turn_results(turn) or {}
+        st.session_state.completion_metrics = {
+            "model": turn.answer_model,
+            "streamed": False,
+            "cache": tier,
+            "time_to_first_token": 0.0,
+            "total_time": 0.0,
+        }
+        if message_placeholder is not None:
+            message_placeholder.markdown(res_text)
+        return res_text, results
+
+    if turn.classification == "ingredients_by_name":
+        res_text, results = fetch_and_complete(turn, message_placeholder)
+    else:
+        prompt, results = create_prompt(turn)
+        res_text, turn.answer_model = generate_answer(prompt, turn.answer_model, message_placeholder)
+
+    if results and res_text != "No response received.":
+        store_answer(turn, res_text)
+    return res_text, results
 
-    return prompt, results
+
+def show_completion_metrics():
+    metrics = st.session_state.get("completion_metrics")
+    if st.session_state.debug and metrics:
+        if metrics.get("cache"):
+            source = f"{metrics['cache']} cache hit"
+        else:
+            source = "streamed" if metrics["streamed"] else "SQL"
+        st.sidebar.caption(
+            f"{metrics['model']}: first token after {metrics['time_to_first_token']:.2f}s, "
+            f"total {metrics['total_time']:.2f}s ({source})"
+        )
+    tokens = st.session_state.get("prompt_tokens")
+    if st.session_state.debug and tokens:
+        st.sidebar.caption(
+            f"Prompt: ~{tokens['total']} tokens ({tokens['context']} context, {tokens['history']} history)"
+        )
+
+
+def show_turn_trace():
+    """
+    Draws the spans of the last turn as a waterfall in the debug sidebar.
+    """
+    trace_id = st.session_state.get("trace_id")
+    if not (st.session_state.debug and TRACE_WATERFALL and trace_id):
+        return
+    spans = get_tracer().spans(trace_id)
+    if not spans:
+        return
+    origin = min(span.start for span in spans)
+    depth = {}
+    for span in sorted(spans, key=lambda span: span.start):
+        depth[span.span_id] = depth.get(span.parent_id, -1) + 1 if span.parent_id else 0
+    rows = [
+        {
+            "span": "  " * depth[span.span_id] + span.name,
+            "start_ms": (span.start - origin) * 1000,
+            "end_ms": (span.end - origin) * 1000,
+            "ms": round(span.duration * 1000, 1),
+            "detail": span.error or ", ".join(f"{k}={v}" for k, v in span.attributes.items() if k != "backend"),
+        }
+        for span in sorted(spans, key=lambda span: span.start)
+    ]
+    with st.sidebar.expander("Turn trace"):
+        st.vega_lite_chart(rows, {
+            "mark": {"type": "bar"},
+            "encoding": {
+                "y": {"field": "span", "type": "nominal", "sort": None, "title": None},
+                "x": {"field": "start_ms", "type": "quantitative", "title": "ms"},
+                "x2": {"field": "end_ms"},
+                "color": {"value": "#e4572e"},
+                "tooltip": [{"field": "span"}, {"field": "ms"}, {"field": "detail"}],
+            },
+        }, width="stretch")
 
 
 def main():
@@ -558,18 +1592,25 @@ def main():
     config_options()
     init_messages()
 
-    # Render previous chat messages
-    for message in st.session_state.get("messages", []):
+    # Render previous chat messages; older ones are read back from disk only on request
+    messages = st.session_state.messages
+    earlier = max(0, len(messages) - SESSION_MESSAGES_IN_MEMORY)
+    if earlier and st.toggle(f"Show {earlier} earlier messages", key="show_earlier_messages"):
+        earlier = 0
+    for message in messages[earlier:]:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
     # Input for new questions
-    question = st.chat_input("Enter your question about recipes and cuisines")
-    
+    question = st.chat_input("Enter your question about recipes and cuisines") or st.session_state.pop("suggested_question", None)
 
     if question:
+        if PREFETCH:
+            # Speculative work of the last turn that this question doesn't need is cancelled right away
+            get_prefetcher().release(session_user(), keep={
+                prefetch_key(question, "ingredients_by_name"), *st.session_state.get("export_keys", {}).values()
+            })
         st.session_state.messages.append({"role": "user", "content": question})
-        st.session_state.classification = classify_prompt(question)
         with st.chat_message("user"):
             st.markdown(question)
 
@@ -578,69 +1619,39 @@ def main():
 
             question = question.replace("'", "")
 
-            with st.spinner(f"{st.session_state.model_name} thinking..."):
-                res_text, recipes = complete(question)
-                fetch_and_store_json_data(question)
-                message_placeholder.markdown(res_text)
-
-        st.session_state.messages.append({"role": "assistant", "content": res_text})
-        st.session_state.latest_response = res_text
-
-        
-
-    # Display buttons to generate files
-    if "json_data" in st.session_state and st.session_state.json_data and st.session_state.classification=="recipe":
-        # Generate Shopping List
-        if st.button(
-            label="Generate Shopping List as PDF",
-            icon=":material/shopping_bag:"):
-            generate_shopping_list(st.session_state.json_data)
-            st.session_state.shopping_list_ready = True
-            #st.success("Shopping list PDF generated successfully!")
-
-            # Show download button for Shopping List
-            if st.session_state.get("shopping_list_ready"):
-                st.download_button(
-                    icon=":material/download:",
-                    label="Download Shopping List as PDF",
-                    data=st.session_state.shopping_list_pdf_data,
-                    file_name="shopping_list.pdf",
-                    mime="application/pdf"
-                )
-
-        # Generate Meal Plan CSV
-        if st.button(label="Generate Meal Plan as CSV",icon=":material/ramen_dining:"):
-            download_csv(st.session_state.json_data)
-            st.session_state.meal_plan_ready = True
-            #st.success("Meal plan CSV generated successfully!")
-
-            # Show download button for Meal Plan
-            if st.session_state.get("meal_plan_ready"):
-                st.download_button(
-                    icon=":material/download:",
-                    label="Download Meal Plan as CSV",
-                    data=st.session_state.csv_data,
-                    file_name="mealplan.csv",
-                    mime="text/csv"
-                )
-
-    # Generate Full Response PDF
-    if (st.session_state.get("latest_response") is not None):
-        if st.button(label="Generate Full Response as PDF",icon=":material/picture_as_pdf:"):
-            download_response_as_pdf(st.session_state.latest_response)
-            st.session_state.response_pdf_ready = True
-            #st.success("Response PDF generated successfully!")
-
-            # Show download button for Full Response
-            if st.session_state.get("response_pdf_ready"):
-                st.download_button(
-                    icon=":material/download:",
-                    label="Download Full Response as PDF",
-                    data=st.session_state.pdf_data,
-                    file_name="recipes.pdf",
-                    mime="application/pdf"
-                )
+            # Per-turn measurements, read by the debug sidebar and benchmark.py
+            st.session_state.turn_timings = {}
+            st.session_state.prompt_tokens = None
+            calls_before = backend_calls()
+            with st.spinner(f"{st.session_state.model_name} thinking..."), get_tracer().trace() as trace_id, timed("turn"):
+                st.session_state.trace_id = trace_id
+                turn = build_turn_context(question)
+                st.session_state.classification = turn.classification
+                with timed("store"):
+                    fetch_and_store_json_data(turn)
+                if PREFETCH:
+                    with timed("prefetch"):
+                        prefetch(turn)
+                with timed("complete"):
+                    res_text, recipes = complete(turn, message_placeholder)
+                st.session_state.messages.append({"role": "assistant", "content": res_text})
+                # Scheduled within the trace so the summary's calls show up in the turn's waterfall
+                schedule_summary_update()
+            st.session_state.turn_calls = backend_calls() - calls_before
+
+        st.session_state.messages.compact()
+        start_exports(res_text)
+
+    if PREFETCH:
+        show_follow_ups()
+    show_completion_metrics()
+    show_turn_trace()
+
+    show_exports()
+    show_startup_report()
+    report_session_memory()
 
 if __name__ == "__main__":
-    main()
+    with get_admission().user(session_user()):
+        main()
 
@@ -0,0 +1,363 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from caching import normalize_query
+
+
+def parse_sse(lines):
+    """
+    Yields the text chunks of a Cortex REST inference:complete event stream from its raw lines,
+    e.g. an HTTP response or recorded bytes. Raises RuntimeError on an error event.
+    """
+    event = "message"
+    for raw_line in lines:
+        line = raw_line.decode("utf-8").strip()
+        if not line:
+            # A blank line ends the event
+            event = "message"
+            continue
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+            continue
+        # Only "data:" lines carry payload; comments and ids are skipped
+        if not line.startswith("data:"):
+            continue
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            return
+        data = json.loads(payload)
+        if event == "error" or ("choices" not in data and "message" in data):
+            raise RuntimeError(f"Cortex stream error: {data.get('message', payload)}")
+        for choice in data.get("choices", []):
+            delta = choice.get("delta", {})
+            text = delta.get("content") or delta.get("text")
+            if text:
+                yield text
+
+
+def sse_lines(chunks, model_name):
+    """
+    Encodes text chunks as the event stream parse_sse() reads, line by line as bytes.
+    """
+    for chunk in chunks:
+        data = {"model": model_name, "choices": [{"delta": {"content": chunk}}]}
+        yield f"data: {json.dumps(data)}\n".encode("utf-8")
+        yield b"\n"
+    yield b"data: [DONE]\n"
+
+
+class SnowflakeBackend:
+    """
+    Runs classification, search, completion and embeddings on Snowflake Cortex through a SessionPool.
+    """
+
+    name = "snowflake"
+
+    def __init__(self, pool, classify_expr, rest_url, stream_timeout=120, batch_size=50):
+        self.pool = pool
+        self.classify_expr = classify_expr
+        self.rest_url = rest_url
+        self.stream_timeout = stream_timeout
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def classify(self, query):
+        self._call("classify")
+        with self.pool.connection() as conn:
+            result = conn.session.sql(f"SELECT {self.classify_expr};", params=[query]).collect()
+        if result and result[0]:
+            return json.loads(result[0][0]).get("label")
+        return None
+
+    def classify_and_complete(self, query, model_name, prompt):
+        """
+        Classifies query and completes prompt in a single statement. Returns (label, response).
+        """
+        cmd = f"""
+                SELECT {self.classify_expr} AS classification,
+                       snowflake.cortex.complete(?, ?) AS summary
+              """
+        self._call("classify_and_complete")
+        with self.pool.connection() as conn:
+            result = conn.session.sql(cmd, params=[query, model_name, prompt]).collect()
+        return json.loads(result[0]["CLASSIFICATION"]).get("label"), result[0]["SUMMARY"]
+
+    def search(self, service, query, columns, limit, search_filter=None):
+        """
+        Queries the Cortex Search service registered under `service` and returns the parsed response.
+        """
+        self._call("search")
+        with self.pool.connection() as conn:
+            if search_filter:
+                response = conn.services[service].search(query, columns, filter=search_filter, limit=limit)
+            else:
+                response = conn.services[service].search(query, columns, limit=limit)
+        return response.model_dump()
+
+    def complete(self, prompt, model_name):
+        cmd = """
+                SELECT snowflake.cortex.complete(?, ?) AS response
+              """
+        self._call("complete")
+        with self.pool.connection() as conn:
+            df_response = conn.session.sql(cmd, params=[model_name, prompt]).collect()
+        if df_response:
+            return df_response[0]["RESPONSE"]
+        return None
+
+    def complete_batch(self, prompts, model_name):
+        """
+        Completes many independent prompts with one SQL statement per batch_size prompts
+        and returns the responses in the order of the prompts.
+        """
+        responses = []
+        for offset in range(0, len(prompts), self.batch_size):
+            batch = prompts[offset:offset + self.batch_size]
+            rows = ", ".join(["(?, ?)"] * len(batch))
+            cmd = f"""
+                    SELECT idx, snowflake.cortex.complete(?, prompt) AS response
+                    FROM (SELECT column1 AS idx, column2 AS prompt FROM VALUES {rows})
+                    ORDER BY idx
+                  """
+            params = [model_name]
+            for idx, prompt in enumerate(batch):
+                params.extend([idx, prompt])
+            self._call("complete_batch")
+            with self.pool.connection() as conn:
+                df_response = conn.session.sql(cmd, params=params).collect()
+            by_idx = {row["IDX"]: row["RESPONSE"] for row in df_response}
+            responses.extend(by_idx.get(idx) for idx in range(len(batch)))
+        return responses
+
+    def stream(self, prompt, model_name):
+        """
+        Streams a completion from the Cortex REST API and yields the text chunks as they arrive.
+        """
+        self._call("stream")
+        with self.pool.connection() as conn:
+            token = conn.session.connection.rest.token
+        body = {
+            "model": model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True,
+        }
+        request = urllib.request.Request(
+            f"{self.rest_url}/api/v2/cortex/inference:complete",
+            data=json.dumps(body).encode("utf-8"),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "text/event-stream",
+                "Authorization": f'Snowflake Token="{token}"',
+            },
+        )
+        try:
+            response = urllib.request.urlopen(request, timeout=self.stream_timeout)
+        except urllib.error.HTTPError as e:
+            # The body says why, e.g. an expired session token or an unknown model
+            detail = e.read().decode("utf-8", "replace")
+            try:
+                detail = json.loads(detail).get("message", detail)
+            except ValueError:
+                pass
+            raise RuntimeError(f"Cortex REST API returned {e.code}: {detail}") from e
+        with response:
+            yield from parse_sse(response)
+
+    def embed(self, text, model_name):
+        cmd = """
+                SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768(?, ?) AS embedding
+              """
+        self._call("embed")
+        with self.pool.connection() as conn:
+            df_response = conn.session.sql(cmd, params=[model_name, text]).collect()
+        embedding = df_response[0]["EMBEDDING"]
+        return json.loads(embedding) if isinstance(embedding, str) else list(embedding)
+
+    def fetch_table(self, table, columns):
+        self._call("fetch_table")
+        with self.pool.connection() as conn:
+            return conn.session.table(table).select(columns).to_pandas()
+
+    def stats(self):
+        return {**self.pool.stats(), "calls": dict(self.calls)}
+
+
+# Words that make the local classifier pick a label, checked in this order
+LOCAL_CLASSIFY_RULES = [
+    ("recipe", re.compile(r"\b(recipes?|cook|cooking|make|bake|prepare|dish|dishes|meal|meals|breakfast|lunch|dinner|cuisine)\b")),
+    ("ingredients", re.compile(r"\b(high|rich|low|foods?|most|least|top|best|sources?|under|over|calories|protein|fat|vitamin|iron|calcium|fiber)\b")),
+]
+# Columns searched by each local stand-in for a Cortex Search service
+LOCAL_SEARCH_COLUMNS = {
+    "recipe": ("recipes", ["TRANSLATEDRECIPENAME", "CUISINE", "DIET", "TRANSLATEDINGREDIENTS", "COURSE"]),
+    "ingredients": ("nutrition", ["NAME", "CATEGORY"]),
+    "ingredients_by_name": ("nutrition", ["NAME"]),
+}
+EMBEDDING_DIMENSIONS = 768
+
+
+class LocalBackend:
+    """
+    Offline stand-in for SnowflakeBackend: BM25 search with SQLite FTS5 over the recipe and nutrition
+    fixtures in `fixtures_dir`, keyword classification, hashed bag-of-words embeddings and a
+    deterministic fake LLM. Every call sleeps `latency` seconds, and completions a further
+    `token_latency` seconds per generated word, to stand in for warehouse round trips under load.
+    """
+
+    name = "local"
+
+    def __init__(self, fixtures_dir, latency=0.0, token_latency=0.0):
+        import pandas as pd
+
+        self.latency = latency
+        self.token_latency = token_latency
+        self.tables = {
+            "recipes": pd.read_csv(os.path.join(fixtures_dir, "recipes.csv"), dtype=str).fillna(""),
+            "nutrition": pd.read_csv(os.path.join(fixtures_dir, "nutrition.csv"), dtype=str).fillna(""),
+        }
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        for service, (table, columns) in LOCAL_SEARCH_COLUMNS.items():
+            frame = self.tables[table]
+            columns = [column for column in columns if column in frame.columns]
+            self._conn.execute(f"CREATE VIRTUAL TABLE {service} USING fts5({', '.join(columns)})")
+            self._conn.executemany(
+                f"INSERT INTO {service} (rowid, {', '.join(columns)}) VALUES (?, {', '.join('?' * len(columns))})",
+                [(position, *row) for position, row in enumerate(frame[columns].itertuples(index=False))],
+            )
+        self._conn.commit()
+        self.calls = {}
+
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def classify(self, query):
+        self._call("classify")
+        text = normalize_query(query)
+        for label, pattern in LOCAL_CLASSIFY_RULES:
+            if pattern.search(text):
+                return label
+        return "ingredients_by_name"
+
+    def classify_and_complete(self, query, model_name, prompt):
+        return self.classify(query), self.complete(prompt, model_name)
+
+    def search(self, service, query, columns, limit, search_filter=None):
+        self._call("search")
+        table = LOCAL_SEARCH_COLUMNS[service][0]
+        frame = self.tables[table]
+        terms = normalize_query(query).split()
+        if not terms:
+            return {"results": [], "request_id": "local"}
+        match = " OR ".join(f'"{term}"' for term in terms)
+        with self._lock:
+            positions = [row[0] for row in self._conn.execute(
+                f"SELECT rowid FROM {service} WHERE {service} MATCH ? ORDER BY bm25({service})", (match,)
+            )]
+        # Semantic search always returns its nearest rows, so unmatched queries fall back to table order
+        matched = set(positions)
+        positions += [position for position in range(len(frame)) if position not in matched]
+        results = []
+        for position in positions:
+            record = frame.iloc[position]
+            if search_filter and not matches_filter(record, search_filter):
+                continue
+            results.append({column: record.get(column) for column in columns if column in frame.columns})
+            if len(results) >= limit:
+                break
+        return {"results": results, "request_id": "local"}
+
+    def _reply(self, prompt):
+        """
+        Deterministic answer shaped like what the calling prompt asks for.
+        """
+        def block(tag):
+            found = re.findall(rf"<{tag}>(.*?)</{tag}>", prompt, flags=re.S)
+            return re.sub(r"\s+", " ", found[-1]).strip() if found else None
+
+        context, question, exchange = block("context"), block("question"), block("new_exchange")
+        if context is not None:
+            return f"Offline answer to: {question}\n\n{context[:600]}"
+        if exchange is not None:
+            # Conversation summary updates
+            return " ".join(exchange.split()[:120])
+        if question is not None:
+            # Query rewrites with the chat history
+            return question
+        return prompt.strip().rsplit(":", 1)[-1].strip()
+
+    def complete(self, prompt, model_name):
+        return "".join(self.stream(prompt, model_name))
+
+    def complete_batch(self, prompts, model_name):
+        # One round trip for the whole batch, like the VALUES statement on Snowflake
+        self._call("complete_batch")
+        return ["".join(self._words(prompt)) for prompt in prompts]
+
+    def stream(self, prompt, model_name):
+        # Goes through the same event stream parser as the REST API
+        self._call("complete")
+        yield from parse_sse(sse_lines(self._words(prompt), model_name))
+
+    def _words(self, prompt):
+        for word in re.findall(r"\S+\s*", self._reply(prompt)):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield word
+
+    def embed(self, text, model_name):
+        """
+        Hashed bag of words, so questions sharing most of their words get similar vectors.
+        """
+        self._call("embed")
+        vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+        for word in normalize_query(text).split():
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % EMBEDDING_DIMENSIONS] += 1.0
+        return vector.tolist()
+
+    def fetch_table(self, table, columns):
+        self._call("fetch_table")
+        frame = self.tables["nutrition"]
+        return frame[[column for column in columns if column in frame.columns]].copy()
+
+    def stats(self):
+        return {"backend": self.name, "latency": self.latency, "calls": dict(self.calls)}
+
+
+def matches_filter(record, search_filter):
+    """
+    Evaluates a Cortex Search filter ({"@eq": ...}, "@and", "@or", "@not", "@gte", "@lte") on one row.
+    """
+    (op, operand), = search_filter.items()
+    if op == "@and":
+        return all(matches_filter(record, clause) for clause in operand)
+    if op == "@or":
+        return any(matches_filter(record, clause) for clause in operand)
+    if op == "@not":
+        return not matches_filter(record, operand)
+    (column, value), = operand.items()
+    actual = record.get(column)
+    if op == "@eq":
+        return str(actual).lower() == str(value).lower()
+    try:
+        actual = float(actual)
+    except (TypeError, ValueError):
+        return False
+    return actual >= value if op == "@gte" else actual <= value
@@ -0,0 +1,233 @@
+"""
+Headless benchmark of the chat turn pipeline.
+
+Replays the conversations in a corpus through app.py with Streamlit's AppTest against the local
+backend, first one session at a time to measure every stage, then with N concurrent sessions to
+measure throughput. Exits with status 1 when a metric regresses past --threshold of a baseline.
+
+AppTest swaps process-global runtime state on every run, so concurrent sessions run in separate
+processes. Process-wide caches are therefore not shared between them.
+
+    python benchmark.py --concurrency 1 4 8 --latency 0.05 --baseline benchmark_baseline.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import streamlit as st
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STAGES = ("turn", "classify", "search", "store", "prefetch", "complete")
+# Metrics where larger values are regressions; throughput regresses when it drops
+LOWER_IS_BETTER = ("latency", "calls_per_turn", "prompt_tokens")
+
+
+def load_corpus(path):
+    """
+    Reads conversations from a text file: one question per line, blank lines between conversations.
+    """
+    conversations, current = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#"):
+                continue
+            if not line:
+                if current:
+                    conversations.append(current)
+                current = []
+                continue
+            current.append(line)
+    if current:
+        conversations.append(current)
+    return conversations
+
+
+def use_local_backend(args):
+    """
+    Points every simulated session at the local backend. AppTest.secrets swaps st.secrets in and
+    out around each run, which races between concurrent sessions, so the secrets are set once here.
+    """
+    secrets = Secrets()
+    secrets._secrets = {
+        "BACKEND": "local",
+        "LOCAL_FIXTURES_DIR": os.path.join(ROOT, "fixtures"),
+        "LOCAL_LATENCY": args.latency,
+        "LOCAL_TOKEN_LATENCY": args.token_latency,
+    }
+    st.secrets = secrets
+
+
+def new_session(args):
+    app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=args.timeout)
+    app.run()
+    return app
+
+
+def replay(conversation, args):
+    """
+    Runs one conversation in a fresh session and returns a measurement per turn.
+    """
+    app = new_session(args)
+    turns = []
+    for question in conversation:
+        started_at = time.time()
+        start = time.perf_counter()
+        app.chat_input[0].set_value(question).run()
+        elapsed = time.perf_counter() - start
+        if app.exception:
+            raise RuntimeError(f"{question!r} raised {app.exception[0].value}")
+        state = app.session_state
+        tokens = state["prompt_tokens"] if "prompt_tokens" in state else None
+        turns.append({
+            "question": question,
+            "classification": state["classification"],
+            "elapsed": elapsed,
+            "started_at": started_at,
+            "timings": dict(state["turn_timings"]),
+            "calls": state["turn_calls"],
+            "prompt_tokens": tokens["total"] if tokens else None,
+        })
+    return turns
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def sequential_run(conversations, args):
+    """
+    One session at a time, so the backend call counters belong to a single turn.
+    """
+    st.cache_resource.clear()
+    turns = [turn for conversation in conversations for turn in replay(conversation, args)]
+    tokens = [turn["prompt_tokens"] for turn in turns if turn["prompt_tokens"] is not None]
+    return {
+        "turns": len(turns),
+        "latency": {stage: percentiles([turn["timings"][stage] for turn in turns if stage in turn["timings"]])
+                    for stage in STAGES},
+        "calls_per_turn": float(np.mean([turn["calls"] for turn in turns])),
+        "prompt_tokens": float(np.mean(tokens)) if tokens else 0.0,
+    }
+
+
+def replay_corpus(conversations, args):
+    # Forked workers inherit the parent's cached thread pools without their threads
+    st.cache_resource.clear()
+    use_local_backend(args)
+    return [turn for conversation in conversations for turn in replay(conversation, args)]
+
+
+def concurrent_run(conversations, concurrency, args):
+    """
+    `concurrency` sessions each replay the whole corpus at the same time. Throughput is measured from
+    the first turn to the end of the last one, leaving out process start-up.
+    """
+    # AppTest runs app.py as __main__, so workers have to find replay_corpus under this module's name
+    import benchmark
+
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(benchmark.replay_corpus, conversations, args) for _ in range(concurrency)]
+        results = [turn for future in futures for turn in future.result()]
+    wall = max(turn["started_at"] + turn["elapsed"] for turn in results) - min(turn["started_at"] for turn in results)
+    return {
+        "sessions": concurrency,
+        "turns": len(results),
+        "throughput": len(results) / wall,
+        "latency": {"turn": percentiles([turn["elapsed"] for turn in results])},
+    }
+
+
+def flatten(report):
+    """
+    Maps a report to {"sequential.latency.search.p95": value, ...} for the regression check.
+    """
+    flat = {}
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                walk(f"{prefix}.{key}" if prefix else str(key), item)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix] = float(value)
+
+    walk("", report)
+    return flat
+
+
+def regressions(report, baseline, threshold):
+    """
+    Returns a message for every metric that is worse than the baseline by more than `threshold`.
+    """
+    current = flatten(report)
+    messages = []
+    for name, expected in flatten(baseline).items():
+        if name not in current or name.endswith(".turns") or name.endswith(".sessions"):
+            continue
+        actual = current[name]
+        if any(part in name for part in LOWER_IS_BETTER):
+            # Sub-millisecond stages jitter too much for a relative check
+            if actual > expected * (1 + threshold) and actual - expected > 0.001:
+                messages.append(f"{name}: {actual:.4f} > {expected:.4f}")
+        elif name.endswith("throughput") and actual < expected * (1 - threshold):
+            messages.append(f"{name}: {actual:.2f} < {expected:.2f}")
+    return messages
+
+
+def print_report(report):
+    sequential = report["sequential"]
+    print(f"Sequential: {sequential['turns']} turns, {sequential['calls_per_turn']:.2f} backend calls "
+          f"and ~{sequential['prompt_tokens']:.0f} prompt tokens per turn")
+    for stage, values in sequential["latency"].items():
+        if values:
+            print(f"  {stage:<9}" + "  ".join(f"{q} {v * 1000:8.1f} ms" for q, v in values.items()))
+    for run in report["concurrent"].values():
+        values = run["latency"]["turn"]
+        print(f"{run['sessions']:>3} sessions: {run['throughput']:.2f} turns/s, "
+              + "  ".join(f"{q} {v * 1000:.1f} ms" for q, v in values.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=os.path.join(ROOT, "fixtures", "benchmark_questions.txt"))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every simulated backend call takes")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per streamed word")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds a single app run may take")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative regression")
+    parser.add_argument("--save-baseline", help="Write the report to this file")
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    use_local_backend(args)
+    conversations = load_corpus(args.corpus)
+    report = {
+        "sequential": sequential_run(conversations, args),
+        "concurrent": {str(n): concurrent_run(conversations, n, args) for n in args.concurrency},
+    }
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = regressions(report, json.load(f), args.threshold)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
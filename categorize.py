@@ -0,0 +1,280 @@
+"""
+Bulk categorization of the nutrition table for the ingredients search service.
+
+Replaces the row-by-row COMPLETE of step 6 in SNOWFLAKE_SQL_GUIDE.md. A rule engine labels every
+food whose energy is clearly dominated by protein, carbohydrates or fat, or that is high in fiber
+or minerals, and only the ambiguous rest is sent to Cortex, many prompts per statement.
+
+Results are appended to --output after every batch, so an interrupted run resumes where it
+stopped. Each row carries a fingerprint of its nutrients, and re-runs only categorize foods that
+are new or whose nutrients changed. Rows are flagged once merged into --write-table, and every
+run merges all rows that aren't yet, including those of an earlier run that stopped before its merge.
+
+    python categorize.py --input fixtures/nutrition.csv --backend local
+    python categorize.py --table TABLE1 --write-table FOOD_CATEGORIES
+"""
+import argparse
+import os
+import sys
+import tomllib
+
+import numpy as np
+import pandas as pd
+
+from backends import LocalBackend, SnowflakeBackend
+from caching import make_key
+from connection import PooledConnection, SessionPool
+from nutrition import to_numeric_column
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CATEGORIES = {
+    "protein": "High in protein",
+    "carbohydrates": "High in carbohydrates",
+    "fats": "High in fats",
+    "fiber": "High in fiber",
+    "minerals": "High in essential minerals",
+}
+# Words of an LLM reply that identify a category; the first one in the reply wins
+REPLY_WORDS = {"fiber": "fiber", "fibre": "fiber", "mineral": "minerals", "protein": "protein",
+               "carb": "carbohydrates", "fat": "fats"}
+# Daily values in mg of the minerals considered, per the FDA reference daily intakes
+MINERAL_DAILY_VALUES = {"CALCIUM": 1300, "IRON": 18, "MAGNESIUM": 420, "POTASSIUM": 4700, "ZINC": 11}
+DOMINANT_SHARE = 0.5  # Share of energy from one macronutrient that settles its category
+SHARE_MARGIN = 0.15  # ...when it leads the runner-up by at least this much
+HIGH_FIBER = 6.0  # Grams per 100 g
+HIGH_MINERALS = 0.4  # Fraction of a mineral's daily value per 100 g
+CHECKPOINT_COLUMNS = ["FOOD_ITEM", "CATEGORY", "SOURCE", "FINGERPRINT", "MERGED"]
+# Names of the positional columns of TABLE1, the full nutrition table step 6 of the setup guide
+# categorizes. TABLE2 has no fiber or magnesium, so it can't feed the fiber rule
+TABLE1_COLUMNS = {"C2": "NAME", "C4": "CALORIES", "C8": "SODIUM", "C30": "CALCIUM", "C32": "IRON", "C33": "MAGNESIUM",
+                  "C39": "PROTEIN", "C59": "CARBOHYDRATE", "C60": "FIBER", "C68": "FAT"}
+
+
+def nutrient_frame(frame):
+    """
+    Numeric nutrients per row: grams of protein, carbohydrate, fat and fiber, and mg of minerals.
+    Columns the table doesn't have are NaN.
+    """
+    def column(*names):
+        for name in names:
+            if name in frame.columns:
+                return to_numeric_column(frame[name]).to_numpy(dtype=float)
+        return np.full(len(frame), np.nan)
+
+    values = {
+        "protein": column("PROTEIN"),
+        "carbohydrate": column("CARBOHYDRATE"),
+        "fat": column("FAT", "TOTAL_FAT"),
+        "fiber": column("FIBER"),
+    }
+    values.update({mineral: column(mineral) for mineral in MINERAL_DAILY_VALUES})
+    return pd.DataFrame(values, index=frame.index)
+
+
+def rule_categories(nutrients):
+    """
+    Categorizes every row at once from its macronutrient energy shares, fiber and mineral content.
+    Returns (categories, best guesses): a category key per row or None when the rules are
+    ambiguous, and the macronutrient with the largest share as a fallback for those rows.
+    """
+    # Energy per macronutrient at 4/4/9 kcal per gram; fiber adds no usable energy
+    digestible_carbs = np.clip(nutrients["carbohydrate"].to_numpy() - np.nan_to_num(nutrients["fiber"].to_numpy()), 0, None)
+    energy = np.column_stack([4 * nutrients["protein"].to_numpy(), 4 * digestible_carbs, 9 * nutrients["fat"].to_numpy()])
+    energy = np.nan_to_num(energy)
+    total = energy.sum(axis=1)
+    shares = np.divide(energy, total[:, None], out=np.zeros_like(energy), where=total[:, None] > 0)
+
+    ordered = np.sort(shares, axis=1)
+    top, runner_up = ordered[:, -1], ordered[:, -2]
+    macro = np.array(["protein", "carbohydrates", "fats"], dtype=object)[shares.argmax(axis=1)]
+    dominant = (top >= DOMINANT_SHARE) & (top - runner_up >= SHARE_MARGIN)
+
+    daily_values = np.column_stack([
+        nutrients[mineral].to_numpy() / daily for mineral, daily in MINERAL_DAILY_VALUES.items()
+    ])
+    minerals = np.nan_to_num(daily_values).max(axis=1) >= HIGH_MINERALS
+    fiber = np.nan_to_num(nutrients["fiber"].to_numpy()) >= HIGH_FIBER
+
+    categories = np.full(len(nutrients), None, dtype=object)
+    categories[dominant] = macro[dominant]
+    # Fiber-rich foods are mostly carbohydrate, and fiber is the more useful label for them
+    categories[fiber & (~dominant | (macro == "carbohydrates"))] = "fiber"
+    categories[minerals & ~dominant & ~fiber] = "minerals"
+    guesses = np.where(total > 0, macro, "minerals")
+    return categories, guesses
+
+
+def fingerprints(frame, nutrients):
+    return [make_key(name, [None if np.isnan(value) else round(value, 4) for value in row])
+            for name, row in zip(frame["NAME"], nutrients.to_numpy(dtype=float))]
+
+
+def category_prompt(name, nutrients):
+    profile = ", ".join(f"{column}={value:g}" for column, value in nutrients.items() if not np.isnan(value))
+    return (
+        f"The food item is: {name}. Its nutritional profile per 100 g is: {profile}. "
+        "Categorize the food item as high in protein, carbohydrates, fats, fiber, or essential minerals. "
+        "Return the category only; do not include the name of the food item."
+    )
+
+
+def parse_reply(reply):
+    text = (reply or "").lower()
+    found = [(text.find(word), category) for word, category in REPLY_WORDS.items() if word in text]
+    return min(found)[1] if found else None
+
+
+def load_checkpoint(path):
+    """
+    Returns {food: (category, source, fingerprint, merged)} from an earlier run; later lines win.
+    merged is "1" once the row was merged into the Snowflake table.
+    """
+    if not os.path.exists(path):
+        return {}
+    # Checkpoints written before the MERGED column count as not merged
+    frame = pd.read_csv(path, dtype=str, keep_default_na=False).reindex(columns=CHECKPOINT_COLUMNS, fill_value="0")
+    return {row.FOOD_ITEM: (row.CATEGORY, row.SOURCE, row.FINGERPRINT, row.MERGED) for row in frame.itertuples(index=False)}
+
+
+def append_checkpoint(path, rows):
+    if not rows:
+        return
+    frame = pd.DataFrame([(*row, "0") for row in rows], columns=CHECKPOINT_COLUMNS)
+    frame.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def write_checkpoint(path, checkpoint, foods):
+    """
+    Rewrites the checkpoint with one line per food of `foods` that it has.
+    """
+    rows = [(food, *checkpoint[food]) for food in foods if food in checkpoint]
+    tmp_path = f"{path}.tmp"
+    pd.DataFrame(rows, columns=CHECKPOINT_COLUMNS).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def unmerged(path):
+    """
+    Returns the (FOOD_ITEM, CATEGORY) rows of the checkpoint not merged into Snowflake yet.
+    """
+    return [(food, category) for food, (category, _, _, merged) in load_checkpoint(path).items() if merged != "1"]
+
+
+def mark_merged(path, foods):
+    checkpoint = load_checkpoint(path)
+    for food in foods:
+        if food in checkpoint:
+            checkpoint[food] = (*checkpoint[food][:3], "1")
+    write_checkpoint(path, checkpoint, checkpoint)
+
+
+def categorize(frame, complete_batch, output, batch_size=50, progress=print):
+    """
+    Categorizes the foods in `frame` (a NAME column plus nutrient columns) into `output` and
+    returns (FOOD_ITEM, CATEGORY) rows of the foods that were new or changed.
+    complete_batch(prompts) returns one reply per prompt, in order.
+    """
+    frame = frame[frame["NAME"].astype(str).str.strip() != ""].drop_duplicates("NAME", keep="last").reset_index(drop=True)
+    nutrients = nutrient_frame(frame)
+    keys = fingerprints(frame, nutrients)
+    done = load_checkpoint(output)
+    todo = np.array([done.get(name, (None, None, None))[2] != key for name, key in zip(frame["NAME"], keys)], dtype=bool)
+    progress(f"{len(frame)} foods, {int(todo.sum())} new or changed")
+
+    categories, guesses = rule_categories(nutrients.loc[todo])
+    names = frame["NAME"][todo].tolist()
+    todo_keys = [key for key, pending in zip(keys, todo) if pending]
+    append_checkpoint(output, [
+        (name, CATEGORIES[category], "rules", key)
+        for name, category, key in zip(names, categories, todo_keys) if category is not None
+    ])
+
+    ambiguous = [index for index, category in enumerate(categories) if category is None]
+    progress(f"{len(names) - len(ambiguous)} categorized by rules, {len(ambiguous)} sent to the LLM")
+    todo_nutrients = nutrients.loc[todo].reset_index(drop=True)
+    for offset in range(0, len(ambiguous), batch_size):
+        batch = ambiguous[offset:offset + batch_size]
+        replies = complete_batch([category_prompt(names[index], todo_nutrients.iloc[index]) for index in batch])
+        rows = []
+        for index, reply in zip(batch, replies):
+            category = parse_reply(reply)
+            source = "llm" if category else "guess"
+            rows.append((names[index], CATEGORIES[category or guesses[index]], source, todo_keys[index]))
+        append_checkpoint(output, rows)
+        progress(f"{min(offset + batch_size, len(ambiguous))}/{len(ambiguous)} LLM categorizations")
+
+    # Compact the checkpoint to one line per current food
+    current = load_checkpoint(output)
+    write_checkpoint(output, current, frame["NAME"])
+    return [(name, current[name][0]) for name in names if name in current]
+
+
+def read_secrets():
+    with open(os.path.join(ROOT, ".streamlit", "secrets.toml"), "rb") as f:
+        return tomllib.load(f)
+
+
+def snowflake_connection(secrets):
+    from snowflake.snowpark import Session
+
+    params = {name: secrets[name] for name in ("account", "user", "password", "role", "database", "schema", "warehouse")}
+    return PooledConnection(Session.builder.configs(params).create(), None, {})
+
+
+def merge_categories(session, table, rows):
+    """
+    Upserts the (FOOD_ITEM, CATEGORY) rows into `table` through a temporary staging table.
+    """
+    session.sql(f"CREATE TABLE IF NOT EXISTS {table} (FOOD_ITEM STRING, CATEGORY STRING)").collect()
+    staged = pd.DataFrame(rows, columns=["FOOD_ITEM", "CATEGORY"])
+    session.write_pandas(staged, f"{table}_STAGE", auto_create_table=True, overwrite=True, table_type="temporary")
+    session.sql(f"""
+        MERGE INTO {table} t USING {table}_STAGE s ON t.FOOD_ITEM = s.FOOD_ITEM
+        WHEN MATCHED THEN UPDATE SET t.CATEGORY = s.CATEGORY
+        WHEN NOT MATCHED THEN INSERT (FOOD_ITEM, CATEGORY) VALUES (s.FOOD_ITEM, s.CATEGORY)
+    """).collect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="CSV or Parquet file of the nutrition table, instead of --table")
+    parser.add_argument("--table", default="TABLE1",
+                        help="Snowflake table with NAME and nutrient columns, or TABLE1's positional columns")
+    parser.add_argument("--output", default="food_categories.csv", help="Checkpoint file of the categories")
+    parser.add_argument("--backend", choices=["snowflake", "local"], default="snowflake")
+    parser.add_argument("--model", default="mistral-large")
+    parser.add_argument("--batch-size", type=int, default=50, help="Prompts per COMPLETE statement")
+    parser.add_argument("--write-table", help="Merge new and changed categories into this Snowflake table")
+    args = parser.parse_args(argv)
+
+    if args.backend == "local":
+        if not args.input or args.write_table:
+            parser.error("--backend local needs --input and can't --write-table")
+        backend = LocalBackend(os.path.join(ROOT, "fixtures"))
+    else:
+        pool = SessionPool(lambda: snowflake_connection(read_secrets()), size=1)
+        backend = SnowflakeBackend(pool, classify_expr=None, rest_url=None, batch_size=args.batch_size)
+
+    if args.input:
+        frame = pd.read_parquet(args.input) if args.input.endswith(".parquet") else pd.read_csv(args.input, dtype=str)
+    else:
+        with backend.pool.connection() as conn:
+            frame = conn.session.table(args.table).to_pandas()
+    if "NAME" not in frame.columns:
+        frame = frame.rename(columns=TABLE1_COLUMNS)
+
+    changed = categorize(frame, lambda prompts: backend.complete_batch(prompts, args.model), args.output, args.batch_size)
+    print(f"{len(changed)} categories written to {args.output}")
+    if args.write_table:
+        # Includes rows checkpointed by earlier runs that stopped or failed before merging
+        rows = unmerged(args.output)
+        if rows:
+            with backend.pool.connection() as conn:
+                merge_categories(conn.session, args.write_table, rows)
+            mark_merged(args.output, [food for food, _ in rows])
+        print(f"{len(rows)} categories merged into {args.write_table}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+import collections
+import concurrent.futures
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from caching import make_key
+from telemetry import current_span
+
+
+def fan_out(executor, fn, items, timeout=None, default=None):
+    """
+    Runs fn(item) for every item on the executor and returns the results in input order.
+
+    Each call gets `timeout` seconds from the moment it starts running. Calls that raise or run
+    out of time are replaced by default(item); timed out calls are cancelled if still queued on
+    the executor and otherwise left to finish in the background with their result discarded.
+    """
+    items = list(items)
+    started = {}
+    lock = threading.Lock()
+
+    def run(index, item):
+        with lock:
+            started[index] = time.monotonic()
+        return fn(item)
+
+    # Each call runs in a copy of the caller's context, so tracing spans nest under the caller's
+    futures = [executor.submit(contextvars.copy_context().run, run, index, item) for index, item in enumerate(items)]
+    results = [None] * len(items)
+    pending = dict(enumerate(futures))
+
+    while pending:
+        done, _ = concurrent.futures.wait(
+            pending.values(), timeout=0.05, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        now = time.monotonic()
+        for index, future in list(pending.items()):
+            if future in done:
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    print(f"Call for {items[index]!r} failed: {e}")
+                    results[index] = default(items[index]) if default else None
+                del pending[index]
+                continue
+            with lock:
+                start = started.get(index)
+            if timeout is not None and start is not None and now - start > timeout:
+                # A running thread can't be interrupted; its result is simply discarded
+                future.cancel()
+                print(f"Call for {items[index]!r} timed out after {timeout}s")
+                results[index] = default(items[index]) if default else None
+                del pending[index]
+
+    return results
+
+
+def deadline_stream(chunks, first_chunk_timeout=None, timeout=None):
+    """
+    Yields from the iterator `chunks`, raising TimeoutError when the first chunk takes longer than
+    `first_chunk_timeout` seconds or the whole stream longer than `timeout`.
+
+    The iterator is consumed on a thread of its own, in a copy of the caller's context, so a stalled
+    read can't block the caller past the deadline. An abandoned iterator is closed after its next
+    chunk arrives.
+    """
+    chunks = iter(chunks)
+    handoff = collections.deque()
+    ready = threading.Event()
+    abandoned = threading.Event()
+    end = object()
+
+    def pump():
+        try:
+            for chunk in chunks:
+                handoff.append(chunk)
+                ready.set()
+                if abandoned.is_set():
+                    break
+            handoff.append(end)
+        except Exception as e:
+            handoff.append(e)
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            ready.set()
+
+    threading.Thread(target=contextvars.copy_context().run, args=(pump,), name="stream", daemon=True).start()
+    start = time.monotonic()
+    first = True
+    try:
+        while True:
+            limits = [limit for limit in (first_chunk_timeout if first else None, timeout) if limit is not None]
+            remaining = max(0.0, min(limits) - (time.monotonic() - start)) if limits else None
+            if not handoff and not ready.wait(remaining):
+                waited_for = "first chunk" if first else "stream"
+                raise TimeoutError(f"{waited_for} timed out after {time.monotonic() - start:.1f}s")
+            ready.clear()
+            while handoff:
+                item = handoff.popleft()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                first = False
+                yield item
+    finally:
+        abandoned.set()
+
+
+_current_user = contextvars.ContextVar("admission_user", default="background")
+
+
+class AdmissionController:
+    """
+    Process-wide gate in front of the remote calls. At most `limit` calls run at once; callers
+    beyond that wait in one queue per user, and freed slots go to the users round robin, so one
+    busy session can't starve the others. Calls with the same key that overlap share the first
+    caller's result instead of running again. A caller gives up with TimeoutError after `max_wait`
+    seconds in the queue.
+    """
+
+    def __init__(self, limit=4, max_wait=60, window=500):
+        self.limit = limit
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queues = collections.OrderedDict()  # user -> deque of waiting events, in serving order
+        self._in_flight = {}  # key -> Future of the call every overlapping caller shares
+        self._waits = collections.deque(maxlen=window)
+        self.admitted = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    @contextmanager
+    def user(self, user_id):
+        """
+        Attributes the calls made in the with-block, and in contexts copied from it, to user_id.
+        """
+        token = _current_user.set(user_id)
+        try:
+            yield
+        finally:
+            _current_user.reset(token)
+
+    def acquire(self):
+        """
+        Waits for a slot and returns the seconds spent waiting. Every acquire() needs a release().
+        """
+        user = _current_user.get()
+        with self._lock:
+            if self._active < self.limit and not self._queues:
+                self._active += 1
+                self._admit(0.0)
+                return 0.0
+            waiter = threading.Event()
+            self._queues.setdefault(user, collections.deque()).append(waiter)
+        start = time.perf_counter()
+        if not waiter.wait(self.max_wait):
+            with self._lock:
+                # The slot may have been handed over right as the wait ran out
+                if not waiter.is_set():
+                    queue = self._queues[user]
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[user]
+                    self.timeouts += 1
+                    raise TimeoutError(f"No remote call slot free within {self.max_wait}s")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._admit(waited)
+        return waited
+
+    def _admit(self, waited):
+        self.admitted += 1
+        self._waits.append(waited)
+
+    def release(self):
+        with self._lock:
+            if not self._queues:
+                self._active -= 1
+                return
+            # The slot passes straight to the next user in line, who then moves to the back
+            user, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                self._queues[user] = queue
+            waiter.set()
+
+    def run(self, key, fn):
+        """
+        Runs fn() in a slot and returns (result, seconds queued, coalesced). With a key, callers
+        arriving while an identical call is in flight wait for its result instead.
+        """
+        if key is not None:
+            with self._lock:
+                shared = self._in_flight.get(key)
+                if shared is None:
+                    future = self._in_flight[key] = concurrent.futures.Future()
+                else:
+                    self.coalesced += 1
+            if shared is not None:
+                return shared.result(), 0.0, True
+        try:
+            waited = self.acquire()
+            try:
+                result = fn()
+            finally:
+                self.release()
+        except BaseException as e:
+            if key is not None:
+                self._settle(key, future).set_exception(e)
+            raise
+        if key is not None:
+            self._settle(key, future).set_result(result)
+        return result, waited, False
+
+    def _settle(self, key, future):
+        # Later callers start a new call rather than getting this one's result
+        with self._lock:
+            del self._in_flight[key]
+        return future
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            queued = {str(user): len(queue) for user, queue in self._queues.items()}
+            active = self._active
+
+        def percentile(q):
+            return waits[min(len(waits) - 1, int(len(waits) * q / 100))] if waits else 0.0
+
+        return {
+            "limit": self.limit,
+            "active": active,
+            "queued": sum(queued.values()),
+            "queued_users": len(queued),
+            "wait_p50": percentile(50),
+            "wait_p95": percentile(95),
+            "wait_max": waits[-1] if waits else 0.0,
+            "admitted": self.admitted,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+        }
+
+
+class AdmittedBackend:
+    """
+    Wraps a backend so that every remote call goes through an AdmissionController. Identical
+    lookups in flight at the same time (classification, search, embeddings, completions) run once.
+    """
+
+    def __init__(self, backend, controller):
+        self.backend = backend
+        self.controller = controller
+        self.name = backend.name
+
+    def _run(self, method, *args):
+        key = make_key(method, args)
+        result, waited, coalesced = self.controller.run(key, lambda: getattr(self.backend, method)(*args))
+        span = current_span()
+        if span is not None:
+            span.set("queued", round(waited, 4))
+            span.set("coalesced", coalesced)
+        return result
+
+    def classify(self, query):
+        return self._run("classify", query)
+
+    def classify_and_complete(self, query, model_name, prompt):
+        return self._run("classify_and_complete", query, model_name, prompt)
+
+    def search(self, service, query, columns, limit, search_filter=None):
+        return self._run("search", service, query, columns, limit, search_filter)
+
+    def complete(self, prompt, model_name):
+        return self._run("complete", prompt, model_name)
+
+    def complete_batch(self, prompts, model_name):
+        return self._run("complete_batch", prompts, model_name)
+
+    def stream(self, prompt, model_name):
+        # A stream holds its slot until it is consumed or closed and is never shared
+        self.controller.acquire()
+        try:
+            yield from self.backend.stream(prompt, model_name)
+        finally:
+            self.controller.release()
+
+    def embed(self, text, model_name):
+        return self._run("embed", text, model_name)
+
+    def fetch_table(self, table, columns):
+        return self._run("fetch_table", table, columns)
+
+    def stats(self):
+        return self.backend.stats()
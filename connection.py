@@ -0,0 +1,135 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PooledConnection:
+    """
+    A Snowpark session together with the Root and Cortex Search service handles built on it.
+    """
+
+    def __init__(self, session, root, services):
+        self.session = session
+        self.root = root
+        self.services = services
+        self.created_at = time.time()
+        self.last_checked = self.created_at
+
+    def is_healthy(self):
+        try:
+            self.session.sql("SELECT 1").collect()
+            self.last_checked = time.time()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.session.close()
+        except Exception:
+            pass
+
+
+class SessionPool:
+    """
+    Bounded, process-wide pool of PooledConnections shared by every Streamlit session.
+    Connections are created lazily on first use, health-checked when idle for longer than
+    `health_check_interval` seconds and replaced when the check fails (e.g. an expired login).
+    Callers wait up to `acquire_timeout` seconds for a connection when all of them are in use.
+    """
+
+    def __init__(self, connect, size=4, health_check_interval=300, acquire_timeout=60):
+        self._connect = connect
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # Most recently returned last
+        # Signalled whenever a connection is returned or a broken one frees its slot
+        self._available = threading.Condition()
+        self._created = 0
+        self.connects = []  # (reason, seconds) of every login, newest last
+        self.reconnects = 0
+        self.waits = 0
+
+    def _open(self, reason):
+        start = time.perf_counter()
+        conn = self._connect()
+        self.connects = (self.connects + [(reason, time.perf_counter() - start)])[-20:]
+        return conn
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._available:
+            waited = False
+            while not self._idle and self._created >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"No Snowflake session free within {self.acquire_timeout}s; all {self.size} are in use"
+                    )
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._available.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._open("initial")
+        except Exception:
+            self._free_slot()
+            raise
+
+    def _release(self, conn):
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    def _free_slot(self):
+        with self._available:
+            self._created -= 1
+            # A waiter can now open a connection in the freed slot
+            self._available.notify()
+
+    def _discard(self, conn):
+        conn.close()
+        self._free_slot()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks a connection out of the pool for the duration of the with-block.
+        """
+        conn = self._acquire()
+        if time.time() - conn.last_checked > self.health_check_interval and not conn.is_healthy():
+            # The replacement takes over the broken connection's slot
+            conn.close()
+            self.reconnects += 1
+            try:
+                conn = self._open("reconnect")
+            except Exception:
+                self._free_slot()
+                raise
+        failed = False
+        try:
+            yield conn
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if failed and not conn.is_healthy():
+                self._discard(conn)
+            else:
+                self._release(conn)
+
+    def stats(self):
+        with self._available:
+            open_connections, idle = self._created, len(self._idle)
+        return {
+            "size": self.size,
+            "open": open_connections,
+            "idle": idle,
+            "reconnects": self.reconnects,
+            "waits": self.waits,
+            "connects": [{"reason": reason, "seconds": round(seconds, 3)} for reason, seconds in self.connects],
+        }
@@ -0,0 +1,137 @@
+import sys
+import threading
+import time
+
+# Shown in place of spilled text that the spill cache has since evicted
+EXPIRED_TEXT = "_(This message is no longer available.)_"
+
+
+class Message:
+    __slots__ = ("role", "content", "key", "size")
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content  # None once spilled
+        self.key = None  # Key of the spilled text
+        self.size = len(content.encode("utf-8"))
+
+
+class ConversationStore:
+    """
+    Chat messages of one session behind a list-like interface of {"role", "content"} dicts.
+    compact() moves the text of older messages to `spill`, a process-wide cache with get/set such
+    as SQLiteCache, and keeps only its key, so a long conversation holds at most `keep` messages
+    and `max_bytes` of text in memory. Spilled messages are read back from the cache on access.
+    """
+
+    def __init__(self, spill, session_id, keep=14, max_bytes=256 * 1024):
+        self.spill = spill
+        self.session_id = session_id
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self._messages = []
+        self._spills = 0  # Numbers the spill keys, which must stay unique after clear()
+
+    def append(self, message):
+        self._messages.append(Message(message["role"], message["content"]))
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _as_dict(self, message):
+        content = message.content
+        if content is None:
+            content = self.spill.get(message.key, EXPIRED_TEXT)
+        return {"role": message.role, "content": content}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._as_dict(message) for message in self._messages[index]]
+        return self._as_dict(self._messages[index])
+
+    def __iter__(self):
+        for message in list(self._messages):
+            yield self._as_dict(message)
+
+    def nbytes(self):
+        """
+        Bytes of message text held in memory.
+        """
+        return sum(message.size for message in self._messages if message.content is not None)
+
+    def spilled(self):
+        return sum(message.content is None for message in self._messages)
+
+    def _spill(self, message):
+        self._spills += 1
+        message.key = f"{self.session_id}:{self._spills}"
+        self.spill.set(message.key, message.content)
+        message.content = None
+
+    def compact(self):
+        """
+        Spills every message before the newest `keep`, then older ones of those until the text in
+        memory fits `max_bytes`. The latest exchange always stays. Returns the number spilled.
+        """
+        in_memory = [message for message in self._messages if message.content is not None]
+        spilled = 0
+        total = sum(message.size for message in in_memory)
+        for position, message in enumerate(in_memory[:-2]):
+            if position >= len(in_memory) - self.keep and total <= self.max_bytes:
+                break
+            self._spill(message)
+            total -= message.size
+            spilled += 1
+        return spilled
+
+    def clear(self):
+        for message in self._messages:
+            if message.key is not None:
+                self.spill.delete(message.key)
+        self._messages = []
+
+
+def deep_size(value, seen=None):
+    """
+    Approximate bytes of memory held by value and everything it contains. Objects with an
+    nbytes() method, such as ConversationStore, report their own size.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if hasattr(value, "nbytes") and callable(value.nbytes):
+        return sys.getsizeof(value) + value.nbytes()
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    return size
+
+
+class SessionMemory:
+    """
+    Latest memory report of every session active within the last `idle` seconds, for operators.
+    """
+
+    def __init__(self, idle=3600):
+        self.idle = idle
+        self._lock = threading.Lock()
+        self._reports = {}  # session id -> (reported at, report)
+
+    def update(self, session_id, report):
+        now = time.time()
+        with self._lock:
+            self._reports[session_id] = (now, report)
+            for stale in [key for key, (at, _) in self._reports.items() if now - at > self.idle]:
+                del self._reports[stale]
+
+    def sessions(self):
+        now = time.time()
+        with self._lock:
+            reports = {key: report for key, (at, report) in self._reports.items() if now - at <= self.idle}
+        return dict(sorted(reports.items(), key=lambda item: item[1]["bytes"], reverse=True))
+
+    def total(self):
+        return sum(report["bytes"] for report in self.sessions().values())
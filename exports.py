@@ -0,0 +1,171 @@
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+from caching import TTLCache
+from shopping import aggregate_ingredients, shopping_list_markdown
+
+
+def text_to_pdf(text):
+    """
+    Renders plain text into a single-column PDF and returns its bytes.
+    """
+    # Only needed once a download is rendered, so kept out of the app's cold start
+    from fpdf import FPDF
+
+    # Initialize the PDF object
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+
+    # Add the text to the PDF
+    pdf.multi_cell(0, 10, txt=text)  # Handles multi-line text
+
+    # Generate the PDF as a byte string
+    return pdf.output(dest="S").encode("latin1")
+
+
+def render_shopping_list_pdf(json_data, complete=None, max_llm_items=40, progress=None):
+    """
+    Generates a shopping list PDF from the recipes in json_data. Ingredients are parsed, unit
+    converted and summed locally; complete(prompt), when given, only tidies the wording of lists
+    of at most max_llm_items items. An empty LLM reply falls back to the aggregated list.
+    """
+    progress = progress or (lambda fraction: None)
+
+    items = aggregate_ingredients(json_data.get('results', []))
+    shopping_list = shopping_list_markdown(items)
+    progress(0.2)
+
+    if complete is not None and 0 < len(items) <= max_llm_items:
+        prompt = f"""
+            You are a smart assistant. Below is a shopping list in Markdown whose quantities have already been
+            combined. Tidy the item names and merge obvious duplicates, but keep the headers, the Markdown format
+            and every quantity. Return only the list.
+            {shopping_list}
+        """
+        shopping_list = complete(prompt) or shopping_list
+    progress(0.8)
+
+    # Convert Markdown to HTML and parse it into plain text using BeautifulSoup
+    from bs4 import BeautifulSoup
+    from markdown2 import markdown
+
+    html_text = markdown(shopping_list.strip())
+    plain_text = BeautifulSoup(html_text, 'html.parser').get_text()
+    return text_to_pdf(plain_text)
+
+
+def render_meal_plan_csv(json_data, progress=None):
+    """
+    Exports the recipes in json_data as a meal plan CSV.
+    """
+    # Create a list of dictionaries for each recipe
+    recipe_data = [
+        {
+            'Recipe Name': item['TRANSLATEDRECIPENAME'],
+            'Ingredients': item['TRANSLATEDINGREDIENTS'],
+            'Instructions': item['TRANSLATEDINSTRUCTIONS'],
+            'URL': item.get('URL', 'N/A'),
+            'Prep Time (mins)': item['PREPTIMEINMINS'],
+            'Cook Time (mins)': item['COOKTIMEINMINS'],
+            'Total Time (mins)': item['TOTALTIMEINMINS'],
+            'Cuisine': item['CUISINE'],
+            'Servings': item['SERVINGS'],
+            'Diet': item['DIET']
+        }
+        for item in json_data['results']
+    ]
+
+    # Convert the list of dictionaries to a DataFrame and generate the CSV output
+    import pandas as pd
+
+    return pd.DataFrame(recipe_data).to_csv(index=False).encode("utf-8")
+
+
+def render_response_pdf(response_text, progress=None):
+    """
+    Renders the full response as a PDF.
+    """
+    return text_to_pdf(response_text)
+
+
+class ExportJobs:
+    """
+    Background queue of export renders shared by every session. Each job is identified by a key
+    derived from its inputs, runs at most once and its bytes are kept in a TTL cache, so a
+    download button can be served as soon as the render has finished. With a `disk` cache such as
+    SQLiteCache, results are also written there and only the `maxsize` most recent stay in memory.
+    """
+
+    def __init__(self, max_workers=2, maxsize=256, ttl=3600, disk=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._disk = disk
+        self._futures = {}
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, render, *args):
+        """
+        Starts render(*args, progress=...) unless a job with this key is running or has finished.
+        """
+        with self._lock:
+            if key in self._futures or self._result(key) is not None:
+                return
+            self._progress[key] = 0.0
+            self._futures[key] = self._executor.submit(self._run, key, render, *args)
+
+    def _run(self, key, render, *args):
+        def progress(fraction):
+            self._progress[key] = fraction
+
+        try:
+            data = render(*args, progress=progress)
+            self._results.set(key, data)
+            if self._disk is not None:
+                # The disk cache stores JSON, so bytes are base64 encoded
+                stored = {"bytes": base64.b64encode(data).decode()} if isinstance(data, bytes) else {"value": data}
+                self._disk.set(key, stored)
+            with self._lock:
+                # The bytes now live in the result cache, which bounds memory
+                self._futures.pop(key, None)
+            return data
+        finally:
+            with self._lock:
+                self._progress.pop(key, None)
+
+    def status(self, key):
+        """
+        Returns ("done", bytes), ("running", progress), ("error", exception) or (None, None) for unknown keys.
+        """
+        data = self._result(key)
+        if data is not None:
+            return "done", data
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                return None, None
+            if future.done() and future.exception() is not None:
+                # Failed jobs stay registered so they aren't retried on every rerun; cancel() clears them
+                return "error", future.exception()
+            return "running", self._progress.get(key, 0.0)
+
+    def _result(self, key):
+        data = self._results.get(key)
+        if data is None and self._disk is not None:
+            stored = self._disk.get(key)
+            if stored is not None:
+                data = base64.b64decode(stored["bytes"]) if "bytes" in stored else stored["value"]
+                self._results.set(key, data)
+        return data
+
+    def cancel(self, key):
+        """
+        Forgets the job and returns whether it was stopped before it started; a running render
+        still finishes and its result is kept.
+        """
+        with self._lock:
+            future = self._futures.pop(key, None)
+        return future is not None and future.cancel()
@@ -0,0 +1,262 @@
+import concurrent.futures
+import math
+import os
+from dataclasses import dataclass
+
+
+from shopping import parse_ingredient, split_ingredients
+
+MEAL_SLOTS = ("Breakfast", "Lunch", "Dinner")
+# Words added to the search query of each meal slot
+SLOT_QUERIES = {
+    "Breakfast": "breakfast",
+    "Lunch": "lunch main course",
+    "Dinner": "dinner main course",
+    "Snack": "evening snack",
+}
+# Cortex Search has no offset, so further pages of a slot come from reworded queries
+QUERY_VARIATIONS = ("", "quick", "healthy", "traditional", "easy", "homestyle", "one pot", "festive")
+# Grams assumed for an ingredient given as a count, e.g. "2 tomatoes"
+GRAMS_PER_PIECE = 50
+
+PLAN_COLUMNS = [
+    "Week", "Day", "Meal", "Recipe Name", "Cuisine", "Diet", "Total Time (mins)",
+    "Estimated kcal per serving", "Servings", "Ingredients", "Instructions", "URL",
+]
+_STRING_COLUMNS = [column for column in PLAN_COLUMNS if column not in ("Week", "Day", "Estimated kcal per serving")]
+
+
+@dataclass(frozen=True)
+class PlanRequest:
+    days: int = 7
+    slots: tuple = MEAL_SLOTS
+    diet: str = ""  # e.g. "Vegetarian", empty for any diet
+    cuisines: tuple = ()  # Empty for any cuisine
+    max_recipe_time: int = 0  # Minutes per recipe, 0 for no limit
+    daily_time_budget: int = 0  # Minutes of cooking per day, 0 for no limit
+    daily_calories: int = 0  # Target kcal per person per day, 0 to ignore
+
+
+def minutes(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def search_specs(request, page_size):
+    """
+    Returns the (slot, query, filter) searches needed to gather enough candidates for the plan:
+    one per slot and cuisine, plus reworded pages until each slot can be filled about three times over.
+    """
+    cuisines = list(request.cuisines) or [""]
+    pages = max(1, min(len(QUERY_VARIATIONS), math.ceil(3 * request.days / (page_size * len(cuisines)))))
+    specs = []
+    for slot in request.slots:
+        for cuisine in cuisines:
+            clauses = []
+            if request.diet:
+                clauses.append({"@eq": {"DIET": request.diet}})
+            if cuisine:
+                clauses.append({"@eq": {"CUISINE": cuisine}})
+            search_filter = {"@and": clauses} if len(clauses) > 1 else (clauses[0] if clauses else None)
+            for variation in QUERY_VARIATIONS[:pages]:
+                words = [variation, request.diet, cuisine, SLOT_QUERIES.get(slot, slot.lower()), "recipe"]
+                specs.append((slot, " ".join(word for word in words if word), search_filter))
+    return specs
+
+
+def matches_request(recipe, request):
+    """
+    Applies the plan's filters locally, so they hold even when the search service can't filter on them.
+    """
+    if request.diet and str(recipe.get("DIET", "")).lower() != request.diet.lower():
+        return False
+    if request.cuisines and str(recipe.get("CUISINE", "")).lower() not in {c.lower() for c in request.cuisines}:
+        return False
+    total_time = minutes(recipe.get("TOTALTIMEINMINS"))
+    if request.max_recipe_time and not total_time <= request.max_recipe_time:
+        return False
+    return bool(recipe.get("TRANSLATEDRECIPENAME"))
+
+
+def estimate_calories(recipe, snapshot):
+    """
+    Rough kcal per serving from the recipe's ingredient quantities and the per-100 g calories
+    in the nutrition snapshot. Returns None when fewer than half of the ingredients are known.
+    """
+    lines = split_ingredients(recipe.get("TRANSLATEDINGREDIENTS", ""))
+    total, known = 0.0, 0
+    for line in lines:
+        ingredient = parse_ingredient(line)
+        if ingredient.dimension == "as needed":
+            known += 1
+            continue
+        position = snapshot.find(ingredient.name)
+        if position is None:
+            continue
+        kcal_per_100g = snapshot.values["CALORIES"].iat[position]
+        if math.isnan(kcal_per_100g):
+            continue
+        # Treat a millilitre as a gram, close enough for planning
+        grams = ingredient.amount * GRAMS_PER_PIECE if ingredient.dimension == "count" else ingredient.amount
+        total += grams * kcal_per_100g / 100
+        known += 1
+    if not lines or known < len(lines) / 2:
+        return None
+    servings = minutes(recipe.get("SERVINGS"))
+    return total / servings if servings and servings > 0 else total
+
+
+class PlanAssembler:
+    """
+    Collects candidate recipes per meal slot as search results arrive and lays them out day by day,
+    preferring unused recipes, quicker cooking, a mix of cuisines within a day and meals close to
+    the calorie target.
+    """
+
+    def __init__(self, request, calories=None):
+        self.request = request
+        self.calories = calories
+        self.pools = {slot: {} for slot in request.slots}  # slot -> recipe name -> (recipe, kcal)
+        self.uses = {}
+
+    def add(self, slot, recipes):
+        pool = self.pools[slot]
+        for recipe in recipes:
+            name = recipe.get("TRANSLATEDRECIPENAME")
+            if name in pool or not matches_request(recipe, self.request):
+                continue
+            kcal = self.calories(recipe) if self.calories else None
+            pool[name] = (recipe, kcal)
+
+    def __len__(self):
+        return sum(len(pool) for pool in self.pools.values())
+
+    def score(self, recipe, kcal, day_cuisines, time_left):
+        total_time = minutes(recipe.get("TOTALTIMEINMINS"))
+        total_time = 60.0 if math.isnan(total_time) else total_time
+        # Reusing a recipe costs more than any other trade-off, so repeats only fill gaps
+        score = 10.0 * self.uses.get(recipe["TRANSLATEDRECIPENAME"], 0) + total_time / 60
+        if time_left is not None and total_time > time_left:
+            score += 5.0
+        if str(recipe.get("CUISINE")) in day_cuisines:
+            score += 0.5
+        if self.request.daily_calories and kcal is not None:
+            target = self.request.daily_calories / len(self.request.slots)
+            score += 2.0 * abs(kcal - target) / target
+        return score
+
+    def days(self):
+        """
+        Yields the plan rows one day at a time.
+        """
+        for day in range(self.request.days):
+            day_cuisines = set()
+            time_left = self.request.daily_time_budget or None
+            rows = []
+            for slot in self.request.slots:
+                candidates = self.pools[slot].values()
+                if not candidates:
+                    continue
+                recipe, kcal = min(candidates, key=lambda candidate: self.score(*candidate, day_cuisines, time_left))
+                name = recipe["TRANSLATEDRECIPENAME"]
+                self.uses[name] = self.uses.get(name, 0) + 1
+                day_cuisines.add(str(recipe.get("CUISINE")))
+                total_time = minutes(recipe.get("TOTALTIMEINMINS"))
+                if time_left is not None and not math.isnan(total_time):
+                    time_left -= total_time
+                rows.append({
+                    "Week": day // 7 + 1,
+                    "Day": day + 1,
+                    "Meal": slot,
+                    "Recipe Name": name,
+                    "Cuisine": recipe.get("CUISINE"),
+                    "Diet": recipe.get("DIET"),
+                    "Total Time (mins)": recipe.get("TOTALTIMEINMINS"),
+                    "Estimated kcal per serving": None if kcal is None else round(kcal),
+                    "Servings": recipe.get("SERVINGS"),
+                    "Ingredients": recipe.get("TRANSLATEDINGREDIENTS"),
+                    "Instructions": recipe.get("TRANSLATEDINSTRUCTIONS"),
+                    "URL": recipe.get("URL", "N/A"),
+                })
+            yield rows
+
+
+def plan_chunk(rows):
+    import pandas as pd
+
+    frame = pd.DataFrame(rows, columns=PLAN_COLUMNS)
+    # Fixed column types keep every Parquet row group on the same schema
+    frame[_STRING_COLUMNS] = frame[_STRING_COLUMNS].astype("string")
+    return frame.astype({"Week": "int64", "Day": "int64", "Estimated kcal per serving": "float64"})
+
+
+def write_plan(days, path, file_format="csv", chunk_rows=500, progress=None):
+    """
+    Writes the rows yielded per day to a CSV or Parquet file in chunks of about chunk_rows rows,
+    so a long plan is never held in memory as a whole. Returns the number of rows written.
+    """
+    progress = progress or (lambda fraction: None)
+    tmp_path = f"{path}.tmp"
+    writer = None
+    buffer, written = [], 0
+
+    def flush():
+        nonlocal writer
+        frame = plan_chunk(buffer)
+        if file_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table)
+        else:
+            frame.to_csv(tmp_path, mode="a" if written else "w", header=not written, index=False)
+        buffer.clear()
+
+    try:
+        for rows in days:
+            buffer.extend(rows)
+            if len(buffer) >= chunk_rows:
+                count = len(buffer)
+                flush()
+                written += count
+                progress(written)
+        if buffer or not written:
+            count = len(buffer)
+            flush()
+            written += count
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, path)
+    return written
+
+
+def build_meal_plan(request, search, executor, path, file_format="csv", page_size=50,
+                    calories=None, chunk_rows=500, progress=None):
+    """
+    Builds a meal plan file at `path`. search(query, limit, filter) runs on the executor for every
+    page in search_specs(); results are handed to the assembler as they complete, and the plan is
+    then written day by day. Returns the path.
+    """
+    progress = progress or (lambda fraction: None)
+    assembler = PlanAssembler(request, calories)
+    specs = search_specs(request, page_size)
+    futures = {executor.submit(search, query, page_size, search_filter): slot for slot, query, search_filter in specs}
+    for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+        try:
+            assembler.add(futures[future], future.result().get("results", []))
+        except Exception as e:
+            print(f"Meal plan search failed: {e}")
+        progress(0.6 * done / len(futures))
+    if not len(assembler):
+        raise RuntimeError("No recipes match the meal plan filters")
+
+    total_rows = request.days * len(request.slots)
+    write_plan(assembler.days(), path, file_format, chunk_rows,
+               progress=lambda written: progress(0.6 + 0.4 * written / total_rows))
+    return path
@@ -0,0 +1,394 @@
+import difflib
+import os
+import re
+import time
+
+import numpy as np
+
+from caching import normalize_query
+
+# Conversion factors to grams for the mass units found in the nutrition table
+UNIT_FACTORS = {"g": 1.0, "mg": 1e-3, "mcg": 1e-6, "ug": 1e-6, "µg": 1e-6}
+
+# Words users write for the TABLE2 nutrient columns
+NUTRIENT_SYNONYMS = {
+    "calories": "CALORIES", "calorie": "CALORIES", "kcal": "CALORIES", "energy": "CALORIES",
+    "fat": "TOTAL_FAT", "fats": "TOTAL_FAT", "total fat": "TOTAL_FAT",
+    "cholesterol": "CHOLESTEROL",
+    "sodium": "SODIUM", "salt": "SODIUM",
+    "vitamin a": "VITAMIN_A", "vitamin b12": "VITAMIN_B12", "vitamin b6": "VITAMIN_B6",
+    "vitamin c": "VITAMIN_C", "vitamin d": "VITAMIN_D", "vitamin e": "VITAMIN_E", "vitamin k": "VITAMIN_K",
+    "calcium": "CALCIUM", "iron": "IRON", "potassium": "POTASSIUM",
+    "protein": "PROTEIN", "proteins": "PROTEIN",
+    "carbohydrate": "CARBOHYDRATE", "carbohydrates": "CARBOHYDRATE", "carbs": "CARBOHYDRATE", "carb": "CARBOHYDRATE",
+}
+_NUTRIENT = "|".join(sorted((re.escape(word) for word in NUTRIENT_SYNONYMS), key=len, reverse=True))
+_NUMBER = r"(\d+(?:\.\d+)?)\s*(?:g|mg|mcg|grams?|kcal)?"
+
+TOP_PATTERN = re.compile(rf"\b(?:top|best|first)\s+(\d+)\b.*?\b(?:by|in|for)\s+({_NUTRIENT})\b")
+EXTREME_PATTERN = re.compile(rf"\b(highest|most|richest|lowest|least|fewest)\s+(?:in\s+)?({_NUTRIENT})\b")
+RICH_PATTERN = re.compile(rf"\b(high|rich|low)\s+(?:in\s+)?({_NUTRIENT})\b")
+MAX_PATTERN = re.compile(rf"\b(?:under|below|less than|at most|max(?:imum)?|up to)\s+{_NUMBER}\s*(?:of\s+)?({_NUTRIENT})\b")
+MIN_PATTERN = re.compile(rf"\b(?:over|above|more than|at least|min(?:imum)?)\s+{_NUMBER}\s*(?:of\s+)?({_NUTRIENT})\b")
+# Words a structured nutrient question may carry besides its criteria. Anything else (a diet, a food
+# group, "for diabetics") needs semantic search
+NUTRIENT_QUERY_WORDS = set("""
+    a an and are as at by can contain containing content find food foods for give has have i in ingredient
+    ingredients is it item items list me my of on options per please show some that the to what which
+    with
+""".split())
+
+# Leading phrases stripped from by-name questions to leave the food names
+NAME_PREFIX = re.compile(
+    r"^(?:(?:what|which) (?:is|are) (?:the )?|give me (?:the )?|show me (?:the )?|can you tell me |tell me )?"
+    r"(?:about |nutrition(?:al)? (?:facts|values?|information|info|content|profile) (?:of|for|in) |"
+    r"(?:calories|benefits|nutrients|nutrition) (?:of|in) |compare (?:the )?(?:nutrition(?:al)? (?:facts|values?) of )?)"
+)
+NAME_SEPARATOR = re.compile(r"\s*(?:,|\band\b|\bvs\b|\bversus\b|\bwith\b|\bthan\b|\bor\b)\s*")
+
+
+def to_numeric_column(series):
+    """
+    Converts a column of values such as "9.17 g" or "381 mg" to floats in the column's most
+    common mass unit. Values without a recognised unit are taken as they are.
+    """
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(float)
+    parts = series.astype(str).str.extract(r"([-+]?\d*\.?\d+)\s*([a-zA-Zµ]*)")
+    numbers = pd.to_numeric(parts[0], errors="coerce")
+    units = parts[1].str.lower()
+    factors = units.map(UNIT_FACTORS)
+    known_units = units[factors.notna()]
+    if known_units.empty:
+        return numbers
+    target = UNIT_FACTORS[known_units.mode().iloc[0]]
+    return numbers * factors.fillna(target).to_numpy() / target
+
+
+def name_keys(name):
+    """
+    Returns the lookup keys of a food name: the whole normalized name, its head before the first
+    comma ("Mangos, raw" -> "mangos") and the singular of that head.
+    """
+    normalized = normalize_query(name)
+    keys = [normalized]
+    head = normalize_query(str(name).split(",")[0])
+    for key in (head, re.sub(r"(?:es|s)$", "", head)):
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+class NutritionSnapshot:
+    """
+    In-memory copy of the nutrition table with numeric nutrient columns and a name index,
+    answering exact-name lookups and nutrient filters without a round trip to Cortex Search.
+    """
+
+    def __init__(self, frame, columns, loaded_at=None):
+        import pandas as pd
+
+        self.frame = frame.reset_index(drop=True)
+        self.columns = [column for column in columns if column in self.frame.columns]
+        self.nutrients = [column for column in self.columns if column not in ("NAME", "CATEGORY")]
+        self.values = pd.DataFrame({column: to_numeric_column(self.frame[column]) for column in self.nutrients})
+        self.loaded_at = loaded_at or time.time()
+        self.name_index = {}
+        for position, name in enumerate(self.frame["NAME"]):
+            for key in name_keys(name):
+                # Shorter names win, so "mango" resolves to "Mangos, raw" rather than "Mango nectar, canned"
+                current = self.name_index.get(key)
+                if current is None or len(str(name)) < len(str(self.frame["NAME"].iat[current])):
+                    self.name_index[key] = position
+        self._keys = list(self.name_index)
+
+    @classmethod
+    def load(cls, path, columns, fetch, max_age):
+        """
+        Reads the Parquet snapshot at `path`, refreshing it with fetch() when it is older than `max_age` seconds.
+        """
+        import pandas as pd
+
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+            return cls(pd.read_parquet(path), columns, loaded_at=os.path.getmtime(path))
+        frame = fetch()
+        tmp_path = f"{path}.tmp"
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        return cls(frame, columns)
+
+    def rows(self, positions):
+        records = self.frame.iloc[list(positions)][self.columns].to_dict(orient="records")
+        return [{k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in record.items()} for record in records]
+
+    def find(self, name, cutoff=0.85):
+        """
+        Returns the row position of a food name, exact first and then by fuzzy match, or None.
+        """
+        for key in name_keys(name):
+            if key in self.name_index:
+                return self.name_index[key]
+        matches = difflib.get_close_matches(normalize_query(name), self._keys, n=1, cutoff=cutoff)
+        if matches:
+            return self.name_index[matches[0]]
+        return None
+
+    def lookup(self, names):
+        """
+        Returns the rows of all names, or None if any of them isn't in the snapshot.
+        """
+        positions = [self.find(name) for name in names]
+        if not positions or any(position is None for position in positions):
+            return None
+        return self.rows(dict.fromkeys(positions))
+
+    def filter(self, constraints, sort_by=None, descending=True, limit=10):
+        """
+        Returns up to `limit` rows satisfying every (column, op, value) constraint, ranked by `sort_by`.
+        """
+        mask = np.ones(len(self.values), dtype=bool)
+        for column, op, value in constraints:
+            column_values = self.values[column].to_numpy()
+            mask &= column_values <= value if op == "<=" else column_values >= value
+        positions = np.flatnonzero(mask)
+        if sort_by is not None:
+            sort_values = self.values[sort_by].to_numpy()[positions]
+            sort_values = np.where(np.isnan(sort_values), -np.inf if descending else np.inf, sort_values)
+            order = np.argsort(-sort_values if descending else sort_values, kind="stable")
+            positions = positions[order]
+        return self.rows(positions[:limit])
+
+    def answer(self, query, classification, limit):
+        """
+        Answers the query locally in the shape of a Cortex Search response, or returns None when
+        the query needs semantic search.
+        """
+        if classification == "ingredients_by_name":
+            names = extract_food_names(query)
+            results = self.lookup(names) if names else None
+        else:
+            parsed = parse_nutrient_query(query, limit)
+            results = self.filter(**parsed) if parsed else None
+        if not results:
+            return None
+        return {"results": results, "request_id": "local-snapshot"}
+
+
+def extract_food_names(query):
+    """
+    Pulls the food names out of a by-name question, e.g. "Compare mangoes and bananas" -> ["mangoes", "bananas"].
+    """
+    text = NAME_PREFIX.sub("", normalize_query(query))
+    return [name for name in NAME_SEPARATOR.split(text) if name]
+
+
+def parse_nutrient_query(query, limit=10):
+    """
+    Parses structured nutrient questions such as "top 10 by protein under 200 calories" into
+    filter() arguments. Returns None when the query has no nutrient structure, ranks by more than one
+    nutrient or says anything the structure doesn't capture.
+    """
+    text = normalize_query(query).replace("less then", "less than")
+    constraints = [(NUTRIENT_SYNONYMS[m.group(2)], "<=", float(m.group(1))) for m in MAX_PATTERN.finditer(text)]
+    constraints += [(NUTRIENT_SYNONYMS[m.group(2)], ">=", float(m.group(1))) for m in MIN_PATTERN.finditer(text)]
+
+    # The whole query has to be structure: every word is part of a criterion or a filler word
+    matches = [(name, m) for name, pattern in (("top", TOP_PATTERN), ("extreme", EXTREME_PATTERN), ("rich", RICH_PATTERN),
+                                               ("limit", MAX_PATTERN), ("limit", MIN_PATTERN))
+               for m in pattern.finditer(text)]
+    covered = [False] * len(text)
+    for _, m in matches:
+        covered[m.start():m.end()] = [True] * (m.end() - m.start())
+    rest = "".join(" " if is_covered else char for char, is_covered in zip(text, covered))
+    if any(word not in NUTRIENT_QUERY_WORDS for word in rest.split()):
+        return None
+
+    sort_columns = {NUTRIENT_SYNONYMS[m.group(2)] for name, m in matches if name != "limit"}
+    if len(sort_columns) > 1:
+        # "low in sodium but high in protein" ranks by two things at once
+        return None
+
+    sort_by, descending = None, True
+    top = TOP_PATTERN.search(text)
+    extreme = EXTREME_PATTERN.search(text)
+    rich = RICH_PATTERN.search(text)
+    if top:
+        limit = int(top.group(1))
+        sort_by = NUTRIENT_SYNONYMS[top.group(2)]
+    elif extreme:
+        sort_by = NUTRIENT_SYNONYMS[extreme.group(2)]
+        descending = extreme.group(1) in ("highest", "most", "richest")
+    elif rich:
+        sort_by = NUTRIENT_SYNONYMS[rich.group(2)]
+        descending = rich.group(1) != "low"
+
+    if sort_by is None and not constraints:
+        return None
+    return {"constraints": constraints, "sort_by": sort_by, "descending": descending, "limit": limit}
+
+
+# "more/less <nutrient> than <food>" compares; "more than 10 g protein" is a filter
+COMPARISON_PATTERN = re.compile(
+    r"\b(?:compare|comparison|vs|versus|difference between|differ|healthier|better than)\b"
+    r"|\b(?:more|less|fewer) (?:\w+ )?than (?!\d)"
+)
+
+
+def is_comparison(query):
+    return bool(COMPARISON_PATTERN.search(normalize_query(query)))
+
+
+def compared_rows(query, rows):
+    """
+    Returns the rows of the foods a comparison question names, in the order it names them, or
+    an empty list unless at least two of them are among `rows`.
+    """
+    if not is_comparison(query):
+        return []
+    def names(row, name):
+        # The food may be named exactly or inside a longer phrase, e.g. "does spinach have more iron"
+        row_keys = name_keys(row.get("NAME", ""))
+        return bool(set(name_keys(name)) & set(row_keys)) or any(
+            re.search(rf"\b{re.escape(key)}(?:es|s)?\b", normalize_query(name)) for key in row_keys[1:]
+        )
+
+    matched = []
+    for name in extract_food_names(query):
+        for row in rows:
+            if row not in matched and names(row, name):
+                matched.append(row)
+                break
+    return matched if len(matched) >= 2 else []
+
+
+def mentioned_nutrients(query):
+    """
+    Returns the TABLE2 columns named in the query, in order of appearance.
+    """
+    text = normalize_query(query)
+    found = {}
+    for match in re.finditer(rf"\b({_NUTRIENT})\b", text):
+        found.setdefault(NUTRIENT_SYNONYMS[match.group(1)], None)
+    return list(found)
+
+
+def nutrient_values(rows, columns):
+    """
+    Builds the numeric nutrient frame (one row per item, indexed by NAME) for a batch of result rows.
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame(rows).drop_duplicates("NAME")
+    nutrients = [column for column in columns if column in frame.columns and column not in ("NAME", "CATEGORY")]
+    values = pd.DataFrame({column: to_numeric_column(frame[column]) for column in nutrients})
+    values.index = frame["NAME"].astype(str).to_numpy()
+    return values
+
+
+def per_100_kcal(values):
+    """
+    Normalizes every nutrient to the amount per 100 kcal of the item.
+    """
+    calories = values["CALORIES"].to_numpy(dtype=float) if "CALORIES" in values else np.full(len(values), np.nan)
+    scale = np.divide(100.0, calories, out=np.full_like(calories, np.nan), where=calories > 0)
+    return values.drop(columns="CALORIES", errors="ignore").mul(scale, axis=0)
+
+
+def compare_nutrients(values):
+    """
+    Compares every item against the first one. Returns (diff, ratio) frames shaped like `values`.
+    """
+    import pandas as pd
+
+    array = values.to_numpy(dtype=float)
+    base = array[0]
+    diff = array - base
+    ratio = np.divide(array, base, out=np.full_like(array, np.nan), where=base != 0)
+    return (
+        pd.DataFrame(diff, index=values.index, columns=values.columns),
+        pd.DataFrame(ratio, index=values.index, columns=values.columns),
+    )
+
+
+def category_percentiles(snapshot, names):
+    """
+    Percentile (0-100) of each item's nutrients within its CATEGORY across the whole snapshot.
+    """
+    ranks = snapshot.values.groupby(snapshot.frame["CATEGORY"].fillna("")).rank(pct=True) * 100
+    positions = [snapshot.find(name) for name in names]
+    ranks = ranks.reindex([position for position in positions if position is not None])
+    ranks.index = [name for name, position in zip(names, positions) if position is not None]
+    return ranks
+
+
+def top_k(values, nutrient, k=10, descending=True):
+    """
+    Returns the k items with the most (or least) of a nutrient.
+    """
+    column = values[nutrient].to_numpy(dtype=float)
+    column = np.where(np.isnan(column), -np.inf if descending else np.inf, column)
+    order = np.argsort(-column if descending else column, kind="stable")[:k]
+    return values.iloc[order]
+
+
+def format_number(value):
+    if value is None or (isinstance(value, float) and not np.isfinite(value)):
+        return "-"
+    return f"{value:.3g}" if abs(value) < 1000 else f"{value:.0f}"
+
+
+def markdown_table(frame, index_label):
+    """
+    Renders a small frame as a Markdown table without extra dependencies.
+    """
+    header = [index_label] + [str(column) for column in frame.columns]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    for label, row in frame.iterrows():
+        cells = [row_value if isinstance(row_value, str) else format_number(row_value) for row_value in row.tolist()]
+        lines.append("| " + " | ".join([str(label)] + cells) + " |")
+    return "\n".join(lines)
+
+
+def comparison_context(rows, columns, snapshot=None):
+    """
+    Compact Markdown comparing the items of `rows` nutrient by nutrient: values, difference and
+    ratio against the first item, amount per 100 kcal and, with a snapshot, category percentile.
+    """
+    import pandas as pd
+
+    values = nutrient_values(rows, columns)
+    diff, ratio = compare_nutrients(values)
+    normalized = per_100_kcal(values)
+    first = values.index[0]
+
+    table = pd.DataFrame(index=values.columns)
+    for name in values.index:
+        table[name] = values.loc[name]
+    for name in values.index[1:]:
+        table[f"{name} - {first}"] = diff.loc[name]
+        table[f"{name} / {first}"] = ratio.loc[name]
+    for name in values.index:
+        table[f"{name} per 100 kcal"] = normalized.loc[name].reindex(values.columns)
+    if snapshot is not None:
+        percentiles = category_percentiles(snapshot, list(values.index))
+        for name in percentiles.index:
+            table[f"{name} category percentile"] = percentiles.loc[name].reindex(values.columns)
+    return markdown_table(table.dropna(how="all"), "Nutrient")
+
+
+def ranking_context(rows, columns, query, limit=None):
+    """
+    Compact Markdown listing the items with their nutrients, ranked by the first nutrient the query names.
+    """
+    values = nutrient_values(rows, columns)
+    nutrients = mentioned_nutrients(query)
+    if nutrients and nutrients[0] in values:
+        descending = not re.search(r"\b(low|lowest|least|fewest|less)\b", normalize_query(query))
+        values = top_k(values, nutrients[0], limit or len(values), descending)
+    table = values.copy()
+    categories = {row["NAME"]: row.get("CATEGORY") for row in rows}
+    if any(categories.values()):
+        table.insert(0, "CATEGORY", [categories.get(name) or "-" for name in table.index])
+    return markdown_table(table, "NAME")
@@ -0,0 +1,140 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from caching import TTLCache
+from shopping import aggregate_ingredients
+
+# Follow-up question asked for a main ingredient; it matches the "ingredients_by_name" keyword
+# rule, so the follow-up is classified locally and searched exactly as warmed
+FOLLOW_UP_QUESTION = "Nutritional facts of {}"
+# Ingredients that flavor a dish rather than make it, which nobody asks the nutrition of
+MINOR_CATEGORIES = ("Spices & Herbs", "Oils & Condiments")
+
+
+def predict_follow_ups(recipes, limit=3):
+    """
+    Likely next questions about the recipes of a turn: the nutrition of their main ingredients,
+    those shared by the most recipes first.
+    """
+    items = [item for item in aggregate_ingredients(recipes)
+             if item.category not in MINOR_CATEGORIES and item.amounts]
+    # aggregate_ingredients sorts by category, and the stable sort keeps that order within ties
+    items.sort(key=lambda item: -len(item.recipes))
+    return [FOLLOW_UP_QUESTION.format(item.name) for item in items[:limit]]
+
+
+class Prefetcher:
+    """
+    Speculative work started on behalf of sessions before they ask for it. submit() runs a task on
+    a small pool of its own, so it never delays the calls of a turn; track() registers work started
+    elsewhere, e.g. an export render. Every key remembers the sessions ("owners") it was started
+    for, and release() cancels the work that none of them still wants. Finished tasks are kept as
+    warmed for `ttl` seconds, and claim() reports whether a lookup was served by one.
+    """
+
+    def __init__(self, max_workers=2, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._owners = {}  # key -> (set of owners, last registered at)
+        self._futures = {}  # key -> future of a submitted task
+        self._tracked = {}  # key -> callable cancelling work started elsewhere
+        self._warmed = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._counts = {"started": 0, "used": 0, "cancelled": 0, "failed": 0}
+
+    def _own(self, owner, key):
+        owners, _ = self._owners.get(key, (set(), None))
+        owners.add(owner)
+        self._owners[key] = (owners, time.time())
+
+    def submit(self, owner, key, fn, *args):
+        """
+        Runs fn(*args) in the background unless the work for key is pending or already warmed.
+        Returns whether it was started.
+        """
+        with self._lock:
+            self._own(owner, key)
+            if key in self._futures or self._warmed.get(key) is not None:
+                return False
+            self._futures[key] = self._executor.submit(self._run, key, fn, *args)
+            self._counts["started"] += 1
+        return True
+
+    def _run(self, key, fn, *args):
+        try:
+            fn(*args)
+            self._warmed.set(key, True)
+        except Exception as e:
+            with self._lock:
+                self._counts["failed"] += 1
+            print(f"Prefetch failed: {e}")
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+                self._owners.pop(key, None)
+
+    def track(self, owner, key, cancel):
+        """
+        Registers owner's interest in work started elsewhere. cancel() is called once no owner wants
+        it and returns whether the work was stopped before it started.
+        """
+        with self._lock:
+            self._own(owner, key)
+            self._tracked.setdefault(key, cancel)
+
+    def claim(self, key):
+        """
+        Returns whether key was warmed by a finished task, counting the prefetch as used.
+        """
+        if self._warmed.get(key) is None:
+            return False
+        self._warmed.delete(key)
+        with self._lock:
+            self._counts["used"] += 1
+        return True
+
+    def release(self, owner, keep=()):
+        """
+        Drops owner's interest in every key but those in keep and cancels the work nobody else
+        wants. Submitted tasks that have already started run to completion. Returns the number
+        cancelled.
+        """
+        keep = set(keep)
+        now = time.time()
+        cancelled = 0
+        with self._lock:
+            for key, (owners, registered_at) in list(self._owners.items()):
+                if key not in keep:
+                    owners.discard(owner)
+                if not owners:
+                    del self._owners[key]
+                    future = self._futures.get(key)
+                    if future is not None and future.cancel():
+                        del self._futures[key]
+                        cancelled += 1
+                    cancel = self._tracked.pop(key, None)
+                    if cancel is not None and cancel():
+                        cancelled += 1
+                elif key in self._tracked and now - registered_at > self.ttl:
+                    # Owners of tracked work may never come back; forget it without cancelling
+                    del self._owners[key]
+                    del self._tracked[key]
+            self._counts["cancelled"] += cancelled
+        return cancelled
+
+    def pending(self):
+        with self._lock:
+            return len(self._futures)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            pending, tracked = len(self._futures), len(self._tracked)
+        return {
+            "pending": pending,
+            "tracked": tracked,
+            "warmed": len(self._warmed),
+            **counts,
+            "hit_rate": counts["used"] / counts["started"] if counts["started"] else 0.0,
+        }
@@ -0,0 +1,96 @@
+import math
+import re
+
+# Recipe fields worth sending to the LLM, in the order they are rendered
+RECIPE_CONTEXT_FIELDS = [
+    ("TRANSLATEDRECIPENAME", "Recipe"),
+    ("CUISINE", "Cuisine"),
+    ("DIET", "Diet"),
+    ("PREPTIMEINMINS", "Prep (mins)"),
+    ("COOKTIMEINMINS", "Cook (mins)"),
+    ("TOTALTIMEINMINS", "Total (mins)"),
+    ("SERVINGS", "Servings"),
+    ("TRANSLATEDINGREDIENTS", "Ingredients"),
+    ("TRANSLATEDINSTRUCTIONS", "Instructions"),
+    ("URL", "URL"),
+]
+# Free-text fields that are truncated to make each recipe fit its share of the budget
+LONG_RECIPE_FIELDS = ("TRANSLATEDINGREDIENTS", "TRANSLATEDINSTRUCTIONS")
+
+
+def estimate_tokens(text):
+    """
+    Rough token count (about four characters per token for English text), good enough for budgeting.
+    """
+    return math.ceil(len(str(text)) / 4)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts text on a word boundary so that it fits in max_tokens.
+    """
+    text = re.sub(r"\s+", " ", str(text)).strip()
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max(0, max_chars - 1)].rsplit(" ", 1)[0]
+    return cut + "…"
+
+
+def truncate_lines_to_tokens(text, max_tokens):
+    """
+    Keeps whole lines (e.g. table rows) from the top of text while they fit in max_tokens.
+    """
+    kept, used = [], 0
+    for line in str(text).splitlines():
+        cost = estimate_tokens(line) + 1
+        if kept and used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept)
+
+
+def recipe_context(rows, max_tokens):
+    """
+    Renders recipe search results as compact labelled blocks, dropping duplicate recipes and
+    trimming instructions and ingredient lists so that all recipes fit in max_tokens.
+    """
+    unique = {}
+    for row in rows:
+        unique.setdefault(row.get("TRANSLATEDRECIPENAME"), row)
+    if not unique:
+        return ""
+    share = max_tokens // len(unique)
+
+    blocks = []
+    for row in unique.values():
+        short = [f"{label}: {row[field]}" for field, label in RECIPE_CONTEXT_FIELDS
+                 if field not in LONG_RECIPE_FIELDS and row.get(field) not in (None, "")]
+        remaining = share - estimate_tokens("\n".join(short))
+        # Ingredients get up to a third of what is left, instructions the rest
+        lines = list(short)
+        for field in LONG_RECIPE_FIELDS:
+            if not row.get(field):
+                continue
+            allowance = remaining // 3 if field == "TRANSLATEDINGREDIENTS" else remaining
+            value = truncate_to_tokens(row[field], max(allowance, 16))
+            remaining -= estimate_tokens(value)
+            lines.append(f"{dict(RECIPE_CONTEXT_FIELDS)[field]}: {value}")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def format_chat_history(messages, max_tokens, max_message_tokens=200):
+    """
+    Renders chat messages as "Role: content" lines, newest kept first, within max_tokens.
+    """
+    lines, used = [], 0
+    for message in reversed(list(messages or [])):
+        allowance = min(max_message_tokens, max_tokens - used - 4)
+        if allowance < 16:
+            break
+        line = f"{message['role'].capitalize()}: {truncate_to_tokens(message['content'], allowance)}"
+        lines.append(line)
+        used += estimate_tokens(line)
+    return "\n".join(reversed(lines))
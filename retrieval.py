@@ -0,0 +1,210 @@
+import math
+import re
+from dataclasses import dataclass
+
+from caching import normalize_query
+
+# Phrases users write for the DIET values of the recipe table, longest first
+DIET_PHRASES = [
+    ("high protein vegetarian", "High Protein Vegetarian"),
+    ("high protein non vegetarian", "High Protein Non Vegetarian"),
+    ("no onion no garlic", "No Onion No Garlic (Sattvic)"),
+    ("non vegetarian", "Non Vegeterian"),
+    ("non veg", "Non Vegeterian"),
+    ("nonveg", "Non Vegeterian"),
+    ("diabetic friendly", "Diabetic Friendly"),
+    ("diabetic", "Diabetic Friendly"),
+    ("gluten free", "Gluten Free"),
+    ("sugar free", "Sugar Free Diet"),
+    ("sattvic", "No Onion No Garlic (Sattvic)"),
+    ("eggetarian", "Eggetarian"),
+    ("vegetarian", "Vegetarian"),
+    ("veggie", "Vegetarian"),
+    ("veg", "Vegetarian"),
+    ("vegan", "Vegan"),
+]
+# DIET values that also satisfy a requested diet, e.g. vegan recipes are vegetarian too
+DIET_FAMILIES = {
+    "Vegetarian": ["Vegetarian", "High Protein Vegetarian", "Vegan", "No Onion No Garlic (Sattvic)"],
+    "Non Vegeterian": ["Non Vegeterian", "High Protein Non Vegetarian"],
+}
+# Cuisine words and the CUISINE values of the recipe table they stand for. "Indian" alone is left
+# out, since nearly every recipe is some Indian cuisine.
+CUISINES = {
+    "south indian": ["South Indian Recipes"],
+    "north indian": ["North Indian Recipes"],
+    "italian": ["Italian Recipes"],
+    "chinese": ["Chinese", "Indo Chinese"],
+    "indo chinese": ["Indo Chinese"],
+    "continental": ["Continental"],
+    "mexican": ["Mexican"],
+    "thai": ["Thai"],
+    "asian": ["Asian"],
+    "fusion": ["Fusion"],
+    "mediterranean": ["Mediterranean"],
+    "middle eastern": ["Middle Eastern"],
+    "lebanese": ["Lebanese"],
+    "greek": ["Greek"],
+    "french": ["French"],
+    "japanese": ["Japanese"],
+    "korean": ["Korean"],
+    "american": ["American"],
+    "punjabi": ["Punjabi"],
+    "kerala": ["Kerala Recipes"],
+    "bengali": ["Bengali Recipes"],
+    "gujarati": ["Gujarati Recipes"],
+    "rajasthani": ["Rajasthani"],
+    "maharashtrian": ["Maharashtrian Recipes"],
+    "goan": ["Goan Recipes"],
+    "hyderabadi": ["Hyderabadi"],
+    "mughlai": ["Mughlai"],
+    "kashmiri": ["Kashmiri"],
+    "chettinad": ["Chettinad"],
+    "andhra": ["Andhra"],
+    "karnataka": ["Karnataka"],
+    "udupi": ["Udupi"],
+    "tamil": ["Tamil Nadu"],
+    "mangalorean": ["Mangalorean"],
+    "konkan": ["Konkan"],
+    "sindhi": ["Sindhi"],
+    "awadhi": ["Awadhi"],
+    "parsi": ["Parsi Recipes"],
+}
+TIME_PATTERN = re.compile(
+    r"\b(?:under|below|less than|within|in|at most|max(?:imum)?|up to|no more than)\s+"
+    r"(\d+(?:\.\d+)?)\s*(min|mins|minute|minutes|hr|hrs|hour|hours)\b"
+)
+QUICK_WORDS = re.compile(r"\b(quick|quickly|fast|instant|easy)\b")
+QUICK_MINUTES = 30
+STOP_WORDS = set("""
+    a an and are as at be can for from give how i in is it me my of on or please recipe recipes show some
+    suggest that the to what which with make cook prepare dish dishes food foods want need something
+""".split())
+
+
+@dataclass(frozen=True)
+class RecipeConstraints:
+    diets: tuple = ()  # DIET values, any of which matches
+    cuisines: tuple = ()  # CUISINE values, any of which matches
+    max_minutes: float = 0  # 0 for no limit
+
+    def __bool__(self):
+        return bool(self.diets or self.cuisines or self.max_minutes)
+
+
+def _phrase(text, phrase):
+    return re.search(rf"\b{re.escape(phrase)}\b", text) is not None
+
+
+def extract_constraints(query):
+    """
+    Reads the diet, cuisines and time limit a recipe question asks for, e.g.
+    "vegetarian Italian under 30 minutes". Words that aren't constraints are ignored.
+    """
+    text = normalize_query(query)
+    diets = ()
+    for phrase, value in DIET_PHRASES:
+        if _phrase(text, phrase):
+            diets = tuple(DIET_FAMILIES.get(value, [value]))
+            break
+    cuisines = []
+    for word, values in CUISINES.items():
+        if _phrase(text, word):
+            cuisines.extend(value for value in values if value not in cuisines)
+    max_minutes = 0
+    match = TIME_PATTERN.search(text)
+    if match:
+        max_minutes = float(match.group(1)) * (60 if match.group(2).startswith(("hr", "hour")) else 1)
+    elif QUICK_WORDS.search(text):
+        max_minutes = QUICK_MINUTES
+    return RecipeConstraints(diets, tuple(cuisines), max_minutes)
+
+
+def constraint_filter(constraints):
+    """
+    Cortex Search filter on the DIET and CUISINE attributes, or None when there is nothing to filter.
+    The time limit is applied locally, as TOTALTIMEINMINS isn't a numeric attribute.
+    """
+    clauses = []
+    for column, values in (("DIET", constraints.diets), ("CUISINE", constraints.cuisines)):
+        if values:
+            options = [{"@eq": {column: value}} for value in values]
+            clauses.append(options[0] if len(options) == 1 else {"@or": options})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"@and": clauses}
+
+
+def _minutes(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def violations(recipe, constraints):
+    """
+    Number of hard constraints (diet, cuisine, time limit) the recipe breaks.
+    """
+    count = 0
+    if constraints.diets and str(recipe.get("DIET", "")).lower() not in {d.lower() for d in constraints.diets}:
+        count += 1
+    if constraints.cuisines and str(recipe.get("CUISINE", "")).lower() not in {c.lower() for c in constraints.cuisines}:
+        count += 1
+    if constraints.max_minutes and not _minutes(recipe.get("TOTALTIMEINMINS")) <= constraints.max_minutes:
+        count += 1
+    return count
+
+
+def query_terms(query):
+    """
+    Content words of the query, without stop words and the words that were read as constraints.
+    """
+    text = normalize_query(query)
+    for phrase, _ in DIET_PHRASES:
+        text = re.sub(rf"\b{re.escape(phrase)}\b", " ", text)
+    for word in CUISINES:
+        text = re.sub(rf"\b{re.escape(word)}\b", " ", text)
+    text = QUICK_WORDS.sub(" ", TIME_PATTERN.sub(" ", text))
+    return [word for word in text.split() if word not in STOP_WORDS and not word.isdigit()]
+
+
+def lexical_score(recipe, terms):
+    """
+    Share of the query terms found in the recipe, with name matches counting double.
+    """
+    if not terms:
+        return 0.0
+    name = set(normalize_query(recipe.get("TRANSLATEDRECIPENAME", "")).split())
+    body = set(normalize_query(recipe.get("TRANSLATEDINGREDIENTS", "")).split())
+    # Plural and singular forms count as the same word
+    stem = lambda word: re.sub(r"(?:es|s)$", "", word)
+    name |= {stem(word) for word in name}
+    body |= {stem(word) for word in body}
+    score = sum(2.0 if term in name or stem(term) in name else 1.0 if term in body or stem(term) in body else 0.0
+                for term in terms)
+    return score / (2.0 * len(terms))
+
+
+def rerank(results, query, constraints, limit, rrf_k=60):
+    """
+    Orders candidate recipes from a wider search: recipes breaking fewer hard constraints first,
+    then by reciprocal rank fusion of the semantic search rank and a lexical match of the query's
+    content words. Returns the top `limit`.
+    """
+    terms = query_terms(query)
+    lexical = [lexical_score(recipe, terms) for recipe in results]
+    lexical_rank = {index: rank for rank, index in enumerate(sorted(range(len(results)), key=lambda i: -lexical[i]))}
+
+    def key(index):
+        fused = 1 / (rrf_k + index + 1) + (1 / (rrf_k + lexical_rank[index] + 1) if lexical[index] else 0.0)
+        return violations(results[index], constraints), -fused
+
+    seen, ranked = set(), []
+    for index in sorted(range(len(results)), key=key):
+        name = results[index].get("TRANSLATEDRECIPENAME")
+        if name in seen:
+            continue
+        seen.add(name)
+        ranked.append(results[index])
+    return ranked[:limit]
@@ -0,0 +1,172 @@
+import concurrent.futures
+import contextvars
+import re
+import threading
+import time
+from collections import deque
+
+# Cortex COMPLETE models from smallest to largest
+MODELS = ("mistral-7b", "mixtral-8x7b", "mistral-large")
+# Credits per million tokens, from the Snowflake service consumption table
+MODEL_COSTS = {"mistral-7b": 0.12, "mixtral-8x7b": 0.22, "mistral-large": 5.10}
+
+# Words of questions that need reasoning over several items or constraints
+REASONING_WORDS = re.compile(
+    r"\b(compare|comparison|versus|vs|difference|between|instead|substitute|replace|why|explain|"
+    r"balanced|healthiest|plan|week|weekly|without|allergic|diabetic|pregnant)\b"
+)
+
+
+def question_complexity(question):
+    """
+    Scores a question from 0 (short lookup) to 2 (long or multi-part reasoning); the score is the
+    index into MODELS of the smallest model expected to answer it well.
+    """
+    words = question.lower().split()
+    score = 0
+    if len(words) > 20:
+        score += 1
+    if len(words) > 40:
+        score += 1
+    score += min(2, len(set(REASONING_WORDS.findall(" ".join(words)))))
+    if question.count("?") > 1:
+        score += 1
+    return 0 if score == 0 else 1 if score <= 2 else 2
+
+
+class ModelStats:
+    """
+    Recent call latencies per pipeline stage and model, plus timeout and error counts.
+    Timed out calls count with the full timeout, so a struggling model soon exceeds its budget.
+    """
+
+    def __init__(self, window=50):
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}  # (stage, model) -> deque of seconds
+        self._outcomes = {}  # (stage, model, outcome) -> count
+
+    def record(self, stage, model, seconds, outcome="ok"):
+        with self._lock:
+            self._latencies.setdefault((stage, model), deque(maxlen=self.window)).append(seconds)
+            key = (stage, model, outcome)
+            self._outcomes[key] = self._outcomes.get(key, 0) + 1
+
+    def percentile(self, stage, model, q=90):
+        """
+        The q-th percentile of the recent latencies, or None before the first call.
+        """
+        with self._lock:
+            samples = sorted(self._latencies.get((stage, model), ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._latencies)
+            outcomes = dict(self._outcomes)
+        stats = {}
+        for stage, model in sorted(keys):
+            stats.setdefault(model, {})[stage] = {
+                "calls": sum(count for (s, m, _), count in outcomes.items() if (s, m) == (stage, model)),
+                "timeouts": outcomes.get((stage, model, "timeout"), 0),
+                "errors": outcomes.get((stage, model, "error"), 0),
+                "p50": self.percentile(stage, model, 50),
+                "p90": self.percentile(stage, model, 90),
+            }
+        return stats
+
+
+class ModelRouter:
+    """
+    Picks the COMPLETE model for each pipeline stage. Stages in stage_models use their fixed model
+    and the others the smallest model the question's complexity allows. The choice never exceeds
+    the caller's ceiling or cost_budget (credits per million tokens, 0 for none), and steps down to
+    smaller models while the recorded p90 latency of the stage is over its latency budget.
+    call() retries on the next smaller model when a call times out or fails.
+    """
+
+    def __init__(self, stage_models=None, latency_budgets=None, timeouts=None, cost_budget=0,
+                 models=MODELS, costs=MODEL_COSTS, max_workers=16):
+        self.stage_models = dict(stage_models or {})
+        self.latency_budgets = dict(latency_budgets or {})
+        self.timeouts = dict(timeouts or {})
+        self.cost_budget = cost_budget
+        self.models = tuple(models)
+        self.costs = dict(costs)
+        self.model_stats = ModelStats()
+        # Calls with a timeout run here, so the caller can give up on them and move on
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="routed")
+
+    def candidates(self, ceiling=None):
+        """
+        Models from smallest to largest up to the ceiling that fit the cost budget.
+        """
+        models = self.models[:self.models.index(ceiling) + 1] if ceiling in self.models else self.models
+        affordable = [model for model in models if not self.cost_budget or self.costs.get(model, 0) <= self.cost_budget]
+        return affordable or [self.models[0]]
+
+    def choose(self, stage, question="", ceiling=None):
+        if ceiling is not None and ceiling not in self.models:
+            # Models the router doesn't know are used as they are
+            return ceiling
+        candidates = self.candidates(ceiling)
+        fixed = self.stage_models.get(stage)
+        tier = self.models.index(fixed) if fixed in self.models else question_complexity(question)
+        index = min(tier, len(candidates) - 1)
+        budget = self.latency_budgets.get(stage)
+        while budget and index > 0:
+            p90 = self.model_stats.percentile(stage, candidates[index])
+            if p90 is None or p90 <= budget:
+                break
+            index -= 1
+        return candidates[index]
+
+    def fallbacks(self, model):
+        """
+        The model followed by every smaller one, largest first.
+        """
+        if model not in self.models:
+            return [model]
+        return list(reversed(self.models[:self.models.index(model) + 1]))
+
+    def record(self, stage, model, seconds, outcome="ok"):
+        self.model_stats.record(stage, model, seconds, outcome)
+
+    def call(self, stage, model, fn):
+        """
+        Runs fn(model) within the stage's timeout and returns (result, model used). Calls that time
+        out or raise are retried with the next smaller model; the last error is raised when every
+        model failed. A timed out call can't be interrupted and finishes in the background.
+        """
+        timeout = self.timeouts.get(stage)
+        error = None
+        for attempt in self.fallbacks(model):
+            start = time.perf_counter()
+            future = None
+            try:
+                if timeout:
+                    future = self._executor.submit(contextvars.copy_context().run, fn, attempt)
+                    result = future.result(timeout=timeout)
+                else:
+                    result = fn(attempt)
+            except Exception as e:
+                # fn may raise TimeoutError itself (admission, session pool); only an unfinished
+                # future means the model ran out of time
+                if future is not None and not future.done():
+                    future.cancel()
+                    self.record(stage, attempt, timeout, "timeout")
+                    print(f"{stage} on {attempt} timed out after {timeout}s")
+                    error = TimeoutError(f"{stage} timed out on every model")
+                    continue
+                self.record(stage, attempt, time.perf_counter() - start, "error")
+                print(f"{stage} on {attempt} failed: {e}")
+                error = e
+                continue
+            self.record(stage, attempt, time.perf_counter() - start)
+            return result, attempt
+        raise error
+
+    def stats(self):
+        return self.model_stats.stats()
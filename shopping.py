@@ -0,0 +1,243 @@
+import re
+from dataclasses import dataclass, field
+from fractions import Fraction
+
+# unit -> (dimension, factor to the dimension's base unit: ml for volume, g for mass, 1 for counts)
+UNITS = {
+    "cup": ("volume", 240), "cups": ("volume", 240),
+    "tablespoon": ("volume", 15), "tablespoons": ("volume", 15), "tbsp": ("volume", 15), "tbs": ("volume", 15),
+    "teaspoon": ("volume", 5), "teaspoons": ("volume", 5), "tsp": ("volume", 5),
+    "ml": ("volume", 1), "millilitre": ("volume", 1), "milliliter": ("volume", 1),
+    "l": ("volume", 1000), "litre": ("volume", 1000), "liter": ("volume", 1000), "litres": ("volume", 1000), "liters": ("volume", 1000),
+    "pinch": ("volume", 0.3), "pinches": ("volume", 0.3), "dash": ("volume", 0.6),
+    "g": ("mass", 1), "gm": ("mass", 1), "gms": ("mass", 1), "gram": ("mass", 1), "grams": ("mass", 1),
+    "kg": ("mass", 1000), "kgs": ("mass", 1000), "kilogram": ("mass", 1000), "kilograms": ("mass", 1000),
+    "clove": ("count", 1), "cloves": ("count", 1), "piece": ("count", 1), "pieces": ("count", 1),
+    "sprig": ("count", 1), "sprigs": ("count", 1), "stalk": ("count", 1), "stalks": ("count", 1),
+    "inch": ("count", 1), "inches": ("count", 1), "bunch": ("count", 1), "bunches": ("count", 1),
+    "handful": ("count", 1), "handfuls": ("count", 1), "can": ("count", 1), "cans": ("count", 1),
+    "packet": ("count", 1), "packets": ("count", 1), "slice": ("count", 1), "slices": ("count", 1),
+}
+# Labels kept for counted units, e.g. "2 inch ginger" is bought as ginger by the inch
+COUNT_LABELS = {
+    "clove": "cloves", "cloves": "cloves", "sprig": "sprigs", "sprigs": "sprigs", "stalk": "stalks", "stalks": "stalks",
+    "inch": "inch", "inches": "inch", "bunch": "bunches", "bunches": "bunches", "handful": "handfuls",
+    "handfuls": "handfuls", "can": "cans", "cans": "cans", "packet": "packets", "packets": "packets",
+    "slice": "slices", "slices": "slices",
+}
+
+# Regional and alternative names -> canonical shopping name
+SYNONYMS = {
+    "haldi": "turmeric powder", "jeera": "cumin seeds", "cumin seeds jeera": "cumin seeds",
+    "dhania": "coriander", "dhania powder": "coriander powder", "coriander dhania leaves": "coriander leaves",
+    "coriander leaves": "coriander leaves", "cilantro": "coriander leaves", "methi": "fenugreek",
+    "kasuri methi": "dried fenugreek leaves", "hing": "asafoetida", "rai": "mustard seeds",
+    "sarson": "mustard seeds", "ajwain": "carom seeds", "pudina": "mint leaves", "atta": "whole wheat flour",
+    "maida": "all purpose flour", "besan": "gram flour", "sooji": "semolina", "rava": "semolina",
+    "dahi": "yogurt", "curd": "yogurt", "curd dahi": "yogurt", "paneer": "paneer", "cottage cheese": "paneer",
+    "kadi patta": "curry leaves", "curry leaf": "curry leaves", "adrak": "ginger", "lahsun": "garlic",
+    "pyaz": "onion", "tamatar": "tomato", "aloo": "potato", "matar": "green peas", "gobi": "cauliflower",
+    "imli": "tamarind", "gur": "jaggery", "elaichi": "cardamom", "laung": "cloves", "dalchini": "cinnamon",
+    "tej patta": "bay leaf", "kesar": "saffron", "chana dal": "bengal gram dal", "toor dal": "pigeon pea dal",
+    "arhar dal": "pigeon pea dal", "moong dal": "green gram dal", "urad dal": "black gram dal",
+    "capsicum": "bell pepper", "shimla mirch": "bell pepper", "brinjal": "eggplant", "baingan": "eggplant",
+    "lady finger": "okra", "bhindi": "okra", "green chillies": "green chilli", "red chillies": "red chilli",
+}
+
+# Singular terms; plurals ("eggs", "tomatoes", "chillies") match through the optional suffix the
+# compiled patterns add. The first matching category wins, and vegetable beans are kept out of the
+# pulses so they fall through to Produce.
+CATEGORIES = [
+    ("Spices & Herbs", r"powder|masala|seed|cumin|turmeric|chilli|chili|pepper corn|peppercorn|cardamom|clove|cinnamon|bay leaf|"
+                       r"asafoetida|saffron|fenugreek|curry leaves|mint|coriander|basil|oregano|thyme|parsley|salt|nutmeg|mace|star anise"),
+    ("Dairy & Eggs", r"milk|yogurt|cream|butter|ghee|cheese|paneer|khoya|egg"),
+    ("Meat & Seafood", r"chicken|mutton|lamb|fish|prawn|shrimp|beef|pork|keema|crab"),
+    ("Grains, Flours & Pulses", r"rice|flour|semolina|dal|lentil|gram|(?<!green )(?<!french )(?<!broad )(?<!string )bean|"
+                                r"chana|chickpea|rajma|oat|poha|noodle|pasta|bread|quinoa|millet"),
+    ("Oils & Condiments", r"oil|vinegar|sauce|ketchup|honey|sugar|jaggery|tamarind|paste|syrup|stock"),
+    ("Nuts & Dried Fruit", r"almond|cashew|peanut|walnut|pistachio|raisin|date|coconut|sesame|nut"),
+    ("Produce", r"onion|tomato|potato|garlic|ginger|carrot|pea|cauliflower|cabbage|spinach|eggplant|okra|bell pepper|"
+                r"lemon|lime|bean|gourd|pumpkin|mushroom|corn|cucumber|radish|beetroot|banana|apple|mango|leaves|fruit|vegetable"),
+]
+_CATEGORY_PATTERNS = [(category, re.compile(rf"\b(?:{pattern})(?:e?s)?\b", re.IGNORECASE)) for category, pattern in CATEGORIES]
+
+UNICODE_FRACTIONS = {"½": "1/2", "¼": "1/4", "¾": "3/4", "⅓": "1/3", "⅔": "2/3", "⅛": "1/8"}
+# A mixed number ("1 1/2", "1-1/2") is tried before the range alternative could split it
+_AMOUNT = r"\d+(?:\s+|-)\d+/\d+|\d+/\d+|\d+(?:\.\d+)?"
+QUANTITY_PATTERN = re.compile(rf"^\s*({_AMOUNT})(?:\s*(?:-|to)\s*({_AMOUNT}))?\s*")
+
+
+@dataclass
+class Ingredient:
+    name: str
+    dimension: str  # "volume", "mass", "count" or "as needed"
+    amount: float  # In the dimension's base unit
+    unit_label: str = ""
+
+
+@dataclass
+class ShoppingItem:
+    name: str
+    category: str
+    amounts: dict = field(default_factory=dict)  # dimension -> amount in base unit
+    unit_labels: dict = field(default_factory=dict)  # "count" dimension -> label such as "cloves"
+    as_needed: bool = False
+    recipes: set = field(default_factory=set)
+
+
+def split_ingredients(text):
+    """
+    Splits a TRANSLATEDINGREDIENTS string on the commas that aren't inside parentheses.
+    """
+    parts, depth, current = [], 0, []
+    for char in str(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(0, depth - 1)
+        if char == "," and depth == 0:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append("".join(current))
+    return [part.strip() for part in parts if part.strip()]
+
+
+def parse_amount(text):
+    return float(sum(Fraction(part) for part in text.replace("-", " ").split()))
+
+
+def canonical_name(name):
+    """
+    Maps an ingredient name to its shopping name: lowercase, without preparation notes, with
+    regional names from SYNONYMS resolved and a plural reduced to the singular.
+    """
+    name = name.lower()
+    alias = re.search(r"\(([^)]*)\)", name)
+    name = re.sub(r"\([^)]*\)", " ", name)
+    name = re.split(r"\s+-\s+|\s+–\s+", name)[0]
+    name = re.sub(r"[^a-z\s]", " ", name)
+    name = re.sub(r"\s+", " ", name).strip()
+    if name in SYNONYMS:
+        return SYNONYMS[name]
+    if alias:
+        alias_name = re.sub(r"\s+", " ", re.sub(r"[^a-z\s]", " ", alias.group(1))).strip()
+        if alias_name in SYNONYMS:
+            return SYNONYMS[alias_name]
+    for plural, singular in (("tomatoes", "tomato"), ("potatoes", "potato"), ("chillies", "chilli"), ("onions", "onion")):
+        name = re.sub(rf"\b{plural}\b", singular, name)
+    return SYNONYMS.get(name, name)
+
+
+def parse_ingredient(text):
+    """
+    Parses one ingredient line such as "1/2 cup Green peas (Matar)" or "Salt - to taste".
+    """
+    text = str(text)
+    for symbol, ascii_fraction in UNICODE_FRACTIONS.items():
+        text = text.replace(symbol, f" {ascii_fraction}")
+
+    match = QUANTITY_PATTERN.match(text)
+    if not match:
+        # No quantity: "Salt - to taste", "Oil for frying", "Coriander leaves"
+        return Ingredient(canonical_name(text), "as needed", 0.0)
+    # For a range such as "2-3 tomatoes" buy the upper bound; "a-b" with b below a is not a range
+    amount = parse_amount(match.group(1))
+    if match.group(2):
+        amount = max(amount, parse_amount(match.group(2)))
+    rest = text[match.end():]
+
+    unit_match = re.match(r"([a-zA-Z]+)\.?\s+", rest)
+    unit = unit_match.group(1).lower() if unit_match else ""
+    if unit in UNITS:
+        dimension, factor = UNITS[unit]
+        rest = rest[unit_match.end():]
+        label = COUNT_LABELS.get(unit, "") if dimension == "count" else ""
+        return Ingredient(canonical_name(rest), dimension, amount * factor, label)
+    return Ingredient(canonical_name(rest), "count", amount)
+
+
+def categorize(name):
+    for category, pattern in _CATEGORY_PATTERNS:
+        if pattern.search(name):
+            return category
+    return "Other"
+
+
+def aggregate_ingredients(recipes):
+    """
+    Merges the ingredients of all recipes into shopping items, summing quantities per dimension.
+    Returns the items sorted by category and name.
+    """
+    items = {}
+    for recipe in recipes:
+        recipe_name = recipe.get("TRANSLATEDRECIPENAME", "")
+        for line in split_ingredients(recipe.get("TRANSLATEDINGREDIENTS", "")):
+            ingredient = parse_ingredient(line)
+            if not ingredient.name:
+                continue
+            item = items.get(ingredient.name)
+            if item is None:
+                item = items[ingredient.name] = ShoppingItem(ingredient.name, categorize(ingredient.name))
+            item.recipes.add(recipe_name)
+            if ingredient.dimension == "as needed":
+                item.as_needed = True
+                continue
+            item.amounts[ingredient.dimension] = item.amounts.get(ingredient.dimension, 0.0) + ingredient.amount
+            if ingredient.unit_label:
+                item.unit_labels[ingredient.dimension] = ingredient.unit_label
+    category_order = [category for category, _ in CATEGORIES] + ["Other"]
+    return sorted(items.values(), key=lambda item: (category_order.index(item.category), item.name))
+
+
+def format_number(amount):
+    fraction = Fraction(amount).limit_denominator(4)
+    if abs(float(fraction) - amount) < 0.01:
+        whole, remainder = divmod(fraction, 1)
+        if remainder and whole:
+            return f"{whole} {remainder}"
+        return str(remainder or whole)
+    return f"{amount:.1f}"
+
+
+def format_quantity(item):
+    """
+    Renders the summed quantities of an item in kitchen units, e.g. "1 1/2 cups + 2 cloves".
+    """
+    parts = []
+    volume = item.amounts.get("volume")
+    if volume:
+        if volume >= 1000:
+            parts.append(f"{format_number(volume / 1000)} l")
+        elif volume >= 60:
+            cups = volume / 240
+            parts.append(f"{format_number(cups)} {'cup' if cups <= 1 else 'cups'}")
+        elif volume >= 15:
+            parts.append(f"{format_number(volume / 15)} tbsp")
+        else:
+            parts.append(f"{format_number(volume / 5)} tsp")
+    mass = item.amounts.get("mass")
+    if mass:
+        parts.append(f"{format_number(mass / 1000)} kg" if mass >= 1000 else f"{format_number(mass)} g")
+    count = item.amounts.get("count")
+    if count:
+        parts.append(f"{format_number(count)} {item.unit_labels.get('count', '')}".strip())
+    if item.as_needed:
+        parts.append("as needed")
+    return " + ".join(parts)
+
+
+def shopping_list_markdown(items):
+    """
+    Renders shopping items as Markdown grouped by category.
+    """
+    lines = ["# Shopping List"]
+    category = None
+    for item in items:
+        if item.category != category:
+            category = item.category
+            lines.append(f"\n## {category}")
+        quantity = format_quantity(item)
+        lines.append(f"- **{item.name.capitalize()}**" + (f": {quantity}" if quantity else ""))
+    return "\n".join(lines)
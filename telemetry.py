@@ -0,0 +1,309 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompting import estimate_tokens
+
+# Upper bounds in seconds of the Prometheus latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def new_id(length):
+    return os.urandom(length // 2).hex()
+
+
+class Span:
+    """
+    One timed operation of a trace. Attributes describe it, e.g. model, prompt_tokens or cache.
+    """
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(16)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+class Tracer:
+    """
+    Records spans of recent turns in a bounded buffer and aggregates them into Prometheus metrics.
+    Spans started in the same context nest under each other; fan_out carries the context into its
+    worker threads.
+    """
+
+    def __init__(self, max_spans=5000):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._durations = {}  # name -> [bucket counts..., +Inf count, sum]
+        self._errors = {}
+        self._cache = {}  # (name, result) -> count
+        self._gauges = {}  # metric name -> (help text, read)
+
+    @contextmanager
+    def trace(self):
+        """
+        Starts a new trace, e.g. for one chat turn, and yields its id.
+        """
+        trace_id = new_id(32)
+        token = _current_trace.set(trace_id)
+        try:
+            yield trace_id
+        finally:
+            _current_trace.reset(token)
+
+    def start_span(self, name, **attributes):
+        """
+        Starts a span under the current one without making it current; finish() records it.
+        """
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent else (_current_trace.get() or new_id(32))
+        return Span(name, trace_id, parent.span_id if parent else None, attributes)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            self.finish(span)
+
+    def finish(self, span):
+        span.end = time.time()
+        with self._lock:
+            self._spans.append(span)
+            histogram = self._durations.setdefault(span.name, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if span.duration <= bound:
+                    histogram[index] += 1
+            histogram[len(LATENCY_BUCKETS)] += 1
+            histogram[-1] += span.duration
+            if span.error:
+                self._errors[span.name] = self._errors.get(span.name, 0) + 1
+            cache = span.attributes.get("cache")
+            if cache:
+                self._cache[(span.name, cache)] = self._cache.get((span.name, cache), 0) + 1
+
+    def gauge(self, name, help_text, read):
+        """
+        Exports read(), called on every scrape, as a Prometheus gauge.
+        """
+        self._gauges[name] = (help_text, read)
+
+    def spans(self, trace_id=None):
+        with self._lock:
+            return [span for span in self._spans if trace_id is None or span.trace_id == trace_id]
+
+    def prometheus(self):
+        """
+        Renders the aggregated metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            durations = {name: list(values) for name, values in self._durations.items()}
+            errors = dict(self._errors)
+            cache = dict(self._cache)
+        lines = [
+            "# HELP nutrimate_span_duration_seconds Duration of pipeline stages and remote calls.",
+            "# TYPE nutrimate_span_duration_seconds histogram",
+        ]
+        for name, histogram in sorted(durations.items()):
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                lines.append(f'nutrimate_span_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {histogram[index]}')
+            count = histogram[len(LATENCY_BUCKETS)]
+            lines.append(f'nutrimate_span_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+            lines.append(f'nutrimate_span_duration_seconds_sum{{stage="{name}"}} {histogram[-1]:.6f}')
+            lines.append(f'nutrimate_span_duration_seconds_count{{stage="{name}"}} {count}')
+        lines += ["# HELP nutrimate_span_errors_total Failed pipeline stages and remote calls.",
+                  "# TYPE nutrimate_span_errors_total counter"]
+        for name, count in sorted(errors.items()):
+            lines.append(f'nutrimate_span_errors_total{{stage="{name}"}} {count}')
+        lines += ["# HELP nutrimate_cache_lookups_total Cache lookups by stage and result.",
+                  "# TYPE nutrimate_cache_lookups_total counter"]
+        for (name, result), count in sorted(cache.items()):
+            lines.append(f'nutrimate_cache_lookups_total{{stage="{name}",result="{result}"}} {count}')
+        for name, (help_text, read) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {read()}"]
+        return "\n".join(lines) + "\n"
+
+    def otlp_json(self, trace_id=None):
+        """
+        Returns the recorded spans as an OTLP/JSON ExportTraceServiceRequest.
+        """
+        def value(item):
+            if isinstance(item, bool):
+                return {"boolValue": item}
+            if isinstance(item, int):
+                return {"intValue": str(item)}
+            if isinstance(item, float):
+                return {"doubleValue": item}
+            return {"stringValue": str(item)}
+
+        spans = []
+        for span in self.spans(trace_id):
+            record = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 3 if span.name.startswith("remote.") else 1,  # SPAN_KIND_CLIENT or SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(int(span.start * 1e9)),
+                "endTimeUnixNano": str(int((span.end or time.time()) * 1e9)),
+                "attributes": [{"key": key, "value": value(item)} for key, item in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                record["parentSpanId"] = span.parent_id
+            spans.append(record)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "nutrimate"}}]},
+                "scopeSpans": [{"scope": {"name": "nutrimate"}, "spans": spans}],
+            }]
+        }
+
+
+def current_span():
+    """
+    The innermost open span of the calling context, or None.
+    """
+    return _current_span.get()
+
+
+def size_attributes(prefix, text):
+    text = "" if text is None else str(text)
+    return {f"{prefix}_chars": len(text), f"{prefix}_tokens": estimate_tokens(text)}
+
+
+class InstrumentedBackend:
+    """
+    Wraps a backend so that every remote call is recorded as a span with its model, prompt and
+    response sizes, latency and error.
+    """
+
+    def __init__(self, backend, tracer):
+        self.backend = backend
+        self.tracer = tracer
+        self.name = backend.name
+
+    def classify(self, query):
+        with self.tracer.span("remote.classify", backend=self.name, **size_attributes("prompt", query)) as span:
+            label = self.backend.classify(query)
+            span.set("label", str(label))
+            return label
+
+    def classify_and_complete(self, query, model_name, prompt):
+        with self.tracer.span("remote.classify_and_complete", backend=self.name, model=model_name,
+                              **size_attributes("prompt", prompt)) as span:
+            label, response = self.backend.classify_and_complete(query, model_name, prompt)
+            span.attributes.update(size_attributes("response", response))
+            span.set("label", str(label))
+            return label, response
+
+    def search(self, service, query, columns, limit, search_filter=None):
+        with self.tracer.span("remote.search", backend=self.name, service=service, limit=limit,
+                              filtered=bool(search_filter), **size_attributes("prompt", query)) as span:
+            results = self.backend.search(service, query, columns, limit, search_filter)
+            span.set("results", len(results.get("results", [])))
+            span.attributes.update(size_attributes("response", json.dumps(results, default=str)))
+            return results
+
+    def complete(self, prompt, model_name):
+        with self.tracer.span("remote.complete", backend=self.name, model=model_name,
+                              **size_attributes("prompt", prompt)) as span:
+            response = self.backend.complete(prompt, model_name)
+            span.attributes.update(size_attributes("response", response))
+            return response
+
+    def complete_batch(self, prompts, model_name):
+        with self.tracer.span("remote.complete_batch", backend=self.name, model=model_name, prompts=len(prompts),
+                              **size_attributes("prompt", "".join(prompts))) as span:
+            responses = self.backend.complete_batch(prompts, model_name)
+            span.attributes.update(size_attributes("response", "".join(filter(None, responses))))
+            return responses
+
+    def stream(self, prompt, model_name):
+        # The span stays open while the caller consumes the stream, but isn't made current because
+        # a generator may be closed from another context
+        span = self.tracer.start_span("remote.stream", backend=self.name, model=model_name,
+                                      **size_attributes("prompt", prompt))
+        chunks = []
+        try:
+            for chunk in self.backend.stream(prompt, model_name):
+                if not chunks:
+                    span.set("time_to_first_token", time.time() - span.start)
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.attributes.update(size_attributes("response", "".join(chunks)))
+            self.tracer.finish(span)
+
+    def embed(self, text, model_name):
+        with self.tracer.span("remote.embed", backend=self.name, model=model_name, **size_attributes("prompt", text)):
+            return self.backend.embed(text, model_name)
+
+    def fetch_table(self, table, columns):
+        with self.tracer.span("remote.fetch_table", backend=self.name, table=table) as span:
+            frame = self.backend.fetch_table(table, columns)
+            span.set("rows", len(frame))
+            return frame
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def serve(tracer, port, host="127.0.0.1"):
+    """
+    Serves GET /metrics (Prometheus text) and GET /traces (OTLP JSON, ?trace_id= to filter)
+    from a daemon thread and returns the server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            if path == "/metrics":
+                body = tracer.prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            elif path == "/traces":
+                params = dict(part.split("=", 1) for part in query.split("&") if "=" in part)
+                body = json.dumps(tracer.otlp_json(params.get("trace_id"))).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="telemetry", daemon=True).start()
+    return server
@@ -0,0 +1,97 @@
+import http.server
+import json
+import threading
+import types
+from contextlib import contextmanager
+
+import pytest
+
+from backends import SnowflakeBackend
+
+TOKEN = "session-token"
+
+# Recorded inference:complete events, with the keep-alive comment the service sends first
+RECORDED_STREAM = [
+    b": keep-alive\n\n",
+    b'data: {"id": "1", "model": "mistral-7b", "choices": [{"delta": {"content": "Spinach is "}}]}\n\n',
+    b'data: {"id": "1", "model": "mistral-7b", "choices": [{"delta": {"content": "rich in iron."}}]}\n\n',
+    b"data: [DONE]\n\n",
+]
+ERROR_STREAM = RECORDED_STREAM[:2] + [b'event: error\ndata: {"message": "Model is overloaded"}\n\n']
+EXPIRED_SESSION = {"code": "390112", "message": "Your session has expired. Please login again."}
+
+
+class FakeCortex(http.server.BaseHTTPRequestHandler):
+    """
+    Serves server.reply, a list of SSE chunks or (status, JSON body), and records each request.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, dict(self.headers), body))
+        reply = self.server.reply
+        if isinstance(reply, tuple):
+            status, payload = reply
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for chunk in reply:
+            self.wfile.write(chunk)
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakePool:
+    @contextmanager
+    def connection(self):
+        rest = types.SimpleNamespace(token=TOKEN)
+        yield types.SimpleNamespace(session=types.SimpleNamespace(connection=types.SimpleNamespace(rest=rest)))
+
+
+@pytest.fixture
+def server():
+    server = http.server.HTTPServer(("127.0.0.1", 0), FakeCortex)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backend(server):
+    return SnowflakeBackend(FakePool(), None, f"http://127.0.0.1:{server.server_port}", stream_timeout=5)
+
+
+def test_stream_yields_the_recorded_chunks(server, backend):
+    server.reply = RECORDED_STREAM
+    assert list(backend.stream("Tell me about spinach", "mistral-7b")) == ["Spinach is ", "rich in iron."]
+    (path, headers, body), = server.requests
+    assert path == "/api/v2/cortex/inference:complete"
+    assert headers["Authorization"] == f'Snowflake Token="{TOKEN}"'
+    assert headers["Accept"] == "text/event-stream"
+    assert body == {"model": "mistral-7b", "messages": [{"role": "user", "content": "Tell me about spinach"}], "stream": True}
+
+
+def test_stream_raises_on_an_error_event(server, backend):
+    server.reply = ERROR_STREAM
+    chunks = backend.stream("Tell me about spinach", "mistral-7b")
+    assert next(chunks) == "Spinach is "
+    with pytest.raises(RuntimeError, match="Model is overloaded"):
+        next(chunks)
+
+
+def test_stream_raises_with_the_message_of_an_http_error(server, backend):
+    server.reply = (401, EXPIRED_SESSION)
+    with pytest.raises(RuntimeError, match="returned 401: Your session has expired"):
+        list(backend.stream("Tell me about spinach", "mistral-7b"))
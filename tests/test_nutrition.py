@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+import pytest
+
+from nutrition import NutritionSnapshot, parse_nutrient_query
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fixtures")
+
+
+@pytest.fixture(scope="module")
+def snapshot():
+    frame = pd.read_csv(os.path.join(FIXTURES, "nutrition.csv"))
+    return NutritionSnapshot(frame, list(frame.columns))
+
+
+@pytest.mark.parametrize("query, sort_by, descending, constraints", [
+    ("foods high in protein", "PROTEIN", True, []),
+    ("Which foods are highest in iron?", "IRON", True, []),
+    ("foods low in sodium", "SODIUM", False, []),
+    ("top 10 by protein under 200 calories", "PROTEIN", True, [("CALORIES", "<=", 200.0)]),
+    ("show me foods with at least 10 g protein", None, True, [("PROTEIN", ">=", 10.0)]),
+])
+def test_parse_structured_query(query, sort_by, descending, constraints):
+    parsed = parse_nutrient_query(query)
+    assert (parsed["sort_by"], parsed["descending"], parsed["constraints"]) == (sort_by, descending, constraints)
+
+
+@pytest.mark.parametrize("query", [
+    "which foods are low in sodium but high in protein",
+    "high protein vegetarian foods",
+    "fruits rich in vitamin c",
+    "low sodium foods for diabetics",
+    "healthy breakfast ideas",
+])
+def test_mixed_queries_need_semantic_search(snapshot, query):
+    assert parse_nutrient_query(query) is None
+    assert snapshot.answer(query, "ingredients", 10) is None
+
+
+def test_structured_query_answered_locally(snapshot):
+    response = snapshot.answer("foods high in protein", "ingredients", 3)
+    proteins = [float(row["PROTEIN"].split()[0]) for row in response["results"]]
+    assert proteins == sorted(proteins, reverse=True)
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from routing import ModelRouter
+
+
+def flaky(failing, exception):
+    def fn(model):
+        if model in failing:
+            raise exception
+        return f"answer from {model}"
+    return fn
+
+
+def test_call_without_timeout_falls_back_on_timeout_error():
+    router = ModelRouter()
+    result, model = router.call("answer", "mixtral-8x7b", flaky({"mixtral-8x7b"}, TimeoutError("no slot free")))
+    assert (result, model) == ("answer from mistral-7b", "mistral-7b")
+    stats = router.stats()["mixtral-8x7b"]["answer"]
+    assert (stats["errors"], stats["timeouts"]) == (1, 0)
+
+
+def test_call_records_errors_raised_within_the_timeout_at_their_real_latency():
+    router = ModelRouter(timeouts={"answer": 30})
+    result, model = router.call("answer", "mixtral-8x7b", flaky({"mixtral-8x7b"}, TimeoutError("no slot free")))
+    assert model == "mistral-7b"
+    stats = router.stats()["mixtral-8x7b"]["answer"]
+    assert (stats["errors"], stats["timeouts"]) == (1, 0)
+    assert stats["p90"] < 1
+
+
+def test_call_falls_back_when_the_model_times_out():
+    router = ModelRouter(timeouts={"answer": 0.05})
+
+    def fn(model):
+        if model == "mixtral-8x7b":
+            time.sleep(0.3)
+        return f"answer from {model}"
+
+    assert router.call("answer", "mixtral-8x7b", fn) == ("answer from mistral-7b", "mistral-7b")
+    stats = router.stats()["mixtral-8x7b"]["answer"]
+    assert (stats["timeouts"], stats["p90"]) == (1, 0.05)
+
+
+def test_call_raises_the_last_error_when_every_model_fails():
+    router = ModelRouter()
+    with pytest.raises(ValueError):
+        router.call("answer", "mixtral-8x7b", flaky({"mixtral-8x7b", "mistral-7b"}, ValueError("bad prompt")))
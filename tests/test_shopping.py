@@ -0,0 +1,31 @@
+import pytest
+
+from shopping import categorize, parse_ingredient
+
+
+@pytest.mark.parametrize("line, name, dimension, amount", [
+    ("1-1/2 cups Ragi vermicelli", "ragi vermicelli", "volume", 360),
+    ("1 1/2 cups Ragi vermicelli", "ragi vermicelli", "volume", 360),
+    ("1/2 cup Green peas (Matar)", "green peas", "volume", 120),
+    ("2-3 Tomatoes - chopped", "tomato", "count", 3),
+    ("1 to 2 teaspoons Sugar", "sugar", "volume", 10),
+    ("3-1 Onions", "onion", "count", 3),
+    ("Salt - to taste", "salt", "as needed", 0),
+])
+def test_parse_ingredient(line, name, dimension, amount):
+    ingredient = parse_ingredient(line)
+    assert (ingredient.name, ingredient.dimension) == (name, dimension)
+    assert ingredient.amount == pytest.approx(amount)
+
+
+@pytest.mark.parametrize("name, category", [
+    ("Eggs", "Dairy & Eggs"),
+    ("Cloves", "Spices & Herbs"),
+    ("green beans", "Produce"),
+    ("kidney beans", "Grains, Flours & Pulses"),
+    ("corn flour", "Grains, Flours & Pulses"),
+    ("tomatoes", "Produce"),
+    ("unobtainium", "Other"),
+])
+def test_categorize(name, category):
+    assert categorize(name) == category